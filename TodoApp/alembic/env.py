@@ -1,15 +1,23 @@
+import logging
+import os
+import time
 from logging.config import fileConfig
-from sqlalchemy import engine_from_config
+from sqlalchemy import engine_from_config, event
 from sqlalchemy import pool
 from alembic import context
 
 import models
+from migration_helpers import backfill_progress
 
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
 
+# same DATABASE_URL as the app (see database.py), alembic.ini only has the local sqlite default
+if os.getenv('DATABASE_URL'):
+    config.set_main_option('sqlalchemy.url', os.environ['DATABASE_URL'].replace('%', '%%'))
+
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
 fileConfig(config.config_file_name)
@@ -25,6 +33,38 @@ target_metadata = models.Base.metadata
 # my_important_option = config.get_main_option("my_important_option")
 # ... etc.
 
+# Dry run: alembic -x dry_run=true upgrade head  (or MIGRATION_DRY_RUN=1)
+# Every migration runs inside one transaction which is rolled back at the end, the time of each
+# revision is logged, and the batched helpers of migration_helpers.py only time a few sample
+# batches and print an estimate for the whole table instead of doing the work.
+DRY_RUN = (context.get_x_argument(as_dictionary=True).get('dry_run', '').lower() in ('1', 'true', 'yes')
+           or os.getenv('MIGRATION_DRY_RUN', '').lower() in ('1', 'true', 'yes'))
+
+logger = logging.getLogger('alembic.env')
+
+# In the database on purpose but not in the models: the full text index of search.py, that is
+# the FTS5 table with its shadow tables (todos_fts_data, _idx, _content, _docsize, _config) on
+# SQLite and the generated search_vector column with its GIN index on PostgreSQL, and the
+# progress table of migration_helpers.backfill(). Without this autogenerate and `alembic check`
+# want to drop them.
+SKIPPED_TABLES = {backfill_progress.name}
+SKIPPED_TABLE_PREFIXES = ('todos_fts',)
+SKIPPED_COLUMNS = {('todos', 'search_vector')}
+SKIPPED_INDEXES = {'ix_todos_search_vector'}
+
+
+def include_object(object, name, type_, reflected, compare_to) -> bool:
+    # only what is in the database and missing from the models is skipped
+    if not reflected or compare_to is not None:
+        return True
+    if type_ == 'table':
+        return name not in SKIPPED_TABLES and not name.startswith(SKIPPED_TABLE_PREFIXES)
+    if type_ == 'column':
+        return (object.table.name, name) not in SKIPPED_COLUMNS
+    if type_ == 'index':
+        return name not in SKIPPED_INDEXES
+    return True
+
 
 def run_migrations_offline() -> None:
     """Run migrations in 'offline' mode.
@@ -42,6 +82,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_object=include_object,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -50,6 +91,28 @@ def run_migrations_offline() -> None:
         context.run_migrations()
 
 
+def make_sqlite_transactional(engine) -> None:
+    # pysqlite does not BEGIN before DDL, so a rollback would keep CREATE / ALTER / DROP. With
+    # this the dry run can roll back everything, schema changes included.
+    @event.listens_for(engine, 'connect')
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def do_begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+
+def log_revision_time(ctx, step, heads, run_args) -> None:
+    # on_version_apply runs after every revision, the clock restarts for the next one
+    now = time.perf_counter()
+    started = ctx.opts['revision_started']
+    logger.info('%s%s %s took %.2fs', 'dry run: ' if DRY_RUN else '',
+                'upgrade to' if step.is_upgrade else 'downgrade from', step.up_revision_id,
+                now - started[0])
+    started[0] = now
+
+
 def run_migrations_online() -> None:
     """Run migrations in 'online' mode.
 
@@ -62,12 +125,40 @@ def run_migrations_online() -> None:
         prefix="sqlalchemy.",
         poolclass=pool.NullPool,
     )
+    is_sqlite = connectable.dialect.name == 'sqlite'
+    if DRY_RUN and is_sqlite:
+        make_sqlite_transactional(connectable)
 
     with connectable.connect() as connection:
+        # started before configure, so alembic sees an outer transaction and commits nothing
+        transaction = connection.begin() if DRY_RUN else None
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection, target_metadata=target_metadata,
+            include_object=include_object,
+            # every revision commits on its own, so a long one (see migration_helpers.py) does
+            # not keep the ones before it open, and an autocommit block only commits its own
+            transaction_per_migration=True,
+            # SQLite cannot ALTER most things, autogenerate writes batch_alter_table (copy the
+            # table) for it
+            render_as_batch=is_sqlite,
+            on_version_apply=log_revision_time,
+            dry_run=DRY_RUN,
+            revision_started=[time.perf_counter()],
         )
 
+        if DRY_RUN:
+            try:
+                context.run_migrations()
+            except Exception:
+                # e.g. a NOT NULL on a column which a backfill would have filled, backfills only
+                # sample in a dry run. Everything up to here was timed.
+                logger.error('dry run: stopped, a later step needs data the dry run did not write')
+                raise
+            finally:
+                transaction.rollback()
+                logger.info('dry run: everything rolled back')
+            return
+
         with context.begin_transaction():
             context.run_migrations()
 
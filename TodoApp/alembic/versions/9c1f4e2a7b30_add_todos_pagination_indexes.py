@@ -0,0 +1,30 @@
+"""Add todos pagination indexes
+
+Revision ID: 9c1f4e2a7b30
+Revises: 5b40c5f738a3
+Create Date: 2026-10-18 10:12:31.402115
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c1f4e2a7b30'
+down_revision: Union[str, None] = '5b40c5f738a3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_todos_owner_id_id', 'todos', ['owner_id', 'id'])
+    op.create_index('ix_todos_owner_id_complete_id', 'todos', ['owner_id', 'complete', 'id'])
+    op.create_index('ix_todos_owner_id_priority_id', 'todos', ['owner_id', 'priority', 'id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_todos_owner_id_priority_id', table_name='todos')
+    op.drop_index('ix_todos_owner_id_complete_id', table_name='todos')
+    op.drop_index('ix_todos_owner_id_id', table_name='todos')
@@ -0,0 +1,137 @@
+"""Add todo versions, tombstones and sync triggers
+
+Revision ID: a7d2f9c4e813
+Revises: f3c9a1b7d2e4
+Create Date: 2026-10-18 20:05:31.402916
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from migration_helpers import backfill, create_index_online, drop_backfill_progress
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7d2f9c4e813'
+down_revision: Union[str, None] = 'f3c9a1b7d2e4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # nullable and without a default, so adding them does not rewrite todos
+    op.add_column('todos', sa.Column('version', sa.Integer(), nullable=True))
+    op.add_column('todos', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.create_table(
+        'todo_tombstones',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('owner_id', sa.Integer(), nullable=True),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('deleted_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_todo_tombstones_owner_id_version', 'todo_tombstones',
+                    ['owner_id', 'version'])
+    op.create_table(
+        'todo_sync_version',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('value', sa.Integer(), nullable=False),
+        sa.Column('pruned', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    # the rows which are there get their id as version (backfill below), so the counter
+    # starts after the highest id
+    op.execute("INSERT INTO todo_sync_version (id, value, pruned) "
+               "SELECT 1, coalesce(max(id), 0), 0 FROM todos")
+
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("CREATE TRIGGER todo_sync_ai AFTER INSERT ON todos BEGIN "
+                   "UPDATE todo_sync_version SET value = value + 1 WHERE id = 1; "
+                   "UPDATE todos SET version = (SELECT value FROM todo_sync_version WHERE id = 1), "
+                   "updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE id = new.id; "
+                   "DELETE FROM todo_tombstones WHERE id = new.id; END")
+        op.execute("CREATE TRIGGER todo_sync_au AFTER UPDATE OF title, description, priority, "
+                   "complete, owner_id ON todos WHEN old.title IS NOT new.title "
+                   "OR old.description IS NOT new.description OR old.priority IS NOT new.priority "
+                   "OR old.complete IS NOT new.complete OR old.owner_id IS NOT new.owner_id BEGIN "
+                   "UPDATE todo_sync_version SET value = value + 1 WHERE id = 1; "
+                   "UPDATE todos SET version = (SELECT value FROM todo_sync_version WHERE id = 1), "
+                   "updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE id = new.id; "
+                   "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+                   "SELECT old.id, old.owner_id, value, strftime('%Y-%m-%d %H:%M:%f', 'now') "
+                   "FROM todo_sync_version WHERE id = 1 AND old.owner_id IS NOT new.owner_id "
+                   "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, "
+                   "version = excluded.version, deleted_at = excluded.deleted_at; END")
+        op.execute("CREATE TRIGGER todo_sync_ad AFTER DELETE ON todos BEGIN "
+                   "UPDATE todo_sync_version SET value = value + 1 WHERE id = 1; "
+                   "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+                   "SELECT old.id, old.owner_id, value, strftime('%Y-%m-%d %H:%M:%f', 'now') "
+                   "FROM todo_sync_version WHERE id = 1 "
+                   "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, "
+                   "version = excluded.version, deleted_at = excluded.deleted_at; END")
+    elif dialect == 'postgresql':
+        op.execute("CREATE OR REPLACE FUNCTION todo_sync_stamp() RETURNS trigger AS $$ BEGIN "
+                   "UPDATE todo_sync_version SET value = value + 1 WHERE id = 1 "
+                   "RETURNING value INTO NEW.version; "
+                   "NEW.updated_at := now() AT TIME ZONE 'utc'; "
+                   "IF TG_OP = 'INSERT' THEN "
+                   "DELETE FROM todo_tombstones WHERE id = NEW.id; "
+                   "ELSIF OLD.owner_id IS DISTINCT FROM NEW.owner_id THEN "
+                   "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+                   "VALUES (OLD.id, OLD.owner_id, NEW.version, NEW.updated_at) "
+                   "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, "
+                   "version = excluded.version, deleted_at = excluded.deleted_at; "
+                   "END IF; "
+                   "RETURN NEW; END $$ LANGUAGE plpgsql")
+        op.execute("CREATE OR REPLACE FUNCTION todo_sync_tombstone() RETURNS trigger AS $$ "
+                   "DECLARE next_version integer; BEGIN "
+                   "UPDATE todo_sync_version SET value = value + 1 WHERE id = 1 "
+                   "RETURNING value INTO next_version; "
+                   "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+                   "VALUES (OLD.id, OLD.owner_id, next_version, now() AT TIME ZONE 'utc') "
+                   "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, "
+                   "version = excluded.version, deleted_at = excluded.deleted_at; "
+                   "RETURN NULL; END $$ LANGUAGE plpgsql")
+        op.execute("CREATE TRIGGER todo_sync_insert BEFORE INSERT ON todos "
+                   "FOR EACH ROW EXECUTE FUNCTION todo_sync_stamp()")
+        op.execute("CREATE TRIGGER todo_sync_update BEFORE UPDATE OF title, description, "
+                   "priority, complete, owner_id ON todos FOR EACH ROW WHEN ("
+                   "OLD.title IS DISTINCT FROM NEW.title "
+                   "OR OLD.description IS DISTINCT FROM NEW.description "
+                   "OR OLD.priority IS DISTINCT FROM NEW.priority "
+                   "OR OLD.complete IS DISTINCT FROM NEW.complete "
+                   "OR OLD.owner_id IS DISTINCT FROM NEW.owner_id) "
+                   "EXECUTE FUNCTION todo_sync_stamp()")
+        op.execute("CREATE TRIGGER todo_sync_delete AFTER DELETE ON todos "
+                   "FOR EACH ROW EXECUTE FUNCTION todo_sync_tombstone()")
+
+    # the todos from before: version = id, in batches (rows written since the triggers came
+    # have a version already and are skipped)
+    backfill('todos', {'version': 'id', 'updated_at': 'CURRENT_TIMESTAMP'},
+             where='version IS NULL')
+    create_index_online('ix_todos_owner_id_version', 'todos', ['owner_id', 'version'])
+
+
+def downgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('DROP TRIGGER IF EXISTS todo_sync_ad')
+        op.execute('DROP TRIGGER IF EXISTS todo_sync_au')
+        op.execute('DROP TRIGGER IF EXISTS todo_sync_ai')
+    elif dialect == 'postgresql':
+        op.execute('DROP TRIGGER IF EXISTS todo_sync_delete ON todos')
+        op.execute('DROP TRIGGER IF EXISTS todo_sync_update ON todos')
+        op.execute('DROP TRIGGER IF EXISTS todo_sync_insert ON todos')
+        op.execute('DROP FUNCTION IF EXISTS todo_sync_tombstone()')
+        op.execute('DROP FUNCTION IF EXISTS todo_sync_stamp()')
+    op.drop_index('ix_todos_owner_id_version', table_name='todos')
+    op.drop_table('todo_sync_version')
+    op.drop_index('ix_todo_tombstones_owner_id_version', table_name='todo_tombstones')
+    op.drop_table('todo_tombstones')
+    op.drop_column('todos', 'updated_at')
+    op.drop_column('todos', 'version')
+    # made by the first backfill, the one in upgrade() above
+    drop_backfill_progress()
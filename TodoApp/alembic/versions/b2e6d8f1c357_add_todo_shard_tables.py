@@ -0,0 +1,41 @@
+"""Add todo_shard_owners and todo_id_blocks tables
+
+Revision ID: b2e6d8f1c357
+Revises: a7d2f9c4e813
+Create Date: 2026-10-18 21:32:08.551903
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b2e6d8f1c357'
+down_revision: Union[str, None] = 'a7d2f9c4e813'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # both only matter with DATABASE_SHARD_URLS, the id blocks row is written by the app when
+    # it first starts with shards (sharding.ensure_id_blocks)
+    op.create_table(
+        'todo_shard_owners',
+        sa.Column('owner_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('shard', sa.String(length=64), nullable=False),
+        sa.Column('moving', sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint('owner_id'),
+    )
+    op.create_table(
+        'todo_id_blocks',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('next_block', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('todo_id_blocks')
+    op.drop_table('todo_shard_owners')
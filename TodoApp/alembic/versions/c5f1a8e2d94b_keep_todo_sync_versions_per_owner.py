@@ -0,0 +1,182 @@
+"""Keep the todo sync versions per owner
+
+Revision ID: c5f1a8e2d94b
+Revises: b2e6d8f1c357
+Create Date: 2026-10-18 23:10:42.718305
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c5f1a8e2d94b'
+down_revision: Union[str, None] = 'b2e6d8f1c357'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # the single row counter of todo_sync_version made every todo write wait for the one
+    # before it to commit, now every owner has a counter of their own (owner_id 0: no owner)
+    op.create_table(
+        'todo_sync_versions',
+        sa.Column('owner_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('value', sa.Integer(), nullable=False),
+        sa.Column('pruned', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('owner_id'),
+    )
+    # the clients may hold any version handed out so far, so every owner starts where the
+    # single counter was
+    op.execute("INSERT INTO todo_sync_versions (owner_id, value, pruned) "
+               "SELECT owners.owner_id, counter.value, counter.pruned FROM "
+               "(SELECT coalesce(owner_id, 0) AS owner_id FROM todos UNION "
+               "SELECT coalesce(owner_id, 0) FROM todo_tombstones) AS owners, "
+               "todo_sync_version AS counter WHERE counter.id = 1")
+
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('DROP TRIGGER IF EXISTS todo_sync_ad')
+        op.execute('DROP TRIGGER IF EXISTS todo_sync_au')
+        op.execute('DROP TRIGGER IF EXISTS todo_sync_ai')
+        op.execute("CREATE TRIGGER todo_sync_ai AFTER INSERT ON todos BEGIN "
+                   "INSERT INTO todo_sync_versions (owner_id, value, pruned) "
+                   "VALUES (coalesce(new.owner_id, 0), 1, 0) "
+                   "ON CONFLICT (owner_id) DO UPDATE SET value = value + 1; "
+                   "UPDATE todos SET version = (SELECT value FROM todo_sync_versions "
+                   "WHERE owner_id = coalesce(new.owner_id, 0)), "
+                   "updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE id = new.id; "
+                   "DELETE FROM todo_tombstones WHERE id = new.id; END")
+        op.execute("CREATE TRIGGER todo_sync_au AFTER UPDATE OF title, description, priority, "
+                   "complete, owner_id ON todos WHEN old.title IS NOT new.title "
+                   "OR old.description IS NOT new.description OR old.priority IS NOT new.priority "
+                   "OR old.complete IS NOT new.complete OR old.owner_id IS NOT new.owner_id BEGIN "
+                   "INSERT INTO todo_sync_versions (owner_id, value, pruned) "
+                   "VALUES (coalesce(new.owner_id, 0), 1, 0) "
+                   "ON CONFLICT (owner_id) DO UPDATE SET value = value + 1; "
+                   "UPDATE todos SET version = (SELECT value FROM todo_sync_versions "
+                   "WHERE owner_id = coalesce(new.owner_id, 0)), "
+                   "updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE id = new.id; "
+                   "INSERT INTO todo_sync_versions (owner_id, value, pruned) "
+                   "SELECT coalesce(old.owner_id, 0), 1, 0 "
+                   "WHERE old.owner_id IS NOT new.owner_id "
+                   "ON CONFLICT (owner_id) DO UPDATE SET value = value + 1; "
+                   "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+                   "SELECT old.id, old.owner_id, value, strftime('%Y-%m-%d %H:%M:%f', 'now') "
+                   "FROM todo_sync_versions WHERE owner_id = coalesce(old.owner_id, 0) "
+                   "AND old.owner_id IS NOT new.owner_id "
+                   "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, "
+                   "version = excluded.version, deleted_at = excluded.deleted_at; END")
+        op.execute("CREATE TRIGGER todo_sync_ad AFTER DELETE ON todos BEGIN "
+                   "INSERT INTO todo_sync_versions (owner_id, value, pruned) "
+                   "SELECT coalesce(old.owner_id, 0), 1, 0 WHERE 1 "
+                   "ON CONFLICT (owner_id) DO UPDATE SET value = value + 1; "
+                   "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+                   "SELECT old.id, old.owner_id, value, strftime('%Y-%m-%d %H:%M:%f', 'now') "
+                   "FROM todo_sync_versions WHERE owner_id = coalesce(old.owner_id, 0) "
+                   "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, "
+                   "version = excluded.version, deleted_at = excluded.deleted_at; END")
+    elif dialect == 'postgresql':
+        # the triggers stay, their functions are replaced
+        op.execute("CREATE OR REPLACE FUNCTION todo_sync_stamp() RETURNS trigger AS $$ "
+                   "DECLARE old_version integer; BEGIN "
+                   "INSERT INTO todo_sync_versions AS counter (owner_id, value, pruned) "
+                   "VALUES (coalesce(NEW.owner_id, 0), 1, 0) "
+                   "ON CONFLICT (owner_id) DO UPDATE SET value = counter.value + 1 "
+                   "RETURNING value INTO NEW.version; "
+                   "NEW.updated_at := now() AT TIME ZONE 'utc'; "
+                   "IF TG_OP = 'INSERT' THEN "
+                   "DELETE FROM todo_tombstones WHERE id = NEW.id; "
+                   "ELSIF OLD.owner_id IS DISTINCT FROM NEW.owner_id THEN "
+                   "INSERT INTO todo_sync_versions AS counter (owner_id, value, pruned) "
+                   "VALUES (coalesce(OLD.owner_id, 0), 1, 0) "
+                   "ON CONFLICT (owner_id) DO UPDATE SET value = counter.value + 1 "
+                   "RETURNING value INTO old_version; "
+                   "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+                   "VALUES (OLD.id, OLD.owner_id, old_version, NEW.updated_at) "
+                   "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, "
+                   "version = excluded.version, deleted_at = excluded.deleted_at; "
+                   "END IF; "
+                   "RETURN NEW; END $$ LANGUAGE plpgsql")
+        op.execute("CREATE OR REPLACE FUNCTION todo_sync_tombstone() RETURNS trigger AS $$ "
+                   "DECLARE next_version integer; BEGIN "
+                   "INSERT INTO todo_sync_versions AS counter (owner_id, value, pruned) "
+                   "VALUES (coalesce(OLD.owner_id, 0), 1, 0) "
+                   "ON CONFLICT (owner_id) DO UPDATE SET value = counter.value + 1 "
+                   "RETURNING value INTO next_version; "
+                   "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+                   "VALUES (OLD.id, OLD.owner_id, next_version, now() AT TIME ZONE 'utc') "
+                   "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, "
+                   "version = excluded.version, deleted_at = excluded.deleted_at; "
+                   "RETURN NULL; END $$ LANGUAGE plpgsql")
+    op.drop_table('todo_sync_version')
+
+
+def downgrade() -> None:
+    op.create_table(
+        'todo_sync_version',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('value', sa.Integer(), nullable=False),
+        sa.Column('pruned', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    # the single counter has to be past every owner's, and pruned up to the furthest one
+    op.execute("INSERT INTO todo_sync_version (id, value, pruned) "
+               "SELECT 1, coalesce(max(value), 0), coalesce(max(pruned), 0) "
+               "FROM todo_sync_versions")
+
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('DROP TRIGGER IF EXISTS todo_sync_ad')
+        op.execute('DROP TRIGGER IF EXISTS todo_sync_au')
+        op.execute('DROP TRIGGER IF EXISTS todo_sync_ai')
+        op.execute("CREATE TRIGGER todo_sync_ai AFTER INSERT ON todos BEGIN "
+                   "UPDATE todo_sync_version SET value = value + 1 WHERE id = 1; "
+                   "UPDATE todos SET version = (SELECT value FROM todo_sync_version WHERE id = 1), "
+                   "updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE id = new.id; "
+                   "DELETE FROM todo_tombstones WHERE id = new.id; END")
+        op.execute("CREATE TRIGGER todo_sync_au AFTER UPDATE OF title, description, priority, "
+                   "complete, owner_id ON todos WHEN old.title IS NOT new.title "
+                   "OR old.description IS NOT new.description OR old.priority IS NOT new.priority "
+                   "OR old.complete IS NOT new.complete OR old.owner_id IS NOT new.owner_id BEGIN "
+                   "UPDATE todo_sync_version SET value = value + 1 WHERE id = 1; "
+                   "UPDATE todos SET version = (SELECT value FROM todo_sync_version WHERE id = 1), "
+                   "updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE id = new.id; "
+                   "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+                   "SELECT old.id, old.owner_id, value, strftime('%Y-%m-%d %H:%M:%f', 'now') "
+                   "FROM todo_sync_version WHERE id = 1 AND old.owner_id IS NOT new.owner_id "
+                   "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, "
+                   "version = excluded.version, deleted_at = excluded.deleted_at; END")
+        op.execute("CREATE TRIGGER todo_sync_ad AFTER DELETE ON todos BEGIN "
+                   "UPDATE todo_sync_version SET value = value + 1 WHERE id = 1; "
+                   "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+                   "SELECT old.id, old.owner_id, value, strftime('%Y-%m-%d %H:%M:%f', 'now') "
+                   "FROM todo_sync_version WHERE id = 1 "
+                   "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, "
+                   "version = excluded.version, deleted_at = excluded.deleted_at; END")
+    elif dialect == 'postgresql':
+        op.execute("CREATE OR REPLACE FUNCTION todo_sync_stamp() RETURNS trigger AS $$ BEGIN "
+                   "UPDATE todo_sync_version SET value = value + 1 WHERE id = 1 "
+                   "RETURNING value INTO NEW.version; "
+                   "NEW.updated_at := now() AT TIME ZONE 'utc'; "
+                   "IF TG_OP = 'INSERT' THEN "
+                   "DELETE FROM todo_tombstones WHERE id = NEW.id; "
+                   "ELSIF OLD.owner_id IS DISTINCT FROM NEW.owner_id THEN "
+                   "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+                   "VALUES (OLD.id, OLD.owner_id, NEW.version, NEW.updated_at) "
+                   "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, "
+                   "version = excluded.version, deleted_at = excluded.deleted_at; "
+                   "END IF; "
+                   "RETURN NEW; END $$ LANGUAGE plpgsql")
+        op.execute("CREATE OR REPLACE FUNCTION todo_sync_tombstone() RETURNS trigger AS $$ "
+                   "DECLARE next_version integer; BEGIN "
+                   "UPDATE todo_sync_version SET value = value + 1 WHERE id = 1 "
+                   "RETURNING value INTO next_version; "
+                   "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+                   "VALUES (OLD.id, OLD.owner_id, next_version, now() AT TIME ZONE 'utc') "
+                   "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, "
+                   "version = excluded.version, deleted_at = excluded.deleted_at; "
+                   "RETURN NULL; END $$ LANGUAGE plpgsql")
+    op.drop_table('todo_sync_versions')
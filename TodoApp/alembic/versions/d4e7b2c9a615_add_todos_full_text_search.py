@@ -0,0 +1,60 @@
+"""Add todos full text search
+
+Revision ID: d4e7b2c9a615
+Revises: 9c1f4e2a7b30
+Create Date: 2026-10-18 14:05:47.218934
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4e7b2c9a615'
+down_revision: Union[str, None] = '9c1f4e2a7b30'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        # FTS5 table holding only the index (the text stays in todos), kept in sync by triggers
+        op.execute("CREATE VIRTUAL TABLE todos_fts USING fts5("
+                   "title, description, content='todos', content_rowid='id', "
+                   "tokenize='unicode61 remove_diacritics 2')")
+        op.execute("CREATE TRIGGER todos_fts_ai AFTER INSERT ON todos BEGIN "
+                   "INSERT INTO todos_fts(rowid, title, description) "
+                   "VALUES (new.id, new.title, new.description); END")
+        op.execute("CREATE TRIGGER todos_fts_ad AFTER DELETE ON todos BEGIN "
+                   "INSERT INTO todos_fts(todos_fts, rowid, title, description) "
+                   "VALUES ('delete', old.id, old.title, old.description); END")
+        op.execute("CREATE TRIGGER todos_fts_au AFTER UPDATE OF title, description ON todos BEGIN "
+                   "INSERT INTO todos_fts(todos_fts, rowid, title, description) "
+                   "VALUES ('delete', old.id, old.title, old.description); "
+                   "INSERT INTO todos_fts(rowid, title, description) "
+                   "VALUES (new.id, new.title, new.description); END")
+        op.execute("INSERT INTO todos_fts(todos_fts) VALUES ('rebuild')")
+    elif dialect == 'postgresql':
+        op.add_column('todos', sa.Column(
+            'search_vector', postgresql.TSVECTOR(),
+            sa.Computed("setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+                        "setweight(to_tsvector('english', coalesce(description, '')), 'B')",
+                        persisted=True)))
+        op.create_index('ix_todos_search_vector', 'todos', ['search_vector'],
+                        postgresql_using='gin')
+
+
+def downgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('DROP TRIGGER IF EXISTS todos_fts_au')
+        op.execute('DROP TRIGGER IF EXISTS todos_fts_ad')
+        op.execute('DROP TRIGGER IF EXISTS todos_fts_ai')
+        op.execute('DROP TABLE IF EXISTS todos_fts')
+    elif dialect == 'postgresql':
+        op.drop_index('ix_todos_search_vector', table_name='todos')
+        op.drop_column('todos', 'search_vector')
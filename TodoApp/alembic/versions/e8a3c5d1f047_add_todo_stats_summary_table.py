@@ -0,0 +1,85 @@
+"""Add todo_stats summary table
+
+Revision ID: e8a3c5d1f047
+Revises: d4e7b2c9a615
+Create Date: 2026-10-18 16:41:09.553102
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e8a3c5d1f047'
+down_revision: Union[str, None] = 'd4e7b2c9a615'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'todo_stats',
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('priority', sa.Integer(), nullable=False),
+        sa.Column('complete', sa.Boolean(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('owner_id', 'priority', 'complete'),
+    )
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("CREATE TRIGGER todo_stats_ai AFTER INSERT ON todos BEGIN "
+                   "INSERT INTO todo_stats (owner_id, priority, complete, count) "
+                   "VALUES (coalesce(new.owner_id, 0), coalesce(new.priority, 0), "
+                   "coalesce(new.complete, 0), 1) "
+                   "ON CONFLICT (owner_id, priority, complete) DO UPDATE SET count = count + 1; END")
+        op.execute("CREATE TRIGGER todo_stats_ad AFTER DELETE ON todos BEGIN "
+                   "UPDATE todo_stats SET count = count - 1 WHERE owner_id = coalesce(old.owner_id, 0) "
+                   "AND priority = coalesce(old.priority, 0) "
+                   "AND complete = coalesce(old.complete, 0); END")
+        op.execute("CREATE TRIGGER todo_stats_au AFTER UPDATE OF owner_id, priority, complete "
+                   "ON todos WHEN old.owner_id IS NOT new.owner_id "
+                   "OR old.priority IS NOT new.priority OR old.complete IS NOT new.complete BEGIN "
+                   "UPDATE todo_stats SET count = count - 1 WHERE owner_id = coalesce(old.owner_id, 0) "
+                   "AND priority = coalesce(old.priority, 0) "
+                   "AND complete = coalesce(old.complete, 0); "
+                   "INSERT INTO todo_stats (owner_id, priority, complete, count) "
+                   "VALUES (coalesce(new.owner_id, 0), coalesce(new.priority, 0), "
+                   "coalesce(new.complete, 0), 1) "
+                   "ON CONFLICT (owner_id, priority, complete) DO UPDATE SET count = count + 1; END")
+    elif dialect == 'postgresql':
+        op.execute("CREATE OR REPLACE FUNCTION todo_stats_apply() RETURNS trigger AS $$ BEGIN "
+                   "IF TG_OP IN ('UPDATE', 'DELETE') THEN "
+                   "UPDATE todo_stats SET count = count - 1 WHERE owner_id = coalesce(OLD.owner_id, 0) "
+                   "AND priority = coalesce(OLD.priority, 0) "
+                   "AND complete = coalesce(OLD.complete, false); "
+                   "END IF; "
+                   "IF TG_OP IN ('INSERT', 'UPDATE') THEN "
+                   "INSERT INTO todo_stats (owner_id, priority, complete, count) "
+                   "VALUES (coalesce(NEW.owner_id, 0), coalesce(NEW.priority, 0), "
+                   "coalesce(NEW.complete, false), 1) "
+                   "ON CONFLICT (owner_id, priority, complete) "
+                   "DO UPDATE SET count = todo_stats.count + 1; "
+                   "END IF; "
+                   "RETURN NULL; END $$ LANGUAGE plpgsql")
+        op.execute("CREATE TRIGGER todo_stats_trigger AFTER INSERT OR DELETE "
+                   "OR UPDATE OF owner_id, priority, complete ON todos "
+                   "FOR EACH ROW EXECUTE FUNCTION todo_stats_apply()")
+    # backfill from the todos which are already there
+    op.execute("INSERT INTO todo_stats (owner_id, priority, complete, count) "
+               "SELECT coalesce(owner_id, 0), coalesce(priority, 0), coalesce(complete, false), "
+               "count(*) FROM todos "
+               "GROUP BY coalesce(owner_id, 0), coalesce(priority, 0), coalesce(complete, false)")
+
+
+def downgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('DROP TRIGGER IF EXISTS todo_stats_au')
+        op.execute('DROP TRIGGER IF EXISTS todo_stats_ad')
+        op.execute('DROP TRIGGER IF EXISTS todo_stats_ai')
+    elif dialect == 'postgresql':
+        op.execute('DROP TRIGGER IF EXISTS todo_stats_trigger ON todos')
+        op.execute('DROP FUNCTION IF EXISTS todo_stats_apply()')
+    op.drop_table('todo_stats')
@@ -0,0 +1,95 @@
+# Cold start benchmark: how long a fresh worker takes from "python starts" to "first request
+# answered". Every run is its own process (that is what a new uvicorn / gunicorn worker is).
+# Run it from the TodoApp folder:
+#
+#   python -m benchmarks.cold_start_benchmark --runs 10
+#   python -m benchmarks.cold_start_benchmark --runs 10 --alembic   # database stamped by alembic
+#
+# It reports the import of main.py, the app's lifespan startup and the first request which
+# needs the database (a failed login) separately.
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+async def first_request(app):
+    import httpx
+
+    timings = {}
+    start = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        timings['startup_ms'] = (time.perf_counter() - start) * 1000
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            start = time.perf_counter()
+            response = await client.post('/auth/token', data={'username': 'nobody',
+                                                              'password': 'wrong'})
+            timings['first_request_ms'] = (time.perf_counter() - start) * 1000
+            assert response.status_code == 401, response.text
+    return timings
+
+
+def worker():
+    start = time.perf_counter()
+    from main import app
+    result = {'import_ms': (time.perf_counter() - start) * 1000}
+    result.update(asyncio.run(first_request(app)))
+    result['total_ms'] = result['import_ms'] + result['startup_ms'] + result['first_request_ms']
+    print(json.dumps(result))
+
+
+def prepare_database(path, alembic):
+    # the schema is created once up front, like a database which is already in use
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{path}')
+    subprocess.run([sys.executable, '-c', 'import models; from database import engine; '
+                    'models.Base.metadata.create_all(bind=engine)'], env=env, check=True)
+    if alembic:
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE TABLE IF NOT EXISTS alembic_version '
+                           '(version_num VARCHAR(32) NOT NULL PRIMARY KEY)')
+        connection.execute("INSERT INTO alembic_version VALUES ('9c1f4e2a7b30')")
+        connection.commit()
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--alembic', action='store_true',
+                        help='stamp the database as managed by alembic')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker()
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        prepare_database(path, args.alembic)
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{path}')
+        results = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.cold_start_benchmark',
+                                     '--worker'], env=env, check=True, capture_output=True,
+                                    text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            result['process_ms'] = (time.perf_counter() - start) * 1000
+            results.append(result)
+
+    for key in ('import_ms', 'startup_ms', 'first_request_ms', 'total_ms', 'process_ms'):
+        values = [result[key] for result in results]
+        print(f'{key:<18} median={statistics.median(values):8.1f}  min={min(values):8.1f}  '
+              f'max={max(values):8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Concurrency benchmark for the database layer: DATABASE_MODE=sync (queries on the threadpool)
+# vs DATABASE_MODE=async (AsyncSession on aiosqlite / asyncpg / aiomysql). Run it from the
+# TodoApp folder:
+#
+#   python -m benchmarks.db_concurrency_benchmark --requests 2000 --concurrency 50
+#
+# Every mode runs in its own process because database.py reads DATABASE_MODE on import.
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def drive(app, token, todo_ids, total, concurrency):
+    import httpx
+
+    latencies = []
+    headers = {'Authorization': f'Bearer {token}'}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(i):
+            async with semaphore:
+                start = time.perf_counter()
+                if i % 2:
+                    response = await client.get('/', params={'limit': 50}, headers=headers)
+                else:
+                    todo_id = todo_ids[i % len(todo_ids)]
+                    response = await client.get(f'/todo/{todo_id}', headers=headers)
+                latencies.append(time.perf_counter() - start)
+                assert response.status_code == 200, response.text
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+    return {
+        'requests_per_second': total / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def worker(args):
+    # env is already set by the parent, so these imports pick the right mode and database
+    import models
+    from database import SessionLocal, engine
+    from main import app
+    from routers.auth import create_access_token
+
+    models.Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    user = models.Users(email='bench@example.com', username='bench', first_name='Bench',
+                        last_name='User', role='user', is_active=True, hashed_password='x')
+    db.add(user)
+    db.commit()
+    db.add_all(models.Todos(title=f'todo {i}', description='benchmark todo', priority=i % 5 + 1,
+                            complete=i % 2 == 0, owner_id=user.id) for i in range(args.todos))
+    db.commit()
+    todo_ids = [todo_id for (todo_id,) in db.query(models.Todos.id).all()]
+    token = create_access_token(user.username, user.id, user.role, timedelta(minutes=20))
+    db.close()
+
+    result = asyncio.run(drive(app, token, todo_ids, args.requests, args.concurrency))
+    result['mode'] = os.environ['DATABASE_MODE']
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--todos', type=int, default=1000)
+    parser.add_argument('--modes', default='sync,async')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    for mode in args.modes.split(','):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, DATABASE_MODE=mode,
+                       DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.db_concurrency_benchmark', '--worker',
+                 '--requests', str(args.requests), '--concurrency', str(args.concurrency),
+                 '--todos', str(args.todos)],
+                env=env, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(' '.join(f'{key}={value:.1f}' if isinstance(value, float) else
+                           f'{key}={value}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
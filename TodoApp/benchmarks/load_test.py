@@ -0,0 +1,304 @@
+# Load test for TodoApp: seeds a fresh SQLite database, then drives a mix of realistic
+# requests (login, todo CRUD, admin listing) at a given concurrency and reports throughput and
+# p50/p95/p99 latency per route. Run it from the TodoApp folder:
+#
+#   python -m benchmarks.load_test --duration 30 --concurrency 50
+#   python -m benchmarks.load_test --server uvicorn --workers 4 --output after.json --compare before.json
+#   python -m benchmarks.load_test --mix list=10,read=10,create=2,login=1
+#
+# --server inprocess runs main.app inside this process through httpx's ASGI transport (no
+# network, good for comparing code changes), --server uvicorn starts a real uvicorn.
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+import httpx
+
+DEFAULT_MIX = 'login=1,list=10,read=10,create=3,update=3,delete=1,admin_list=1'
+PASSWORD = 'load-test-password'
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise SystemExit(f'unknown scenario {name!r}, choose from {", ".join(SCENARIOS)}')
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def seed_database(users: int, todos_per_user: int):
+    # imported here because database.py reads DATABASE_URL when it is imported
+    import models
+    from database import SessionLocal, engine
+    from hashing import bcrypt_context
+    from routers.auth import create_access_token
+
+    models.Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    # hashing once is enough, every load test user has the same password
+    hashed_password = bcrypt_context.hash(PASSWORD)
+    user_models = [models.Users(email=f'load{i}@example.com', username=f'load{i}',
+                                first_name='Load', last_name=str(i), hashed_password=hashed_password,
+                                is_active=True, role='admin' if i == 0 else 'user',
+                                phone_number='0000000000')
+                   for i in range(users)]
+    db.add_all(user_models)
+    db.commit()
+    db.add_all(models.Todos(title=f'todo {i}', description='load test todo', priority=i % 5 + 1,
+                            complete=i % 3 == 0, owner_id=user.id)
+               for user in user_models for i in range(todos_per_user))
+    db.commit()
+    seeded = []
+    for user in user_models:
+        todo_ids = [todo_id for (todo_id,) in
+                    db.query(models.Todos.id).filter(models.Todos.owner_id == user.id)]
+        token = create_access_token(user.username, user.id, user.role, timedelta(hours=2))
+        seeded.append({'username': user.username, 'role': user.role, 'token': token,
+                       'todo_ids': todo_ids})
+    db.close()
+    engine.dispose()
+    return seeded
+
+
+class VirtualUser:
+
+    def __init__(self, seeded: dict):
+        self.username = seeded['username']
+        self.role = seeded['role']
+        self.headers = {'Authorization': f"Bearer {seeded['token']}"}
+        self.todo_ids = list(seeded['todo_ids'])
+
+    def todo_body(self):
+        return {'title': f'load test {random.randint(0, 1_000_000)}', 'description': 'load test todo',
+                'priority': random.randint(1, 5), 'complete': random.random() < 0.5}
+
+
+async def scenario_login(client, user):
+    return await client.post('/auth/token', data={'username': user.username, 'password': PASSWORD})
+
+
+async def scenario_list(client, user):
+    return await client.get('/', headers=user.headers)
+
+
+async def scenario_read(client, user):
+    if not user.todo_ids:
+        return await scenario_list(client, user)
+    return await client.get(f'/todo/{random.choice(user.todo_ids)}', headers=user.headers)
+
+
+async def scenario_create(client, user):
+    return await client.post('/todo', json=user.todo_body(), headers=user.headers)
+
+
+async def scenario_update(client, user):
+    if not user.todo_ids:
+        return await scenario_create(client, user)
+    return await client.put(f'/todo/{random.choice(user.todo_ids)}', json=user.todo_body(),
+                            headers=user.headers)
+
+
+async def scenario_delete(client, user):
+    if len(user.todo_ids) < 2:
+        return await scenario_create(client, user)
+    todo_id = user.todo_ids.pop(random.randrange(len(user.todo_ids)))
+    return await client.delete(f'/todo/{todo_id}', headers=user.headers)
+
+
+async def scenario_admin_list(client, user):
+    return await client.get('/admin/todo', headers=user.headers)
+
+
+SCENARIOS = {
+    'login': scenario_login,
+    'list': scenario_list,
+    'read': scenario_read,
+    'create': scenario_create,
+    'update': scenario_update,
+    'delete': scenario_delete,
+    'admin_list': scenario_admin_list,
+}
+
+
+async def drive(client, users, weights, concurrency, duration, total):
+    names = list(weights)
+    route_weights = [weights[name] for name in names]
+    admins = [user for user in users if user.role == 'admin']
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    deadline = time.perf_counter() + duration if duration else None
+    remaining = [total]
+
+    async def worker(worker_id):
+        rng = random.Random(worker_id)
+        while True:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            if deadline is None:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            name = rng.choices(names, weights=route_weights)[0]
+            user = rng.choice(admins if name == 'admin_list' else users)
+            start = time.perf_counter()
+            try:
+                response = await SCENARIOS[name](client, user)
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            latencies[name].append(time.perf_counter() - start)
+            if not ok:
+                errors[name] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    routes = {}
+    for name in names:
+        values = latencies[name]
+        if not values:
+            continue
+        routes[name] = {
+            'requests': len(values),
+            'errors': errors[name],
+            'requests_per_second': len(values) / elapsed,
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+        }
+    all_values = [value for values in latencies.values() for value in values]
+    return {
+        'elapsed_seconds': elapsed,
+        'total': {
+            'requests': len(all_values),
+            'errors': sum(errors.values()),
+            'requests_per_second': len(all_values) / elapsed,
+            'p50_ms': percentile(all_values, 50) * 1000 if all_values else 0.0,
+            'p95_ms': percentile(all_values, 95) * 1000 if all_values else 0.0,
+            'p99_ms': percentile(all_values, 99) * 1000 if all_values else 0.0,
+        },
+        'routes': routes,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_up(base_url, process, timeout=30):
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.perf_counter() < deadline:
+            if process.poll() is not None:
+                raise SystemExit('uvicorn exited before it was ready')
+            try:
+                await client.get('/docs')
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise SystemExit('uvicorn did not come up in time')
+
+
+async def run(args, seeded):
+    users = [VirtualUser(user) for user in seeded]
+    weights = parse_mix(args.mix)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    if args.server == 'inprocess':
+        from main import app
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://loadtest',
+                                     limits=limits) as client:
+            return await drive(client, users, weights, args.concurrency, args.duration, args.requests)
+
+    port = free_port()
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port),
+                                '--workers', str(args.workers), '--log-level', 'warning'],
+                               env=os.environ.copy())
+    try:
+        base_url = f'http://127.0.0.1:{port}'
+        await wait_until_up(base_url, process)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+            return await drive(client, users, weights, args.concurrency, args.duration, args.requests)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def print_report(result, previous=None):
+    def line(name, stats, old):
+        text = (f"{name:<12} {stats['requests']:>8} {stats['errors']:>6} "
+                f"{stats['requests_per_second']:>10.1f} {stats['p50_ms']:>9.1f} "
+                f"{stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f}")
+        if old:
+            change = (stats['requests_per_second'] / old['requests_per_second'] - 1) * 100 \
+                if old['requests_per_second'] else 0.0
+            text += f"   rps {change:+6.1f}%  p99 {stats['p99_ms'] - old['p99_ms']:+8.1f}ms"
+        return text
+
+    print(f"{'route':<12} {'requests':>8} {'errors':>6} {'req/s':>10} {'p50 ms':>9} "
+          f"{'p95 ms':>9} {'p99 ms':>9}")
+    previous_routes = previous['routes'] if previous else {}
+    for name, stats in result['routes'].items():
+        print(line(name, stats, previous_routes.get(name)))
+    print(line('TOTAL', result['total'], previous['total'] if previous else None))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', choices=('inprocess', 'uvicorn'), default='inprocess')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn workers')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds to run, 0 to run --requests requests instead')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='scenario=weight,...')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--todos-per-user', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the results as JSON here')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp, 'loadtest.db')}"
+        seeded = seed_database(args.users, args.todos_per_user)
+        result = asyncio.run(run(args, seeded))
+
+    result['config'] = {key: value for key, value in vars(args).items()
+                        if key not in ('output', 'compare')}
+    result['environment'] = {key: value for key, value in os.environ.items()
+                             if key.startswith(('DATABASE_', 'DB_', 'SQLITE_', 'PASSWORD_HASH_',
+                                                'TOKEN_CACHE_', 'READ_CACHE_'))
+                             and key != 'DATABASE_URL'}
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+    print_report(result, previous)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
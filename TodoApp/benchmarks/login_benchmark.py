@@ -0,0 +1,124 @@
+# Login throughput benchmark: bcrypt on the event loop ('inline', the old behaviour) vs bcrypt
+# on the password hashing pool. Run it from the TodoApp folder:
+#
+#   python -m benchmarks.login_benchmark --requests 64 --concurrency 16
+#
+# Next to the logins we keep firing a cheap request (an unauthenticated GET /) so we can also
+# see how much the logins slow down everybody else on the same worker.
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import models
+from hashing import bcrypt_context, password_hasher
+from main import app
+from rate_limit import rate_limiter
+import database
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def setup_database(path):
+    engine = create_engine(f'sqlite:///{path}', connect_args={'check_same_thread': False})
+    models.Base.metadata.create_all(bind=engine)
+    session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = session_local()
+    db.add(models.Users(email='bench@example.com', username='bench', first_name='Bench',
+                        last_name='User', role='user', is_active=True,
+                        hashed_password=bcrypt_context.hash('benchpass')))
+    db.commit()
+    db.close()
+
+    def get_db():
+        db = session_local()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[database.get_db] = get_db
+    return engine
+
+
+async def run_mode(mode, total, concurrency):
+    password_hasher.shutdown()
+    password_hasher.executor = mode
+
+    login_latencies = []
+    probe_latencies = []
+    done = asyncio.Event()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def login():
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post('/auth/token',
+                                             data={'username': 'bench', 'password': 'benchpass'})
+                login_latencies.append(time.perf_counter() - start)
+                assert response.status_code == 200, response.text
+
+        async def probe():
+            while not done.is_set():
+                start = time.perf_counter()
+                await client.get('/')
+                probe_latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(0.01)
+
+        probe_task = asyncio.create_task(probe())
+        start = time.perf_counter()
+        await asyncio.gather(*(login() for _ in range(total)))
+        elapsed = time.perf_counter() - start
+        done.set()
+        await probe_task
+
+    return {
+        'mode': mode,
+        'logins_per_second': total / elapsed,
+        'login_p50_ms': percentile(login_latencies, 50) * 1000,
+        'login_p99_ms': percentile(login_latencies, 99) * 1000,
+        'probe_p50_ms': percentile(probe_latencies, 50) * 1000,
+        'probe_p99_ms': percentile(probe_latencies, 99) * 1000,
+        'probe_mean_ms': statistics.mean(probe_latencies) * 1000 if probe_latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--modes', default='inline,thread')
+    args = parser.parse_args()
+
+    password_hasher.max_pending = max(password_hasher.max_pending, args.concurrency)
+    # every login is the same user, the login rate limit would reject nearly all of them
+    rate_limiter.backend = None
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = setup_database(os.path.join(tmp, 'bench.db'))
+        try:
+            for mode in args.modes.split(','):
+                result = asyncio.run(run_mode(mode, args.requests, args.concurrency))
+                print(' '.join(f'{key}={value:.1f}' if isinstance(value, float) else
+                               f'{key}={value}' for key, value in result.items()))
+        finally:
+            password_hasher.shutdown()
+            app.dependency_overrides.clear()
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# Benchmark for migration_helpers.backfill on a large seeded SQLite database: one big UPDATE
+# (what a plain op.execute backfill does) vs the batched backfill, while another connection
+# keeps inserting todos like the running app would. Run it from the TodoApp folder:
+#
+#   python -m benchmarks.migration_benchmark --rows 1000000 --batch-size 5000
+#
+# It reports how long each took, how long the writer was blocked at most, and checks the
+# dry run estimate and that an interrupted backfill resumes where it stopped.
+import argparse
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import sqlalchemy as sa
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+
+import migration_helpers
+
+
+def seed(path, rows):
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE todos (id INTEGER PRIMARY KEY, title VARCHAR, '
+                       'description VARCHAR, priority INTEGER, complete BOOLEAN, owner_id INTEGER, '
+                       'title_lower VARCHAR)')
+    batch = 50000
+    for start in range(0, rows, batch):
+        connection.executemany(
+            'INSERT INTO todos (title, description, priority, complete, owner_id) '
+            'VALUES (?, ?, ?, ?, ?)',
+            ((f'Todo Number {i}', 'seeded for the migration benchmark', i % 5 + 1, i % 2,
+              i % 1000 + 1) for i in range(start, min(rows, start + batch))))
+    connection.commit()
+    connection.close()
+
+
+class Writer(threading.Thread):
+    # inserts a todo every few milliseconds and remembers the slowest insert
+
+    def __init__(self, path):
+        super().__init__(daemon=True)
+        self.path = path
+        self.stop = threading.Event()
+        self.max_wait = 0.0
+        self.inserts = 0
+
+    def run(self):
+        connection = sqlite3.connect(self.path, timeout=600)
+        while not self.stop.is_set():
+            start = time.perf_counter()
+            connection.execute("INSERT INTO todos (title, description, priority, complete, "
+                               "owner_id) VALUES ('Live Todo', 'from the app', 1, 0, 1)")
+            connection.commit()
+            self.max_wait = max(self.max_wait, time.perf_counter() - start)
+            self.inserts += 1
+            time.sleep(0.005)
+        connection.close()
+
+
+def reset(path):
+    connection = sqlite3.connect(path)
+    connection.execute('UPDATE todos SET title_lower = NULL')
+    connection.commit()
+    connection.close()
+
+
+def with_writer(path, fn):
+    writer = Writer(path)
+    writer.start()
+    time.sleep(0.2)
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    writer.stop.set()
+    writer.join()
+    return elapsed, writer
+
+
+def run_helper(engine, dry_run=False, **kw):
+    with engine.connect() as connection:
+        context = MigrationContext.configure(connection, opts={'dry_run': dry_run})
+        with Operations.context(context):
+            with context.begin_transaction():
+                migration_helpers.backfill('todos', {'title_lower': 'lower(title)'},
+                                           where='title_lower IS NULL', **kw)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'migration.db')
+        seed(path, args.rows)
+        engine = sa.create_engine(f'sqlite:///{path}', connect_args={'timeout': 600})
+
+        def one_statement():
+            with engine.begin() as connection:
+                connection.execute(sa.text('UPDATE todos SET title_lower = lower(title) '
+                                           'WHERE title_lower IS NULL'))
+
+        elapsed, writer = with_writer(path, one_statement)
+        print(f'single UPDATE     {elapsed:7.2f}s  writer max wait {writer.max_wait * 1000:8.1f} ms '
+              f'({writer.inserts} inserts)')
+
+        reset(path)
+        logger = logging.getLogger('alembic.helpers')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logger.addHandler(handler)
+        run_helper(engine, dry_run=True, batch_size=args.batch_size)
+        print(messages[-1])
+
+        elapsed, writer = with_writer(
+            path, lambda: run_helper(engine, batch_size=args.batch_size))
+        print(f'batched backfill  {elapsed:7.2f}s  writer max wait {writer.max_wait * 1000:8.1f} ms '
+              f'({writer.inserts} inserts)')
+
+        # resume: stop a run after a few batches, the next run carries on from there
+        reset(path)
+        original = migration_helpers.next_batch_end
+        calls = [0]
+
+        def failing_next_batch_end(*a):
+            calls[0] += 1
+            if calls[0] > 3:
+                raise RuntimeError('interrupted')
+            return original(*a)
+
+        migration_helpers.next_batch_end = failing_next_batch_end
+        try:
+            run_helper(engine, batch_size=args.batch_size)
+        except RuntimeError:
+            pass
+        migration_helpers.next_batch_end = original
+        run_helper(engine, batch_size=args.batch_size)
+        print([message for message in messages if 'resuming' in message][-1])
+        with engine.connect() as connection:
+            missing = connection.execute(sa.text(
+                'SELECT count(*) FROM todos WHERE title_lower IS NULL')).scalar()
+        print(f'rows left without title_lower after resume: {missing}')
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# Several workers (serve.py) with each state backend: are the rate limits and revoked tokens
+# the same on every worker, and how does the throughput grow with the number of workers.
+# Run it from the TodoApp folder:
+#
+#   python -m benchmarks.multiworker_benchmark --workers 1,2,4 --states memory,sqlite,redis
+#
+# Every check request goes over a new connection, so the kernel spreads them over the workers.
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.login_benchmark import percentile
+
+TODOAPP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(state: str, workers: int, tmp: str):
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{tmp}/bench.db',
+               STATE_SQLITE_PATH=f'{tmp}/state.db', METRICS_ENABLED='false')
+    process = subprocess.Popen([sys.executable, 'serve.py', '--workers', str(workers),
+                                '--state', state, '--port', str(port)],
+                               cwd=TODOAPP_DIR, env=env, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            if httpx.get(url + '/openapi.json').status_code == 200:
+                # every worker has to be up, not only the first one
+                time.sleep(0.5 + 0.3 * workers)
+                return process, url
+        except httpx.TransportError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'serve.py --state {state} --workers {workers} did not come up')
+
+
+async def fresh(method: str, url: str, **kwargs):
+    # a client per request: one connection, one (random) worker
+    async with httpx.AsyncClient() as client:
+        return await client.request(method, url, **kwargs)
+
+
+async def login(url: str, username: str, password: str):
+    response = await fresh('POST', url + '/auth/token',
+                           data={'username': username, 'password': password})
+    return response
+
+
+async def check_consistency(url: str) -> dict:
+    for username in ('bench', 'victim'):
+        await fresh('POST', url + '/auth/', json={
+            'username': username, 'email': f'{username}@example.com', 'first_name': 'Bench',
+            'last_name': 'User', 'password': 'benchpass', 'role': 'user', 'phone_number': '1'})
+    # 12 wrong passwords for one username, the limit is 5 per minute for the whole app
+    statuses = [(await login(url, 'victim', 'wrong')).status_code for _ in range(12)]
+    # a logged out token has to be rejected by every worker
+    tokens = (await login(url, 'bench', 'benchpass')).json()
+    headers = {'Authorization': 'Bearer ' + tokens['access_token']}
+    for _ in range(8):
+        # let every worker cache the token first
+        await fresh('GET', url + '/user/', headers=headers)
+    await fresh('POST', url + '/auth/logout', headers=headers)
+    after_logout = [(await fresh('GET', url + '/user/', headers=headers)).status_code
+                    for _ in range(20)]
+    return {
+        'wrong_logins_let_through': statuses.count(401),
+        'requests_after_logout_ok': after_logout.count(200),
+    }
+
+
+async def measure_throughput(url: str, seconds: float, concurrency: int) -> dict:
+    tokens = (await login(url, 'bench', 'benchpass')).json()
+    headers = {'Authorization': 'Bearer ' + tokens['access_token']}
+    latencies = []
+    deadline = time.perf_counter() + seconds
+
+    async def client_loop():
+        async with httpx.AsyncClient(base_url=url, headers=headers) as client:
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                response = await client.get('/user/')
+                assert response.status_code == 200, response.text
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        'requests_per_second': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default=','.join(
+        str(count) for count in sorted({1, 2, os.cpu_count() or 1})))
+    parser.add_argument('--states', default='memory,shared-memory,sqlite,redis')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--concurrency', type=int, default=32)
+    args = parser.parse_args()
+
+    print(f'{os.cpu_count()} cpu(s)')
+    for state in args.states.split(','):
+        for workers in (int(count) for count in args.workers.split(',')):
+            with tempfile.TemporaryDirectory() as tmp:
+                process, url = start_server(state, workers, tmp)
+                try:
+                    result = {'state': state, 'workers': workers}
+                    result.update(asyncio.run(check_consistency(url)))
+                    result.update(asyncio.run(
+                        measure_throughput(url, args.seconds, args.concurrency)))
+                finally:
+                    process.terminate()
+                    process.wait(timeout=30)
+            print(' '.join(f'{key}={value:.1f}' if isinstance(value, float) else
+                           f'{key}={value}' for key, value in result.items()), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# Getting a new access token: logging in again with the password (bcrypt) vs POST /auth/refresh,
+# and GET /user with and without the user row cache. Run it from the TodoApp folder:
+#
+#   python -m benchmarks.refresh_benchmark --requests 50
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.login_benchmark import percentile, setup_database
+from hashing import password_hasher
+from main import app
+from metrics import instrument_engine, sql_statements
+from rate_limit import rate_limiter
+from user_cache import user_cache
+
+
+def sql_count() -> float:
+    return sum(sql_statements._values.values())
+
+
+async def timed(label, total, request):
+    latencies = []
+    statements = sql_count()
+    for _ in range(total):
+        start = time.perf_counter()
+        await request()
+        latencies.append(time.perf_counter() - start)
+    return {
+        'case': label,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'sql_per_request': (sql_count() - statements) / total,
+    }
+
+
+async def run_cases(total):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        async def login():
+            response = await client.post('/auth/token',
+                                         data={'username': 'bench', 'password': 'benchpass'})
+            assert response.status_code == 200, response.text
+            return response.json()
+
+        tokens = await login()
+
+        async def refresh():
+            response = await client.post('/auth/refresh',
+                                         json={'refresh_token': tokens['refresh_token']})
+            assert response.status_code == 200, response.text
+            tokens.update(response.json())
+
+        async def profile():
+            response = await client.get('/user/', headers={
+                'Authorization': 'Bearer ' + tokens['access_token']})
+            assert response.status_code == 200, response.text
+
+        results = [await timed('login', total, login), await timed('refresh', total, refresh)]
+        user_cache.enabled = False
+        results.append(await timed('get_user_uncached', total, profile))
+        user_cache.enabled = True
+        results.append(await timed('get_user_cached', total, profile))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    # every login is the same user, the login rate limit would reject nearly all of them
+    rate_limiter.backend = None
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = setup_database(os.path.join(tmp, 'bench.db'))
+        instrument_engine(engine)  # so the statements of each case can be counted
+        try:
+            for result in asyncio.run(run_cases(args.requests)):
+                print(' '.join(f'{key}={value:.2f}' if isinstance(value, float) else
+                               f'{key}={value}' for key, value in result.items()))
+        finally:
+            password_hasher.shutdown()
+            app.dependency_overrides.clear()
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
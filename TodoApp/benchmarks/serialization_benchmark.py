@@ -0,0 +1,86 @@
+# Serialization throughput for a list of todos: the old path (full ORM objects through
+# jsonable_encoder + json) vs the current one (projected rows, response model, orjson).
+# Run it from the TodoApp folder:
+#
+#   python -m benchmarks.serialization_benchmark --rows 10000
+import argparse
+import json
+import time
+from typing import List
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import models
+from models import Todos
+from responses import dumps, orjson
+from routers.todos import TODO_COLUMNS, TodoResponse, serialize_todos
+
+
+def timed(name, fn, repeat, rows):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f'{name:<44} {elapsed * 1000:8.1f}ms per list  {rows / elapsed:12.0f} rows/s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False},
+                           poolclass=StaticPool)
+    models.Base.metadata.create_all(bind=engine)
+    session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = session_local()
+    db.add_all(Todos(title=f'todo number {i}', description='a benchmark todo',
+                     priority=i % 5 + 1, complete=i % 2 == 0, owner_id=1)
+               for i in range(args.rows))
+    db.commit()
+    db.close()
+
+    adapter = TypeAdapter(List[TodoResponse])
+    print(f'{args.rows} rows, orjson {"installed" if orjson is not None else "NOT installed"}')
+
+    def old_path():
+        # what GET / did before: ORM objects, then FastAPI's generic encoder
+        session = session_local()
+        json.dumps(jsonable_encoder(session.query(Todos).all()))
+        session.close()
+
+    def response_model_path():
+        # projected rows validated into the response model, pydantic-core writes the JSON
+        session = session_local()
+        adapter.dump_json(adapter.validate_python(session.query(*TODO_COLUMNS).all(),
+                                                  from_attributes=True))
+        session.close()
+
+    def response_model_orjson_path():
+        # what ORJSONResponse does for admin.read_all: response model to python, orjson writes
+        session = session_local()
+        dumps(adapter.dump_python(adapter.validate_python(session.query(*TODO_COLUMNS).all(),
+                                                          from_attributes=True)))
+        session.close()
+
+    def projected_orjson_path():
+        # what GET / does now on a cache miss
+        session = session_local()
+        serialize_todos(session.query(*TODO_COLUMNS).all())
+        session.close()
+
+    timed('ORM objects + jsonable_encoder + json', old_path, args.repeat, args.rows)
+    timed('projected rows + response model (dump_json)', response_model_path, args.repeat, args.rows)
+    timed('projected rows + response model + orjson', response_model_orjson_path, args.repeat,
+          args.rows)
+    timed('projected rows + orjson', projected_orjson_path, args.repeat, args.rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# Write throughput of one SQLite database vs the same writes spread over N SQLite shards by
+# owner (sharding.py): many owners creating todos at the same time, one commit per todo like
+# POST /todo, with all the todos triggers (stats, sync, search). Run it from the TodoApp folder:
+#
+#   python -m benchmarks.shard_benchmark --shards 4 --owners 32 --todos 200
+#   SQLITE_SYNCHRONOUS=FULL python -m benchmarks.shard_benchmark   # an fsync per commit
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import models
+from benchmarks.login_benchmark import percentile
+from database import configure_connection_events, engine_options
+from main import prepare_todo_tables
+from models import Todos
+from routers.todos import add_todo
+from sharding import HashRing
+
+
+def write_todos(session_local, owner_id: int, count: int) -> list:
+    latencies = []
+    for number in range(count):
+        db = session_local()
+        start = time.perf_counter()
+        add_todo(db, Todos(title=f'todo {number}', description='benchmark todo', priority=1,
+                           complete=False, owner_id=owner_id))
+        latencies.append(time.perf_counter() - start)
+        db.close()
+    return latencies
+
+
+def run_case(tmp: str, shards: int, owners: int, todos: int, threads: int) -> dict:
+    session_locals, engines = {}, []
+    for number in range(shards):
+        url = f'sqlite:///{os.path.join(tmp, f"shards{shards}_{number}.db")}'
+        engine = create_engine(url, **engine_options(url))
+        configure_connection_events(engine)
+        models.Base.metadata.create_all(bind=engine)
+        prepare_todo_tables(engine)
+        engines.append(engine)
+        session_locals[f'shard_{number}'] = sessionmaker(autocommit=False, autoflush=False,
+                                                         bind=engine)
+    ring = HashRing(session_locals)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        futures = [pool.submit(write_todos, session_locals[ring.lookup(owner_id)], owner_id,
+                               todos) for owner_id in range(1, owners + 1)]
+        latencies = [latency for future in futures for latency in future.result()]
+    elapsed = time.perf_counter() - start
+    for engine in engines:
+        engine.dispose()
+    return {
+        'shards': shards,
+        'writes_per_second': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--owners', type=int, default=32)
+    parser.add_argument('--todos', type=int, default=200, help='todos per owner')
+    parser.add_argument('--threads', type=int, default=16, help='writers at the same time')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for shards in sorted({1, args.shards}):
+            result = run_case(tmp, shards, args.owners, args.todos, args.threads)
+            print(' '.join(f'{key}={value:.2f}' if isinstance(value, float) else
+                           f'{key}={value}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# Many idle GET /todo/events streams on one worker: how much memory they take, and how long a
+# write takes to reach all of them. Run it from the TodoApp folder (it needs a file descriptor
+# per connection on both sides, see `ulimit -n`):
+#
+#   python -m benchmarks.sse_benchmark --connections 10000
+import argparse
+import asyncio
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.login_benchmark import percentile
+from benchmarks.multiworker_benchmark import start_server
+
+
+def rss_mb(pid: int) -> float:
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def open_stream(port: int, token: str):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET /todo/events HTTP/1.1\r\nHost: bench\r\nAccept: text/event-stream\r\n'
+                 f'Authorization: Bearer {token}\r\n\r\n'.encode())
+    await writer.drain()
+    # the headers and the first 'retry:' line, then the stream is idle
+    await reader.readuntil(b'retry:')
+    return reader, writer
+
+
+async def wait_for_event(reader, started: float) -> float:
+    await reader.readuntil(b'event: created')
+    return time.perf_counter() - started
+
+
+async def run(port: int, pid: int, connections: int, batch: int):
+    url = f'http://127.0.0.1:{port}'
+    async with httpx.AsyncClient(base_url=url) as client:
+        await client.post('/auth/', json={
+            'username': 'bench', 'email': 'bench@example.com', 'first_name': 'Bench',
+            'last_name': 'User', 'password': 'benchpass', 'role': 'user', 'phone_number': '1'})
+        token = (await client.post('/auth/token', data={'username': 'bench',
+                                                        'password': 'benchpass'})).json()
+        token = token['access_token']
+
+        # warm up (imports, first requests) before the baseline
+        streams = [await open_stream(port, token)]
+        baseline = rss_mb(pid)
+        started = time.perf_counter()
+        while len(streams) < connections:
+            count = min(batch, connections - len(streams))
+            streams += await asyncio.gather(*(open_stream(port, token) for _ in range(count)))
+        opened = time.perf_counter() - started
+        await asyncio.sleep(2)
+        idle = rss_mb(pid)
+
+        started = time.perf_counter()
+        waiters = [asyncio.create_task(wait_for_event(reader, started))
+                   for reader, _ in streams]
+        response = await client.post('/todo', headers={'Authorization': 'Bearer ' + token},
+                                     json={'title': 'fan out', 'description': 'to every stream',
+                                           'priority': 1, 'complete': False})
+        assert response.status_code == 201, response.text
+        latencies = await asyncio.gather(*waiters)
+        still_up = (await client.get('/openapi.json')).status_code == 200
+        for _, writer in streams:
+            writer.close()
+    return {
+        'connections': len(streams),
+        'open_seconds': opened,
+        'rss_baseline_mb': baseline,
+        'rss_idle_mb': idle,
+        'kb_per_connection': (idle - baseline) * 1024 / max(1, len(streams) - 1),
+        'fanout_p50_ms': percentile(latencies, 50) * 1000,
+        'fanout_max_ms': max(latencies) * 1000,
+        'server_ok': still_up,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=10000)
+    parser.add_argument('--batch', type=int, default=500, help='connections opened at once')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # one worker, so every stream (and the write) is on the process we measure
+        process, url = start_server('memory', 1, tmp)
+        try:
+            port = int(url.rsplit(':', 1)[1])
+            result = asyncio.run(run(port, process.pid, args.connections, args.batch))
+        finally:
+            process.terminate()
+            process.wait(timeout=60)
+    print(' '.join(f'{key}={value:.2f}' if isinstance(value, float) else
+                   f'{key}={value}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# What a polling client downloads: the whole list (GET /, page by page) on every poll vs the
+# delta sync (GET /todo/changes?since=...), with a few edits between the polls. Run it from the
+# TodoApp folder:
+#
+#   python -m benchmarks.sync_benchmark --todos 1000 --polls 50 --edits-every 10
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.login_benchmark import percentile, setup_database
+from hashing import password_hasher
+from main import app
+from rate_limit import rate_limiter
+from todo_sync import ensure_sync_triggers
+
+
+async def run_cases(todos, polls, edits_every):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        response = await client.post('/auth/token',
+                                     data={'username': 'bench', 'password': 'benchpass'})
+        client.headers['Authorization'] = 'Bearer ' + response.json()['access_token']
+        for start in range(0, todos, 500):
+            response = await client.post('/todo/bulk', json=[
+                {'title': f'todo {i}', 'description': 'benchmark todo', 'priority': 1 + i % 5,
+                 'complete': False} for i in range(start, min(todos, start + 500))])
+            assert response.status_code == 200, response.text
+        ids = [item['id'] for item in (await client.get('/todo/changes',
+                                                        params={'limit': 1000})).json()['changes']]
+
+        async def edit(poll):
+            await client.put(f'/todo/{ids[poll % len(ids)]}', json={
+                'title': f'edited {poll}', 'description': 'benchmark todo', 'priority': 1,
+                'complete': True})
+
+        async def full_list():
+            size, cursor = 0, None
+            while True:
+                params = {'limit': 1000}
+                if cursor is not None:
+                    params['cursor'] = cursor
+                response = await client.get('/', params=params)
+                size += len(response.content)
+                cursor = response.headers.get('X-Next-Cursor')
+                if cursor is None:
+                    return size
+
+        version = 0
+
+        async def changes():
+            nonlocal version
+            size = 0
+            while True:
+                response = await client.get('/todo/changes', params={'since': version})
+                size += len(response.content)
+                body = response.json()
+                version = body['version']
+                if not body['has_more']:
+                    return size
+
+        results = []
+        # the sync client starts with everything once, like the polling one does every time
+        await changes()
+        for label, poll in (('full_list', full_list), ('changes', changes)):
+            latencies, sizes = [], []
+            for number in range(polls):
+                if number % edits_every == 0:
+                    await edit(number)
+                start = time.perf_counter()
+                sizes.append(await poll())
+                latencies.append(time.perf_counter() - start)
+            results.append({
+                'case': label,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'kb_per_poll': sum(sizes) / len(sizes) / 1024,
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--todos', type=int, default=1000)
+    parser.add_argument('--polls', type=int, default=50)
+    parser.add_argument('--edits-every', type=int, default=10)
+    args = parser.parse_args()
+
+    rate_limiter.backend = None
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = setup_database(os.path.join(tmp, 'bench.db'))
+        ensure_sync_triggers(engine)
+        try:
+            for result in asyncio.run(run_cases(args.todos, args.polls, args.edits_every)):
+                print(' '.join(f'{key}={value:.2f}' if isinstance(value, float) else
+                               f'{key}={value}' for key, value in result.items()))
+        finally:
+            password_hasher.shutdown()
+            app.dependency_overrides.clear()
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import os
+import time
+from responses import dumps
+from shared_state import STATE_BACKEND, STATE_REDIS_URL
+
+# Live todo changes for GET /todo/events (server-sent events), so the clients do not have to
+# poll GET / to find out that nothing changed. Every write route publishes an event for the
+# owner after its commit, and every open stream of that owner gets it.
+#
+# Fan-out is in-process: one bounded queue per open stream, the event is formatted once and put
+# into all queues of the owner without waiting. A stream which does not read its events (slow
+# network, stuck client) fills its queue and is evicted -- it gets a last 'evicted' event and is
+# closed, the publisher never waits for it and memory stays bounded. The client reconnects and
+# catches up with GET /todo/changes (todo_sync.py), events are only a hint, not the source of
+# truth.
+#
+# With several workers (serve.py) a stream is held by one worker and the write may land on
+# another, so CHANGE_FEED_BACKEND=redis sends the events through redis pub/sub (one channel,
+# one subscriber connection per worker) and every worker fans out to its own streams. serve.py
+# starts a local stand-in broker when no redis server is given.
+#
+# uvicorn waits for all open connections before it shuts down, and a stream stays open until
+# its token expires. serve.py gives them --graceful-timeout seconds, run by hand it is
+# `uvicorn main:app --timeout-graceful-shutdown 10`.
+
+CHANGE_FEED_BACKEND = os.getenv('CHANGE_FEED_BACKEND',
+                                'redis' if STATE_BACKEND == 'redis' else 'memory')
+CHANGE_FEED_URL = os.getenv('CHANGE_FEED_URL', STATE_REDIS_URL)
+CHANGE_FEED_CHANNEL = os.getenv('CHANGE_FEED_CHANNEL', 'todo_events')
+CHANGE_FEED_QUEUE_SIZE = int(os.getenv('CHANGE_FEED_QUEUE_SIZE', 100))  # events per stream
+CHANGE_FEED_KEEPALIVE = float(os.getenv('CHANGE_FEED_KEEPALIVE', 15))  # seconds
+# the client waits that long before it reconnects (EventSource 'retry')
+CHANGE_FEED_RETRY_MS = int(os.getenv('CHANGE_FEED_RETRY_MS', 3000))
+
+logger = logging.getLogger('todoapp.change_feed')
+
+EVICTED = b'event: evicted\ndata: {}\n\n'
+
+
+class Subscription:
+    __slots__ = ('owner_id', 'queue', 'evicted')
+
+    def __init__(self, owner_id: int, queue_size: int):
+        self.owner_id = owner_id
+        self.queue = asyncio.Queue(queue_size)
+        self.evicted = False
+
+
+def format_event(event: str, data: dict) -> bytes:
+    return b'event: ' + event.encode() + b'\ndata: ' + dumps(data) + b'\n\n'
+
+
+class ChangeFeed:
+
+    def __init__(self, backend: str = CHANGE_FEED_BACKEND, url: str = CHANGE_FEED_URL,
+                 queue_size: int = CHANGE_FEED_QUEUE_SIZE):
+        self.backend = backend
+        self.url = url
+        self.queue_size = queue_size
+        self._subscribers = {}  # owner_id -> set of Subscription
+        self._redis = None
+        self._listener = None
+        self.connections = 0
+        self.published = 0
+        self.delivered = 0
+        self.evictions = 0
+
+    def subscribe(self, owner_id: int) -> Subscription:
+        if self.backend == 'redis' and self._listener is None:
+            # the first stream of this worker starts listening to the other workers' events
+            self._listener = asyncio.create_task(self._listen())
+        subscription = Subscription(owner_id, self.queue_size)
+        self._subscribers.setdefault(owner_id, set()).add(subscription)
+        self.connections += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscribers.get(subscription.owner_id)
+        if subscriptions is None or subscription not in subscriptions:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscribers[subscription.owner_id]
+        self.connections -= 1
+
+    def evict(self, subscription: Subscription):
+        self.unsubscribe(subscription)
+        subscription.evicted = True
+        self.evictions += 1
+        # the events it did not read are lost anyway, make room for the last one
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(EVICTED)
+
+    def deliver(self, owner_id: int, message: bytes):
+        for subscription in list(self._subscribers.get(owner_id, ())):
+            try:
+                subscription.queue.put_nowait(message)
+                self.delivered += 1
+            except asyncio.QueueFull:
+                self.evict(subscription)
+
+    async def publish(self, owner_id: int, event: str, data: dict):
+        # event: 'created', 'updated' or 'deleted'. Best effort: a lost event only means the
+        # client sees the change at its next GET /todo/changes
+        if owner_id is None:
+            return
+        message = format_event(event, data)
+        self.published += 1
+        if self.backend != 'redis':
+            self.deliver(owner_id, message)
+            return
+        try:
+            await self._client().publish(CHANGE_FEED_CHANNEL, b'%d ' % owner_id + message)
+        except Exception:
+            logger.warning('could not publish a %s event of owner %s', event, owner_id,
+                           exc_info=True)
+
+    def _client(self):
+        if self._redis is None:
+            import redis.asyncio
+
+            self._redis = redis.asyncio.from_url(self.url)
+        return self._redis
+
+    async def _listen(self):
+        while True:
+            try:
+                pubsub = self._client().pubsub(ignore_subscribe_messages=True)
+                await pubsub.subscribe(CHANGE_FEED_CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    owner_id, payload = message['data'].split(b' ', 1)
+                    self.deliver(int(owner_id), payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # the events published meanwhile are lost, the clients catch up by themselves
+                logger.warning('change feed listener lost its connection, reconnecting',
+                               exc_info=True)
+                await asyncio.sleep(1)
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+    def stats(self) -> dict:
+        return {
+            'backend': self.backend,
+            'connections': self.connections,
+            'owners': len(self._subscribers),
+            'published': self.published,
+            'delivered': self.delivered,
+            'evictions': self.evictions,
+        }
+
+
+async def event_stream(subscription: Subscription, expires_at: float = None):
+    # the body of one GET /todo/events response. A comment line every CHANGE_FEED_KEEPALIVE
+    # seconds keeps proxies from closing an idle stream and finds dead connections. The stream
+    # ends when the access token expires, the client reconnects with a fresh one
+    try:
+        yield b'retry: %d\n\n' % CHANGE_FEED_RETRY_MS
+        while True:
+            wait = CHANGE_FEED_KEEPALIVE
+            if expires_at is not None:
+                wait = min(wait, expires_at - time.time())
+                if wait <= 0:
+                    return
+            try:
+                async with asyncio.timeout(wait):
+                    message = await subscription.queue.get()
+            except TimeoutError:
+                yield b': keepalive\n\n'
+                continue
+            yield message
+            if message is EVICTED:
+                return
+    finally:
+        change_feed.unsubscribe(subscription)
+
+
+change_feed = ChangeFeed()
@@ -0,0 +1,106 @@
+import logging
+import os
+import secrets
+import time
+from typing import Annotated
+from fastapi import Depends, HTTPException
+from fastapi.security import OAuth2PasswordBearer
+from jose import jwt, JWTError
+from sqlalchemy.orm import Session
+from starlette import status
+from database import db_session, get_db, recent_writes
+from sharding import shard_map
+from token_cache import token_cache
+from metrics import record_auth
+
+# Every router used to have its own copy of db_dependency / user_dependency (and had to include
+# auth.router again just to get get_current_user). They all live here now, the routers only
+# import them.
+
+logger = logging.getLogger('todoapp.auth')
+
+# JWT needs a secret and an algorithm, so we have to do this
+# on terminal use this -- openssl rand -hex 32, ab isse jo key aayegi uska use krna, and give
+# it to the app as SECRET_KEY (it is never part of the code)
+SECRET_KEY = os.getenv('SECRET_KEY')
+if not SECRET_KEY:
+    # fine for trying the app out: the tokens stop working when it restarts (serve.py makes one
+    # key for all of its workers)
+    SECRET_KEY = secrets.token_hex(32)
+    logger.warning('SECRET_KEY is not set, signing the tokens with a random key')
+ALGORITHM = 'HS256'
+
+# for decoding the JWT
+oauth2_bearer = OAuth2PasswordBearer(tokenUrl='auth/token')
+
+
+# we have to check whether our token is true or fake
+async def get_current_user(token: Annotated[str, Depends(oauth2_bearer)]):
+    # same token seen before (and not expired / revoked) -- skip the decode and signature check
+    cached_user = await token_cache.get(token)
+    if cached_user is not None:
+        return dict(cached_user)
+    try:
+        start = time.perf_counter()
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        finally:
+            record_auth(time.perf_counter() - start)
+        username: str = payload.get('sub')
+        user_id: int = payload.get('id')
+        user_role: str = payload.get('role')
+        if username is None or user_id is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                                detail='Could Not Validate User')
+        user = {'username': username, 'id': user_id, 'user_role': user_role}
+        if await token_cache.is_revoked(token, user):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                                detail='Could Not Validate User')
+        token_cache.put(token, user, payload.get('exp'))
+        return dict(user)
+    except JWTError:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail='Could Not Validate User')
+
+
+db_dependency = Annotated[Session, Depends(get_db)]
+user_dependency = Annotated[dict, Depends(get_current_user)]
+
+
+# For the routes which only read: the session may be on a read replica (see database.py),
+# unless this user wrote something a moment ago and the replicas might not have it yet
+async def get_read_db(user: user_dependency):
+    async with db_session(read_only=not await recent_writes.active(user.get('id'))) as db:
+        yield db
+
+
+read_db_dependency = Annotated[Session, Depends(get_read_db)]
+
+
+# For the todos routes: with shards (sharding.py) the session is on the shard of the user's
+# todos, reads and writes alike; the replicas are only for the main database. While the user's
+# todos are being moved to another shard their writes wait for a moment.
+async def get_todos_db(user: user_dependency):
+    if not shard_map.enabled:
+        async with db_session() as db:
+            yield db
+        return
+    if shard_map.is_moving(user.get('id')):
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail='Your todos are being moved, try again in a moment',
+                            headers={'Retry-After': '5'})
+    async with db_session(bind=shard_map.shard_for(user.get('id')).engine) as db:
+        yield db
+
+
+async def get_todos_read_db(user: user_dependency):
+    if not shard_map.enabled:
+        async with db_session(read_only=not await recent_writes.active(user.get('id'))) as db:
+            yield db
+        return
+    async with db_session(bind=shard_map.shard_for(user.get('id')).engine) as db:
+        yield db
+
+
+todos_db_dependency = Annotated[Session, Depends(get_todos_db)]
+todos_read_db_dependency = Annotated[Session, Depends(get_todos_read_db)]
@@ -0,0 +1,112 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from passlib.context import CryptContext
+
+# bcrypt is slow on purpose (that is what makes it a good password hash), but our routes are
+# 'async def', so calling bcrypt_context.hash / verify directly blocks the whole event loop
+# for every other request. So here we run those calls on a worker pool instead.
+
+# 'thread'  -- bcrypt releases the GIL, so threads already run hashes in parallel (default)
+# 'process' -- separate processes, useful if some other scheme in the context holds the GIL
+# 'inline'  -- old behaviour, hash on the event loop itself (only for benchmarking)
+PASSWORD_HASH_EXECUTOR = os.getenv('PASSWORD_HASH_EXECUTOR', 'thread')
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+# how many hash/verify calls may be waiting or running at the same time, after this we
+# reject the request straight away instead of letting the queue (and latency) grow forever
+PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', 64))
+
+bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+
+
+# these two are module level functions (not lambdas) so that the process pool can pickle them
+def _hash(password: str) -> str:
+    return bcrypt_context.hash(password)
+
+
+def _verify(password: str, hashed_password: str) -> bool:
+    return bcrypt_context.verify(password, hashed_password)
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+
+    def __init__(self, executor: str = PASSWORD_HASH_EXECUTOR,
+                 workers: int = PASSWORD_HASH_WORKERS,
+                 max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        if executor not in ('thread', 'process', 'inline'):
+            raise ValueError(f'Unknown password hash executor: {executor}')
+        self.executor = executor
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self._pool = None
+        self.pending = 0
+        self.max_pending_seen = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+
+    def _get_pool(self):
+        # pool is created on first use, so importing this module does not start any workers
+        if self._pool is None:
+            if self.executor == 'process':
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix='password-hash')
+        return self._pool
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        self.pending += 1
+        self.max_pending_seen = max(self.max_pending_seen, self.pending)
+        start = time.perf_counter()
+        try:
+            if self.executor == 'inline':
+                return fn(*args)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_pool(), fn, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+            self.total_seconds += time.perf_counter() - start
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run(_verify, password, hashed_password)
+
+    @property
+    def queue_depth(self) -> int:
+        # calls which are waiting for a free worker (the rest are being hashed right now)
+        if self.executor == 'inline':
+            return 0
+        return max(0, self.pending - self.workers)
+
+    def stats(self) -> dict:
+        return {
+            'executor': self.executor,
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'pending': self.pending,
+            'queue_depth': self.queue_depth,
+            'max_pending_seen': self.max_pending_seen,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_seconds': self.total_seconds / self.completed if self.completed else 0.0,
+        }
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+password_hasher = PasswordHasher()
@@ -1,25 +1,106 @@
-from fastapi import FastAPI
+import math
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette import status
 import models
-from database import engine
+from change_feed import change_feed
+from database import dispose_engines, engine, prepare_schema, replicas, warm_pool
+from hashing import PasswordHasherBusy, password_hasher
+from rate_limit import RateLimitExceeded
+from responses import ORJSONResponse
+from search import ensure_search_index
+from sharding import drop_owner_foreign_key, ensure_id_blocks, shard_map
+from todo_stats import ensure_stats_triggers
+from todo_sync import ensure_sync_triggers
+from metrics import METRICS_ENABLED, MetricsMiddleware, metrics_allowed, render_metrics
 from routers import auth, todos, admin, users
 
 # using this technique, we have just clean our application for scalability and maintainability
 # we can create multiple python files, each with own distinct functionalities then we will
 # combine them to main.py file
 
-app = FastAPI()
-models.Base.metadata.create_all(bind=engine)
-# This will only run when todos.db does not exist.
-# the above line create everything from our database.py file and models.py file to be created
-# a new database that has a new table of 'todos' and all the columns which we have given
 
-# Now, todos.db has been created, so we have to install sqlite on our system
+def prepare_todo_tables(sync_engine):
+    # the full text search index of the todos (FTS5 table + triggers / tsvector column)
+    ensure_search_index(sync_engine)
+    # the triggers which keep the todo_stats summary table up to date
+    ensure_stats_triggers(sync_engine)
+    # the version / tombstone triggers behind GET /todo/changes
+    ensure_sync_triggers(sync_engine)
 
+
+def prepare_database():
+    # create_all creates everything from our database.py file and models.py file, a new database
+    # that has a new table of 'todos' and all the columns which we have given. Skipped when
+    # alembic manages the schema (see DB_CREATE_ALL in database.py)
+    if prepare_schema(models.Base.metadata):
+        prepare_todo_tables(engine)
+    # with DATABASE_SHARD_URLS the todos are in the shards (sharding.py), each one the same
+    for shard in shard_map.shards.values():
+        if prepare_schema(models.Base.metadata, shard.sync_engine):
+            drop_owner_foreign_key(shard.sync_engine)
+            prepare_todo_tables(shard.sync_engine)
+    if shard_map.enabled:
+        ensure_id_blocks()
+
+
+# Startup / shutdown of every worker. Nothing touches the database on import anymore, so
+# importing main (tests, alembic, scripts) is cheap, and all of it happens here once
+# (serve.py runs prepare_database once itself, before it starts its workers):
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    prepare_database()
+    # open a few pooled connections now, so the first requests do not wait for a connect
+    await warm_pool()
+    # first health check of the read replicas, then one every DB_REPLICA_CHECK_INTERVAL
+    await replicas.start()
+    # which owners are pinned to another shard than the ring says, then again every few seconds
+    await shard_map.start()
+    yield
+    password_hasher.shutdown()
+    await change_feed.close()
+    await shard_map.stop()
+    await dispose_engines()
+
+
+# every route without its own response class answers through orjson (see responses.py)
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# every router is included exactly once, here (they used to include auth.router themselves,
+# which registered the /auth routes four times)
 app.include_router(auth.router)
 app.include_router(todos.router)
 app.include_router(admin.router)
 app.include_router(users.router)
 
+# per route latency / SQL / pool wait numbers, scraped by Prometheus from GET /metrics
+app.add_middleware(MetricsMiddleware)
+if METRICS_ENABLED:
+    @app.get('/metrics', include_in_schema=False, response_class=PlainTextResponse)
+    async def read_metrics(request: Request):
+        # METRICS_TOKEN, or only from this machine (metrics.py)
+        if not metrics_allowed(request):
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Forbidden')
+        return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+
+# when the password hashing pool is full we shed the request here, before it queues up behind
+# other bcrypt calls, so the client gets a quick 503 and can retry a bit later
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy_handler(request: Request, exc: PasswordHasherBusy):
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        content={'detail': 'Too many password checks in progress, try again'},
+                        headers={'Retry-After': '1'})
+
+
+# a bucket of rate_limit.py is empty -- answered before any database or bcrypt work was done
+@app.exception_handler(RateLimitExceeded)
+async def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded):
+    return JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                        content={'detail': 'Too many requests, try again later'},
+                        headers={'Retry-After': str(math.ceil(exc.retry_after))})
+
 #
 # def get_db():
 #     # create db dependency
@@ -0,0 +1,273 @@
+import ipaddress
+import logging
+import os
+import secrets
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from sqlalchemy import event
+
+# Where does the time of a request go? This module measures it per route:
+#   - the whole request (MetricsMiddleware)
+#   - every SQL statement, through the engine's before/after_cursor_execute events
+#   - waiting for a pooled connection (the timed pools in database.py)
+#   - decoding the bearer token (dependencies.get_current_user)
+# and serves everything in the Prometheus text format on GET /metrics.
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+# routes, SQL counts and timings are nobody else's business: with a token GET /metrics wants
+# "Authorization: Bearer <METRICS_TOKEN>" (give it to the Prometheus scrape config), without
+# one it only answers a scraper on this machine talking to us directly (not through a proxy)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# statements slower than this are logged with the route they ran for, 0 turns it off
+SQL_SLOW_QUERY_MS = float(os.getenv('SQL_SLOW_QUERY_MS', 200))
+# development only: warn when one request runs the same statement this many times,
+# which usually means a loop doing one query per row (N+1). 0 turns it off
+SQL_N_PLUS_ONE_THRESHOLD = int(os.getenv('SQL_N_PLUS_ONE_THRESHOLD', 0))
+
+logger = logging.getLogger('todoapp.metrics')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    def __init__(self, name: str, documentation: str, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., +Inf count, sum]
+        self._series = defaultdict(lambda: [0] * (len(self.buckets) + 1) + [0.0])
+
+    def observe(self, labels: tuple, value: float):
+        series = self._series[labels]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        else:
+            series[len(self.buckets)] += 1
+        series[-1] += value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, series in sorted(self._series.items()):
+            label_text = format_labels(self.label_names, labels)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), series):
+                cumulative += bucket_count
+                bucket_labels = format_labels(self.label_names + ('le',), labels + (str(bound),))
+                yield f'{self.name}_bucket{bucket_labels} {cumulative}'
+            yield f'{self.name}_count{label_text} {cumulative}'
+            yield f'{self.name}_sum{label_text} {series[-1]}'
+
+
+class CounterMetric:
+
+    def __init__(self, name: str, documentation: str, label_names):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = Counter()
+
+    def inc(self, labels: tuple, amount: float = 1):
+        self._values[labels] += amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in sorted(self._values.items()):
+            yield f'{self.name}{format_labels(self.label_names, labels)} {value}'
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+def single_value(name: str, documentation: str, value, kind: str = 'gauge') -> list:
+    return [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}', f'{name} {value}']
+
+
+request_duration = Histogram('http_request_duration_seconds', 'Request latency by route',
+                             ('method', 'route', 'status'))
+sql_duration = Histogram('sql_statement_duration_seconds', 'SQL statement latency by route',
+                         ('route',))
+sql_statements = CounterMetric('sql_statements_total', 'SQL statements run by route', ('route',))
+pool_wait = Histogram('db_pool_wait_seconds', 'Time spent waiting for a pooled connection',
+                      ('route',))
+auth_duration = Histogram('auth_token_decode_seconds', 'Time spent decoding bearer tokens',
+                          ('route',))
+slow_queries = CounterMetric('sql_slow_queries_total', 'Statements slower than SQL_SLOW_QUERY_MS',
+                             ('route',))
+in_progress = [0]
+
+
+class RequestStats:
+    # one of these per request, the hooks below add to it and the middleware reports it
+
+    __slots__ = ('scope', 'sql_count', 'sql_seconds', 'statements', 'n_plus_one_reported')
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.statements = Counter() if SQL_N_PLUS_ONE_THRESHOLD else None
+        self.n_plus_one_reported = False
+
+    @property
+    def route(self) -> str:
+        # the router puts the matched route into the scope before calling the endpoint, we label
+        # by its template (/todo/{todo_id}) and not the raw path, otherwise every todo id would
+        # become its own time series
+        route = self.scope.get('route')
+        return getattr(route, 'path', 'unmatched') if route is not None else 'unmatched'
+
+
+current_request: ContextVar = ContextVar('current_request', default=None)
+
+
+def request_route() -> str:
+    stats = current_request.get()
+    return stats.route if stats is not None else 'background'
+
+
+def record_auth(seconds: float):
+    if METRICS_ENABLED:
+        auth_duration.observe((request_route(),), seconds)
+
+
+def record_pool_wait(seconds: float):
+    if METRICS_ENABLED:
+        pool_wait.observe((request_route(),), seconds)
+
+
+def instrument_engine(sync_engine):
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+        if context is not None:
+            context.timed = True
+
+    @event.listens_for(sync_engine, 'handle_error')
+    def handle_error(context):
+        # a statement which failed never gets its after_cursor_execute, its start time would
+        # stay on the stack of the (pooled) connection and the next statement would pop it.
+        # Only when it got as far as before_cursor_execute (not a failed connect)
+        execution = context.execution_context
+        if execution is not None and getattr(execution, 'timed', False) \
+                and context.connection is not None:
+            context.connection.info['query_start'].pop()
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_start'].pop()
+        if context is not None:
+            # popped, an error while fetching the rows must not pop again
+            context.timed = False
+        stats = current_request.get()
+        route = stats.route if stats is not None else 'background'
+        sql_statements.inc((route,))
+        sql_duration.observe((route,), seconds)
+        if SQL_SLOW_QUERY_MS and seconds * 1000 >= SQL_SLOW_QUERY_MS:
+            slow_queries.inc((route,))
+            logger.warning('slow query (%.1f ms) on %s: %s', seconds * 1000, route, statement)
+        if stats is None:
+            return
+        stats.sql_count += 1
+        stats.sql_seconds += seconds
+        if stats.statements is not None:
+            stats.statements[statement] += 1
+            if stats.statements[statement] == SQL_N_PLUS_ONE_THRESHOLD \
+                    and not stats.n_plus_one_reported:
+                stats.n_plus_one_reported = True
+                logger.warning('possible N+1 on %s: same statement ran %d times in one request: %s',
+                               route, SQL_N_PLUS_ONE_THRESHOLD, statement)
+
+
+def metrics_allowed(request) -> bool:
+    if METRICS_TOKEN:
+        return secrets.compare_digest(request.headers.get('authorization', '').encode(),
+                                      f'Bearer {METRICS_TOKEN}'.encode())
+    if request.client is None or 'x-forwarded-for' in request.headers:
+        return False
+    try:
+        return ipaddress.ip_address(request.client.host).is_loopback
+    except ValueError:
+        return False
+
+
+class MetricsMiddleware:
+    # plain ASGI middleware (not BaseHTTPMiddleware), so it adds almost nothing per request
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(scope)
+        token = current_request.set(stats)
+        status_code = [500]
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status_code[0] = message['status']
+            await send(message)
+
+        in_progress[0] += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_progress[0] -= 1
+            request_duration.observe((scope['method'], stats.route, str(status_code[0])),
+                                     time.perf_counter() - start)
+            current_request.reset(token)
+
+
+def render_metrics() -> str:
+    # imported here, these modules import the routers' dependencies which import this module
+    from database import pool_stats
+    from hashing import password_hasher
+    from rate_limit import rate_limiter
+    from read_cache import read_cache
+    from token_cache import token_cache
+    from user_cache import user_cache
+
+    lines = []
+    for metric in (request_duration, sql_duration, sql_statements, slow_queries, pool_wait,
+                   auth_duration):
+        lines.extend(metric.render())
+    lines.extend(single_value('http_requests_in_progress', 'Requests being handled right now',
+                              in_progress[0]))
+    for mode, pool in pool_stats().items():
+        for key in ('checked_out', 'overflow', 'max_wait_seconds'):
+            if key in pool:
+                lines.extend(single_value(f'db_pool_{mode}_{key}', f'{key} of the {mode} pool',
+                                          pool[key]))
+        for key in ('checkouts', 'timeouts'):
+            if key in pool:
+                lines.extend(single_value(f'db_pool_{mode}_{key}_total', f'{key} of the {mode} pool',
+                                          pool[key], 'counter'))
+    hasher = password_hasher.stats()
+    for key in ('pending', 'queue_depth'):
+        lines.extend(single_value(f'password_hasher_{key}', f'password hasher {key}', hasher[key]))
+    for key in ('completed', 'rejected'):
+        lines.extend(single_value(f'password_hasher_{key}_total', f'password hasher {key}',
+                                  hasher[key], 'counter'))
+    for name, stats in (('token_cache', token_cache.stats()), ('read_cache', read_cache.stats()),
+                        ('user_cache', user_cache.stats())):
+        for key in ('hits', 'misses'):
+            lines.extend(single_value(f'{name}_{key}_total', f'{name} {key}', stats[key], 'counter'))
+    limits = rate_limiter.stats()
+    for key in ('allowed', 'rejected'):
+        lines.extend(single_value(f'rate_limit_{key}_total', f'rate limited requests {key}',
+                                  limits[key], 'counter'))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,270 @@
+import logging
+import math
+import os
+import time
+from contextlib import contextmanager
+import sqlalchemy as sa
+from alembic import op
+
+# Helpers for migrations on big tables, so they do not lock a table for minutes:
+#
+#   backfill(...)             -- UPDATE in key ranges of BACKFILL_BATCH_SIZE rows, every batch
+#                                committed on its own, with progress / ETA in the log, and
+#                                resumable: a failed run carries on from the last batch
+#   create_index_online(...)  -- CREATE INDEX CONCURRENTLY on PostgreSQL (writes keep going),
+#                                a plain CREATE INDEX everywhere else
+#   drop_index_online(...)
+#   drop_backfill_progress()  -- in the downgrade of the first migration which ran a backfill
+#   alter_table(...)          -- batch mode, SQLite copies the table for changes it cannot ALTER
+#
+# In a migration:
+#
+#   from migration_helpers import backfill, create_index_online
+#
+#   def upgrade() -> None:
+#       op.add_column('todos', sa.Column('title_lower', sa.String(), nullable=True))
+#       backfill('todos', {'title_lower': 'lower(title)'}, where='title_lower IS NULL')
+#       create_index_online('ix_todos_title_lower', 'todos', ['title_lower'])
+#
+# A backfill must be idempotent (the `where` skips rows which are already done), because a
+# resumed run may redo the batch it was in when it stopped.
+#
+# With alembic -x dry_run=true upgrade head (see env.py) nothing is changed: backfills run a few
+# sample batches in a transaction which is rolled back, indexes sort a sample of the rows, and
+# both log an estimate for the whole table.
+
+BACKFILL_BATCH_SIZE = int(os.getenv('BACKFILL_BATCH_SIZE', 5000))
+# seconds to sleep between two batches, gives other writers (and replicas) room to breathe
+BACKFILL_PAUSE = float(os.getenv('BACKFILL_PAUSE', 0))
+# progress is logged at most this often (seconds)
+BACKFILL_LOG_INTERVAL = float(os.getenv('BACKFILL_LOG_INTERVAL', 5))
+DRY_RUN_SAMPLE_BATCHES = int(os.getenv('DRY_RUN_SAMPLE_BATCHES', 3))
+DRY_RUN_INDEX_SAMPLE_ROWS = int(os.getenv('DRY_RUN_INDEX_SAMPLE_ROWS', 100000))
+
+logger = logging.getLogger('alembic.helpers')
+
+metadata = sa.MetaData()
+# name of a running / failed backfill -> the last key it finished
+backfill_progress = sa.Table(
+    'alembic_backfill_progress', metadata,
+    sa.Column('name', sa.String(255), primary_key=True),
+    sa.Column('last_key', sa.BigInteger, nullable=False),
+    sa.Column('rows_done', sa.BigInteger, nullable=False),
+)
+
+
+def drop_backfill_progress():
+    # backfill() creates the table when it first runs, so the migration which ran the first
+    # backfill takes it away again on its downgrade
+    backfill_progress.drop(op.get_bind(), checkfirst=True)
+
+
+def is_dry_run() -> bool:
+    return bool(op.get_context().opts.get('dry_run'))
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds < 60:
+        return f'{seconds:.1f}s'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h{minutes:02d}m{seconds:02d}s' if hours else f'{minutes}m{seconds:02d}s'
+
+
+def as_clause(value):
+    return sa.text(value) if isinstance(value, str) else value
+
+
+def next_batch_end(connection, table, key_column, last_key, where, batch_size):
+    # the key of the batch_size-th row after last_key, or the last row if fewer are left
+    query = sa.select(key_column).where(key_column > last_key)
+    if where is not None:
+        query = query.where(where)
+    end = connection.execute(query.order_by(key_column).offset(batch_size - 1).limit(1)).scalar()
+    if end is None:
+        last = sa.select(sa.func.max(key_column)).where(key_column > last_key)
+        if where is not None:
+            last = last.where(where)
+        end = connection.execute(last).scalar()
+    return end
+
+
+def count_rows(connection, table, *conditions) -> int:
+    query = sa.select(sa.func.count()).select_from(table)
+    for condition in conditions:
+        if condition is not None:
+            query = query.where(condition)
+    return connection.execute(query).scalar()
+
+
+def backfill(table_name: str, values: dict, where=None, key: str = 'id',
+             batch_size: int = BACKFILL_BATCH_SIZE, name: str = None,
+             pause: float = BACKFILL_PAUSE):
+    # values: column -> SQL expression (a string like 'lower(title)' or a SQLAlchemy expression)
+    # where:  which rows still need it, as SQL text or a SQLAlchemy expression
+    name = name or f'{table_name}:' + ','.join(sorted(values))
+    table = sa.table(table_name, sa.column(key), *(sa.column(column) for column in values))
+    key_column = table.c[key]
+    where = as_clause(where) if where is not None else None
+    update = table.update().values({column: as_clause(value) for column, value in values.items()})
+    context = op.get_context()
+
+    if is_dry_run():
+        estimate_backfill(op.get_bind(), table, key_column, update, where, batch_size, name)
+        return
+
+    # every batch is its own short transaction, so no lock is held for longer than one batch
+    with context.autocommit_block():
+        connection = op.get_bind()
+        backfill_progress.create(connection, checkfirst=True)
+        progress = connection.execute(sa.select(backfill_progress.c.last_key,
+                                                backfill_progress.c.rows_done)
+                                      .where(backfill_progress.c.name == name)).first()
+        if progress is None:
+            last_key = connection.execute(sa.select(sa.func.min(key_column) - 1)).scalar() or 0
+            rows_done = 0
+            connection.execute(backfill_progress.insert().values(
+                name=name, last_key=last_key, rows_done=0))
+        else:
+            last_key, rows_done = progress
+            logger.info('backfill %s: resuming after %s=%s (%d rows done before)',
+                        name, key, last_key, rows_done)
+        remaining = count_rows(connection, table, where, key_column > last_key)
+        total = rows_done + remaining
+        logger.info('backfill %s: %d rows to do in batches of %d', name, remaining, batch_size)
+
+        started = last_log = time.perf_counter()
+        done_now = 0
+        while True:
+            end = next_batch_end(connection, table, key_column, last_key, where, batch_size)
+            if end is None:
+                break
+            batch = update.where(key_column > last_key, key_column <= end)
+            if where is not None:
+                batch = batch.where(where)
+            count = connection.execute(batch).rowcount
+            last_key = end
+            rows_done += count
+            done_now += count
+            connection.execute(backfill_progress.update()
+                               .where(backfill_progress.c.name == name)
+                               .values(last_key=last_key, rows_done=rows_done))
+            now = time.perf_counter()
+            if now - last_log >= BACKFILL_LOG_INTERVAL:
+                last_log = now
+                rate = done_now / (now - started)
+                eta = max(total - rows_done, 0) / rate if rate else 0
+                logger.info('backfill %s: %d/%d rows (%.0f%%), %.0f rows/s, eta %s', name,
+                            rows_done, total, min(100.0, 100 * rows_done / total), rate,
+                            format_seconds(eta))
+            if pause:
+                time.sleep(pause)
+
+        connection.execute(backfill_progress.delete().where(backfill_progress.c.name == name))
+        logger.info('backfill %s: done, %d rows in %s', name, done_now,
+                    format_seconds(time.perf_counter() - started))
+
+
+def estimate_backfill(connection, table, key_column, update, where, batch_size, name):
+    total = count_rows(connection, table, where)
+    last_key = connection.execute(sa.select(sa.func.min(key_column) - 1)).scalar() or 0
+    rows = 0
+    transaction = connection.begin_nested()
+    started = time.perf_counter()
+    try:
+        for _ in range(DRY_RUN_SAMPLE_BATCHES):
+            end = next_batch_end(connection, table, key_column, last_key, where, batch_size)
+            if end is None:
+                break
+            batch = update.where(key_column > last_key, key_column <= end)
+            if where is not None:
+                batch = batch.where(where)
+            rows += connection.execute(batch).rowcount
+            last_key = end
+        elapsed = time.perf_counter() - started
+    finally:
+        transaction.rollback()
+    estimate = total * elapsed / rows if rows else 0
+    logger.info('dry run: backfill %s: %d rows, %d sampled in %.2fs, estimate %s (+ pauses)',
+                name, total, rows, elapsed, format_seconds(estimate))
+    return estimate
+
+
+def create_index_online(index_name: str, table_name: str, columns, unique: bool = False, **kw):
+    connection = op.get_bind()
+    if is_dry_run():
+        estimate_index(connection, index_name, table_name, columns)
+        return
+    if connection.dialect.name != 'postgresql':
+        # SQLite has one writer at a time anyway, MySQL/InnoDB builds indexes online by itself
+        op.create_index(index_name, table_name, columns, unique=unique, if_not_exists=True, **kw)
+        return
+    # CONCURRENTLY cannot run inside a transaction, and does not block writes while it builds
+    with op.get_context().autocommit_block():
+        # a failed concurrent build leaves an INVALID index behind, drop it before trying again
+        invalid = op.get_bind().execute(sa.text(
+            'SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE c.relname = :name AND NOT i.indisvalid'), {'name': index_name}).first()
+        if invalid is not None:
+            op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True)
+        op.create_index(index_name, table_name, columns, unique=unique, if_not_exists=True,
+                        postgresql_concurrently=True, **kw)
+
+
+def drop_index_online(index_name: str, table_name: str, **kw):
+    if is_dry_run() or op.get_bind().dialect.name != 'postgresql':
+        op.drop_index(index_name, table_name=table_name, if_exists=True, **kw)
+        return
+    with op.get_context().autocommit_block():
+        op.drop_index(index_name, table_name=table_name, if_exists=True,
+                      postgresql_concurrently=True, **kw)
+
+
+def estimate_index(connection, index_name, table_name, columns):
+    # building an index is mostly sorting the rows by its columns: time that for a sample and
+    # scale it up by n log n
+    table = sa.table(table_name, *(sa.column(column) for column in columns))
+    total = count_rows(connection, table)
+    sample = sa.select(*table.c).limit(DRY_RUN_INDEX_SAMPLE_ROWS).subquery()
+    started = time.perf_counter()
+    sampled = len(connection.execute(sa.select(*sample.c).order_by(*sample.c)).all())
+    elapsed = time.perf_counter() - started
+    estimate = 0
+    if sampled > 1:
+        estimate = elapsed * (total / sampled) * max(1.0, log_ratio(total, sampled))
+    logger.info('dry run: index %s on %s: %d rows, %d sorted in %.2fs, estimate %s',
+                index_name, table_name, total, sampled, elapsed, format_seconds(estimate))
+    return estimate
+
+
+def log_ratio(total: int, sampled: int) -> float:
+    return math.log(max(total, 2)) / math.log(max(sampled, 2))
+
+
+@contextmanager
+def alter_table(table_name: str, **kw):
+    # batch mode: on SQLite the table is copied into a new one with the change (SQLite cannot
+    # ALTER a column or add a constraint), elsewhere these are the normal ALTER statements
+    connection = op.get_bind()
+    triggers = {}
+    if connection.dialect.name == 'sqlite':
+        logger.info('%s: SQLite batch mode, copying the table', table_name)
+        # a copy loses the triggers of the table (todos has the search, stats and sync ones),
+        # so they are created again afterwards
+        triggers = table_triggers(connection, table_name)
+    with op.batch_alter_table(table_name, recreate='auto', **kw) as batch:
+        yield batch
+    if triggers:
+        # only the ones which are gone: with recreate='auto' a change SQLite can do in place
+        # (add_column) keeps the table, and its triggers with it
+        kept = table_triggers(connection, table_name)
+        for name, trigger in triggers.items():
+            if name not in kept:
+                op.execute(trigger)
+
+
+def table_triggers(connection, table_name: str) -> dict:
+    # SQLite: trigger name -> its CREATE TRIGGER statement
+    return dict(connection.execute(sa.text(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = :table"),
+        {'table': table_name}).all())
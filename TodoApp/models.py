@@ -1,5 +1,5 @@
 from database import Base
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Index
 
 
 class Users(Base):
@@ -25,3 +25,90 @@ class Todos(Base):  #class todos inherits a Base class from a database
     priority = Column(Integer)
     complete = Column(Boolean, default= False)
     owner_id = Column(Integer, ForeignKey("users.id"))
+    # set by triggers on every insert / update (see todo_sync.py), never by the app itself
+    version = Column(Integer)
+    updated_at = Column(DateTime)
+
+    # GET / always filters on owner_id and walks the rows in (priority,) id order, so these
+    # composite indexes let the keyset pagination seek straight to the next page
+    __table_args__ = (
+        Index('ix_todos_owner_id_id', 'owner_id', 'id'),
+        Index('ix_todos_owner_id_complete_id', 'owner_id', 'complete', 'id'),
+        Index('ix_todos_owner_id_priority_id', 'owner_id', 'priority', 'id'),
+        # GET /todo/changes: the owner's rows changed after a version
+        Index('ix_todos_owner_id_version', 'owner_id', 'version'),
+    )
+
+
+# How many todos every owner has per (priority, complete), so GET /todo/stats and /admin/stats
+# read a handful of rows instead of counting the whole todos table. Kept up to date by
+# triggers on todos (see todo_stats.py), a NULL priority / owner counts as 0.
+class TodoStats(Base):
+    __tablename__ = 'todo_stats'
+
+    owner_id = Column(Integer, primary_key=True)
+    priority = Column(Integer, primary_key=True)
+    complete = Column(Boolean, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+# What is left of a deleted todo, so GET /todo/changes can tell the clients to drop it. Written
+# by the delete trigger (and when a todo moves to another owner), one row per todo id.
+class TodoTombstones(Base):
+    __tablename__ = 'todo_tombstones'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)  # the id the todo had
+    owner_id = Column(Integer)
+    version = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_todo_tombstones_owner_id_version', 'owner_id', 'version'),
+    )
+
+
+# One row per owner: the last change version handed out for their todos, and up to which
+# version their tombstones were pruned (a client which synced before that has to fetch
+# everything again). Todos without an owner count under owner_id 0.
+class TodoSyncVersions(Base):
+    __tablename__ = 'todo_sync_versions'
+
+    owner_id = Column(Integer, primary_key=True, autoincrement=False)
+    value = Column(Integer, nullable=False, default=0)
+    pruned = Column(Integer, nullable=False, default=0)
+
+
+# Sharded todos (sharding.py): the owners which are not on the shard the hash ring gives them,
+# because they are being moved or were put elsewhere on purpose. Lives in the main database,
+# every worker keeps a copy in memory. moving: their writes are refused for the moment.
+class TodoShardOwners(Base):
+    __tablename__ = 'todo_shard_owners'
+
+    owner_id = Column(Integer, primary_key=True, autoincrement=False)
+    shard = Column(String(64), nullable=False)
+    moving = Column(Boolean, nullable=False, default=False)
+
+
+# A single row: the next block of todo ids a worker can take. With shards every database would
+# count its own ids from 1, so the todo ids come from here instead and stay unique everywhere.
+class TodoIdBlocks(Base):
+    __tablename__ = 'todo_id_blocks'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    next_block = Column(Integer, nullable=False)
+
+
+# Long lived tokens for POST /auth/refresh. Only a sha256 digest of the token is stored, every
+# refresh marks the used token and issues a new one in the same family (rotation). A token of
+# the family which is presented again after it was used means it leaked, so the whole family
+# gets revoked.
+class RefreshTokens(Base):
+    __tablename__ = 'refresh_tokens'
+
+    id = Column(Integer, primary_key=True)
+    token_digest = Column(String(64), unique=True, nullable=False)
+    family = Column(String(32), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    expires_at = Column(DateTime, nullable=False)
+    used_at = Column(DateTime)
+    revoked = Column(Boolean, nullable=False, default=False)
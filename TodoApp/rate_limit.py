@@ -0,0 +1,169 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from fastapi import Request
+from dependencies import user_dependency
+from shared_state import SHARED_BACKENDS, STATE_BACKEND, create_store
+
+# /auth/token, /auth/ and /user/password run bcrypt for whoever calls them, so a credential
+# stuffing burst could eat every CPU we have. These endpoints now take a token from a bucket
+# (per client IP, and per username where there is one) before doing anything else: a bucket
+# holds up to `count` tokens and refills at count per period, an empty bucket means 429.
+#
+# The check is a route dependency (see routers/auth.py and routers/users.py for the limits),
+# it runs before the route touches the database or the password hasher, so a rejected
+# request costs a dict lookup.
+
+# 'memory', 'off' or one of the shared backends of shared_state.py ('redis', 'sqlite', ...)
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', STATE_BACKEND)
+RATE_LIMIT_URL = os.getenv('RATE_LIMIT_URL', 'redis://localhost:6379/1')
+# buckets kept by the memory backend, the least recently used are dropped after that
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000))
+# only behind a proxy we trust, otherwise anybody can send any X-Forwarded-For
+RATE_LIMIT_TRUST_FORWARDED = os.getenv('RATE_LIMIT_TRUST_FORWARDED', 'false').lower() \
+    in ('1', 'true', 'yes')
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+class RateLimitExceeded(Exception):
+
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def parse_rate(rate: str):
+    # '5/minute' -> (5 tokens of burst, 5 / 60 tokens per second)
+    count, period = rate.split('/')
+    count = int(count)
+    return count, count / PERIODS[period.strip()]
+
+
+class MemoryBackend:
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max(1, max_keys)
+        self._buckets = OrderedDict()  # key -> [tokens, last refill], least recently used first
+        self.evictions = 0
+
+    async def take(self, key: str, burst: int, per_second: float) -> float:
+        # returns 0 when a token was taken, otherwise the seconds until there is one
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(burst), now]
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * per_second)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / per_second
+
+    def size(self) -> int:
+        return len(self._buckets)
+
+
+class RateLimiter:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.allowed = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    async def check(self, key: str, rate: str):
+        if not self.enabled:
+            return
+        burst, per_second = parse_rate(rate)
+        wait = await self.backend.take(key, burst, per_second)
+        if wait > 0:
+            self.rejected += 1
+            raise RateLimitExceeded(wait)
+        self.allowed += 1
+
+    def stats(self) -> dict:
+        return {
+            'backend': type(self.backend).__name__ if self.enabled else 'off',
+            'keys': self.backend.size() if self.enabled else 0,
+            'evictions': getattr(self.backend, 'evictions', 0),
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+        }
+
+
+def create_backend(name: str = RATE_LIMIT_BACKEND):
+    if name == 'off':
+        return None
+    if name in SHARED_BACKENDS:
+        return create_store(name, 'ratelimit:', redis_url=RATE_LIMIT_URL)
+    if name == 'memory':
+        return MemoryBackend()
+    raise ValueError(f'Unknown rate limit backend: {name}')
+
+
+rate_limiter = RateLimiter(create_backend())
+
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get('x-forwarded-for')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.client.host if request.client else 'unknown'
+
+
+async def body_username(request: Request, field: str):
+    # FastAPI has already read (and for forms parsed) the body, both are cached on the request
+    if request.headers.get('content-type', '').startswith('application/json'):
+        try:
+            data = json.loads(await request.body())
+        except ValueError:
+            return None
+        value = data.get(field) if isinstance(data, dict) else None
+    else:
+        value = (await request.form()).get(field)
+    return value.lower() if isinstance(value, str) else None
+
+
+class RateLimit:
+    # dependencies=[Depends(RateLimit('login', per_ip='20/minute', per_username='5/minute'))]
+    # per_username counts the attempts for the 'username' field of the form / JSON body from
+    # one IP, so an IP gets a few guesses at one account instead of all of its per_ip ones. It
+    # is not per username alone: then anybody could lock somebody else out of their account by
+    # sending a few wrong passwords for it
+
+    def __init__(self, name: str, per_ip: str = None, per_username: str = None,
+                 username_field: str = 'username'):
+        self.name = name
+        self.per_ip = per_ip
+        self.per_username = per_username
+        self.username_field = username_field
+
+    async def __call__(self, request: Request):
+        if self.per_ip:
+            await rate_limiter.check(f'{self.name}:ip:{client_ip(request)}', self.per_ip)
+        if self.per_username:
+            username = await body_username(request, self.username_field)
+            if username:
+                await rate_limiter.check(f'{self.name}:user:{username}:ip:{client_ip(request)}',
+                                         self.per_username)
+
+
+class UserRateLimit(RateLimit):
+    # the same for routes behind the bearer token, per_username is per logged in user here
+
+    async def __call__(self, request: Request, user: user_dependency):
+        if self.per_ip:
+            await rate_limiter.check(f'{self.name}:ip:{client_ip(request)}', self.per_ip)
+        if self.per_username and user is not None:
+            await rate_limiter.check(f'{self.name}:user:{user.get("id")}', self.per_username)
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from shared_state import SHARED_BACKENDS, STATE_BACKEND, create_store
+
+# Most of our read traffic is the same dashboard polling GET / and GET /todo/{id} again and
+# again. So we keep the already serialized JSON response per owner for a few seconds, and every
+# write of that owner invalidates it.
+#
+# Invalidation works with a "generation" number per owner which is part of every cache key.
+# A write just increments the number (one INCR, no scanning for keys), the old entries are
+# never read again and fall out by TTL / LRU. A reader takes the generation *before* running
+# its query, so a write which lands in between makes it store under the old, dead generation.
+
+# 'memory', 'off' or one of the shared backends of shared_state.py ('redis', 'sqlite', ...)
+READ_CACHE_BACKEND = os.getenv('READ_CACHE_BACKEND', STATE_BACKEND)
+READ_CACHE_URL = os.getenv('READ_CACHE_URL', 'redis://localhost:6379/0')
+READ_CACHE_TTL = int(os.getenv('READ_CACHE_TTL', 30))  # seconds
+READ_CACHE_MAX_SIZE = int(os.getenv('READ_CACHE_MAX_SIZE', 10000))  # entries, memory backend
+
+
+class MemoryBackend:
+
+    def __init__(self, max_size: int = READ_CACHE_MAX_SIZE):
+        self.max_size = max(1, max_size)
+        self._entries = OrderedDict()  # key -> (expires, value), oldest used first
+        self._counters = {}
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: int):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_counter(self, key: str) -> int:
+        return self._counters.get(key, 0)
+
+    async def incr(self, key: str) -> int:
+        self._counters[key] = self._counters.get(key, 0) + 1
+        return self._counters[key]
+
+    def size(self) -> int:
+        return len(self._entries)
+
+
+class CachedResponse:
+
+    def __init__(self, body: str, etag: str, headers: dict = None):
+        self.body = body
+        self.etag = etag
+        self.headers = headers or {}
+
+    def dumps(self) -> str:
+        return json.dumps({'body': self.body, 'etag': self.etag, 'headers': self.headers})
+
+    @classmethod
+    def loads(cls, value: str):
+        data = json.loads(value)
+        return cls(data['body'], data['etag'], data['headers'])
+
+
+def make_etag(body: str) -> str:
+    return '"' + hashlib.blake2b(body.encode(), digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # the header may carry a list of etags, and weak ones (W/"...") match as well for GET
+    candidates = (candidate.strip() for candidate in if_none_match.split(','))
+    return etag in (candidate[2:] if candidate.startswith('W/') else candidate
+                    for candidate in candidates)
+
+
+class ReadCache:
+
+    def __init__(self, backend, ttl: int = READ_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    async def generation(self, owner_id: int) -> int:
+        # every write, admin deletes included, invalidates just the owner of the todo
+        if not self.enabled:
+            return 0
+        return await self.backend.get_counter(f'todos:gen:{owner_id}')
+
+    @staticmethod
+    def key(owner_id: int, generation: int, *parts) -> str:
+        return f'todos:{owner_id}:{generation}:' + ':'.join(str(part) for part in parts)
+
+    async def get(self, key: str):
+        if not self.enabled:
+            return None
+        value = await self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return CachedResponse.loads(value)
+
+    async def set(self, key: str, cached: CachedResponse):
+        if self.enabled:
+            await self.backend.set(key, cached.dumps(), self.ttl)
+
+    async def invalidate_owner(self, owner_id: int):
+        if self.enabled:
+            self.invalidations += 1
+            await self.backend.incr(f'todos:gen:{owner_id}')
+
+    def stats(self) -> dict:
+        return {
+            'backend': type(self.backend).__name__ if self.enabled else 'off',
+            'ttl': self.ttl,
+            'size': self.backend.size() if self.enabled else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
+
+
+def create_backend(name: str = READ_CACHE_BACKEND):
+    if name == 'off':
+        return None
+    if name in SHARED_BACKENDS:
+        return create_store(name, 'read_cache:', redis_url=READ_CACHE_URL)
+    if name == 'memory':
+        return MemoryBackend()
+    raise ValueError(f'Unknown read cache backend: {name}')
+
+
+read_cache = ReadCache(create_backend())
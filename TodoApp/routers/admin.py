@@ -1,13 +1,29 @@
-from fastapi import APIRouter, Depends, HTTPException, Path
+import csv
+import io
+import itertools
+import json
+from operator import itemgetter
+from fastapi import APIRouter, HTTPException, Path, Query
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
+from sqlalchemy import delete, select
 from sqlalchemy.orm import Session
-from typing import Annotated
+from typing import List, Literal, Optional
 from starlette import status
 import models
 from models import Todos
-from database import SessionLocal
-from routers import auth
-from .auth import get_current_user
+from change_feed import change_feed
+from database import SessionLocal, execute_write, execute_write_returning, pool_stats, \
+    recent_writes, run
+from dependencies import db_dependency, read_db_dependency, user_dependency
+from hashing import password_hasher
+from read_cache import read_cache
+from token_cache import token_cache
+from user_cache import user_cache
+from rate_limit import rate_limiter
+from sharding import batches, merge_by_id, on_every_shard, shard_map
+from todo_stats import merge_stats, query_stats
+from .todos import TODO_COLUMNS, TodoResponse, TodoStatsResponse, todos_changed
 
 router = APIRouter(
     prefix='/admin',  # dividing the operations according to their file
@@ -20,39 +36,146 @@ router = APIRouter(
 
 # Now, todos.db has been created, so we have to install sqlite on our system
 
-router.include_router(auth.router)
 
+def query_all_todos(db: Session):
+    # in id order, so the lists of the shards can be merged
+    return db.query(*TODO_COLUMNS).order_by(Todos.id).all()
 
-def get_db():
-    # create db dependency
-    # before each request, we now need to fetch this db session local and be able to open up the
-    # connection and close the connection on every request send to this fast api application
-    db = SessionLocal()
+
+def delete_any_todo(db: Session, todo_id: int):
+    # returns the row of the deleted todo with its owner (for the cache and the change feed),
+    # or None when there was no such todo. One "DELETE ... RETURNING owner_id" statement.
+    stmt = delete(Todos).where(Todos.id == todo_id)
+    rows = execute_write_returning(db, stmt, Todos.owner_id)
+    if rows is None:
+        # no RETURNING on this backend, the owner has to be looked up first
+        owner = db.execute(select(Todos.owner_id).where(Todos.id == todo_id)).first()
+        rows = [owner] if owner is not None and execute_write(db, stmt, Todos.id) > 0 else []
+    db.commit()
+    return rows[0] if rows else None
+
+
+@router.get("/todo", status_code=status.HTTP_200_OK, response_model=List[TodoResponse])
+async def read_all(user: user_dependency, db: read_db_dependency):
+    if user is None or user.get('user_role') != 'admin':
+        raise HTTPException(status_code= 401, detail= 'Authentication Failed')
+    if shard_map.enabled:
+        # every shard at the same time (sharding.py), merged into one list in id order
+        return list(merge_by_id(await on_every_shard(query_all_todos)))
+    return await run(db, query_all_todos)
+
+
+EXPORT_COLUMNS = ('id', 'title', 'description', 'priority', 'complete', 'owner_id')
+
+
+def export_rows(after_id: int, owner_id: Optional[int], batch_size: int, bind=None):
+    # this runs while the response is being sent, so it opens its own session instead of the
+    # request one. We select plain columns (no ORM objects) and yield_per makes SQLAlchemy fetch
+    # batch_size rows at a time (a server side cursor on PostgreSQL/MySQL), so memory stays the
+    # same whether the table has a thousand rows or a hundred million.
+    # bind: the sync engine of a shard
+    db = SessionLocal(bind=bind) if bind is not None else SessionLocal()
     try:
-        # only the code prior to and including yield statement is executed before sending a response
-        # the code following the yield statement, is executed after the response has been delivered.
-        yield db
+        stmt = select(*(getattr(Todos, column) for column in EXPORT_COLUMNS))\
+            .where(Todos.id > after_id).order_by(Todos.id)
+        if owner_id is not None:
+            stmt = stmt.where(Todos.owner_id == owner_id)
+        for partition in db.execute(stmt.execution_options(yield_per=batch_size)).partitions():
+            yield partition
     finally:
         db.close()
 
 
-db_dependency = Annotated[Session, Depends(get_db)]
-user_dependency = Annotated[dict, Depends(get_current_user)]
+def export_shards(after_id: int, owner_id: Optional[int], batch_size: int):
+    # With shards: one owner is on one shard, everything else is an export of every shard at
+    # the same time (one cursor each), merged into a single stream in id order, so after_id
+    # works the same as without shards.
+    if owner_id is not None:
+        yield from export_rows(after_id, owner_id, batch_size,
+                               shard_map.shard_for(owner_id).sync_engine)
+        return
+    rows = merge_by_id((itertools.chain.from_iterable(
+        export_rows(after_id, None, batch_size, shard.sync_engine))
+        for shard in shard_map.shards.values()), key=itemgetter(0))
+    yield from batches(rows, batch_size)
+
+
+def export_ndjson(rows):
+    for partition in rows:
+        yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in partition)
+
 
+def export_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for partition in rows:
+        writer.writerows(partition)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
 
-@router.get("/todo", status_code=status.HTTP_200_OK)
-async def read_all(user: user_dependency, db: db_dependency):
+
+# streaming version of read_all for dashboards / exports, rows go out in id order so when the
+# connection drops the client can resume with after_id=<last id it received>
+@router.get("/todo/export", status_code=status.HTTP_200_OK)
+async def export_todos(user: user_dependency,
+                       format: Literal['ndjson', 'csv'] = 'ndjson',
+                       after_id: int = Query(default=0, ge=0),
+                       owner_id: Optional[int] = Query(default=None, gt=0),
+                       batch_size: int = Query(default=1000, gt=0, le=10000)):
     if user is None or user.get('user_role') != 'admin':
-        raise HTTPException(status_code= 401, detail= 'Authentication Failed')
-    return db.query(Todos).all()
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+    rows = (export_shards if shard_map.enabled else export_rows)(after_id, owner_id, batch_size)
+    if format == 'csv':
+        return StreamingResponse(export_csv(rows), media_type='text/csv',
+                                 headers={'Content-Disposition': 'attachment; filename=todos.csv'})
+    return StreamingResponse(export_ndjson(rows), media_type='application/x-ndjson')
+
+
+# numbers to size the db pool and the hashing pool under load: how long requests waited for a
+# connection, how many timed out, how deep the bcrypt queue is, how often tokens hit the cache
+@router.get("/runtime", status_code=status.HTTP_200_OK)
+async def read_runtime_stats(user: user_dependency):
+    if user is None or user.get('user_role') != 'admin':
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+    return {
+        'db_pool': pool_stats(),
+        'password_hasher': password_hasher.stats(),
+        'token_cache': token_cache.stats(),
+        'user_cache': user_cache.stats(),
+        'read_cache': read_cache.stats(),
+        'rate_limit': rate_limiter.stats(),
+        'change_feed': change_feed.stats(),
+        'shards': shard_map.stats(),
+    }
+
+
+# the same numbers as GET /todo/stats, summed over every owner
+@router.get("/stats", status_code=status.HTTP_200_OK, response_model=TodoStatsResponse)
+async def read_all_stats(user: user_dependency, db: read_db_dependency):
+    if user is None or user.get('user_role') != 'admin':
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+    if shard_map.enabled:
+        return merge_stats(await on_every_shard(query_stats))
+    return await run(db, query_stats)
 
 
 @router.delete("/todo/{todo_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_todo(user: user_dependency, db: db_dependency, todo_id: int = Path(gt=0)):
-    if user in None or user.get('user_role') != 'admin':
+    if user is None or user.get('user_role') != 'admin':
         raise HTTPException(status_code=401, detail='Authentication Failed')
-    todo_model = db.query(Todos).filter(Todos.id == todo_id).first()
-    if todo_model is None:
+    if shard_map.enabled:
+        # the id is unique over the shards, so at most one of them has it
+        owner = next((row for row in await on_every_shard(delete_any_todo, todo_id)
+                      if row is not None), None)
+    else:
+        owner = await run(db, delete_any_todo, todo_id)
+    if owner is None:
         raise HTTPException(status_code=404, detail='Todo Not Found')
-    db.query(Todos).filter(Todos.id == todo_id).delete()
-    db.commit()
\ No newline at end of file
+    if owner.owner_id is not None:
+        await todos_changed(owner.owner_id, 'deleted', {'ids': [todo_id]})
+    # and the admin's own next GET /admin/todo should not miss it either
+    await recent_writes.mark(user.get('id'))
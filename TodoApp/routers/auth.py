@@ -1,31 +1,44 @@
+import os
+import secrets
 from datetime import timedelta, datetime
-from typing import Annotated
+from typing import Annotated, Optional
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
+from sqlalchemy import update
 from sqlalchemy.orm import Session
 from starlette import status
-from database import SessionLocal
-from models import Users
-from passlib.context import CryptContext
-from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
-from jose import jwt, JWTError
+from database import execute_write, run
+from dependencies import ALGORITHM, SECRET_KEY, db_dependency, oauth2_bearer, user_dependency
+from models import RefreshTokens, Users
+from hashing import password_hasher
+from rate_limit import RateLimit
+from token_cache import token_cache, token_digest
+from user_cache import get_user_row
+from fastapi.security import OAuth2PasswordRequestForm
+from jose import jwt
 
 router = APIRouter(
     prefix='/auth', # dividing the operations according to their file
     tags=['auth']
 )
 
-# JWT needs a secret and an algorithm, so we have to do this
-# on terminal use this -- openssl rand -hex 32, ab isse jo key aayegi uska use krna
-SECRET_KEY = '4a72b92198f7dc46a9566297dd0fbe4592c225afb1a025151eda1a9d4ab11ec4'
-ALGORITHM = 'HS256'
-
 # Encoding JWT
-bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
-# Now in this bcrypt_context, we will use our hashing algorithm 'bcrypt'
+# bcrypt (the hashing algorithm) lives in hashing.py, the routes go through password_hasher so
+# it runs on a worker pool
+# SECRET_KEY / ALGORITHM, the bearer scheme and get_current_user (decoding the JWT) are in
+# dependencies.py, shared by all the routers
+
+# both routes below run bcrypt, so they are rate limited (see rate_limit.py), as 'count/period'
+LOGIN_RATE_LIMIT_PER_IP = os.getenv('LOGIN_RATE_LIMIT_PER_IP', '20/minute')
+LOGIN_RATE_LIMIT_PER_USERNAME = os.getenv('LOGIN_RATE_LIMIT_PER_USERNAME', '5/minute')
+SIGNUP_RATE_LIMIT_PER_IP = os.getenv('SIGNUP_RATE_LIMIT_PER_IP', '10/minute')
+# no bcrypt on a refresh, but every call writes a row, so it gets a (looser) limit as well
+REFRESH_RATE_LIMIT_PER_IP = os.getenv('REFRESH_RATE_LIMIT_PER_IP', '60/minute')
 
-# for decoding the JWT
-oauth2_bearer = OAuth2PasswordBearer(tokenUrl='auth/token')
+# the access token stays short lived, the client gets a new one from POST /auth/refresh with
+# its refresh token instead of sending the password (and paying bcrypt) again
+ACCESS_TOKEN_MINUTES = int(os.getenv('ACCESS_TOKEN_MINUTES', 20))
+REFRESH_TOKEN_DAYS = int(os.getenv('REFRESH_TOKEN_DAYS', 14))
 
 
 class CreateUserRequest(BaseModel):
@@ -41,33 +54,31 @@ class CreateUserRequest(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+    expires_in: Optional[int] = None  # seconds, of the access token
+
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 
-def get_db():
-    # create db dependency
-    # before each request, we now need to fetch this db session local and be able to open up the
-    # connection and close the connection on every request send to this fast api application
-    db = SessionLocal()
-    try:
-        # only the code prior to and including yield statement is executed before sending a response
-        # the code following the yield statement, is executed after the response has been delivered.
-        yield db
-    finally:
-        db.close()
+def get_user_by_username(db: Session, username: str):
+    return db.query(Users).filter(Users.username == username).first() # based on the username
 
 
-db_dependency = Annotated[Session, Depends(get_db)]
+def add_user(db: Session, user_model: Users):
+    db.add(user_model)
+    db.commit()
 
 
 # To authenticate the user, we have created this function, which will take username and
 # password and database session, match them in database, return the result
-def authenticate_user(username: str, password: str, db):
-    user = db.query(Users).filter(Users.username == username).first() # based on the username
+async def authenticate_user(username: str, password: str, db):
+    user = await run(db, get_user_by_username, username)
     if not user:
         return False
     # to verify whether this password matches with our original password or not.
-    if not bcrypt_context.verify(password, user.hashed_password):
+    if not await password_hasher.verify(password, user.hashed_password):
         return False
     return user
 
@@ -79,23 +90,69 @@ def create_access_token(username: str, user_id: int, role: str, expires_delta: t
     return jwt.encode(encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
-# we have to check whether our token is true or fake
-async def get_current_user(token: Annotated[str, Depends(oauth2_bearer)]):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get('sub')
-        user_id: int = payload.get('id')
-        user_role: str = payload.get('role')
-        if username is None or user_id is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                                detail='Could Not Validate User')
-        return {'username': username, 'id': user_id, 'user_role': user_role}
-    except JWTError:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                            detail='Could Not Validate User')
+# Refresh tokens are random strings, not JWTs, they mean nothing without their row in
+# refresh_tokens (and only the digest is stored there, see models.RefreshTokens)
+def store_refresh_token(db: Session, user_id: int, family: str, digest: str):
+    now = datetime.utcnow()
+    # the user's expired tokens are of no use anymore, clean them up on the way
+    db.query(RefreshTokens).filter(RefreshTokens.user_id == user_id,
+                                   RefreshTokens.expires_at <= now)\
+        .delete(synchronize_session=False)
+    db.add(RefreshTokens(token_digest=digest, family=family, user_id=user_id,
+                         expires_at=now + timedelta(days=REFRESH_TOKEN_DAYS), revoked=False))
+    db.commit()
+
 
+def rotate_refresh_token(db: Session, digest: str, new_digest: str):
+    # returns the user id when the token was valid, after swapping it for new_digest
+    now = datetime.utcnow()
+    token = db.query(RefreshTokens.id, RefreshTokens.family, RefreshTokens.user_id,
+                     RefreshTokens.expires_at, RefreshTokens.used_at, RefreshTokens.revoked)\
+        .filter(RefreshTokens.token_digest == digest).first()
+    if token is None or token.revoked or token.expires_at <= now:
+        return None
+    if token.used_at is not None:
+        # used twice: somebody else has a copy of it, the whole family is cut off
+        db.execute(update(RefreshTokens).where(RefreshTokens.family == token.family)
+                   .values(revoked=True))
+        db.commit()
+        return None
+    # only one of two refreshes racing with the same token gets it
+    used = execute_write(db, update(RefreshTokens)
+                         .where(RefreshTokens.id == token.id, RefreshTokens.used_at.is_(None))
+                         .values(used_at=now), RefreshTokens.id)
+    if not used:
+        db.rollback()
+        return None
+    db.add(RefreshTokens(token_digest=new_digest, family=token.family, user_id=token.user_id,
+                         expires_at=now + timedelta(days=REFRESH_TOKEN_DAYS), revoked=False))
+    db.commit()
+    return token.user_id
 
-@router.post("/", status_code=status.HTTP_201_CREATED)
+
+def revoke_refresh_family(db: Session, digest: str, user_id: int):
+    family = db.query(RefreshTokens.family)\
+        .filter(RefreshTokens.token_digest == digest, RefreshTokens.user_id == user_id)\
+        .scalar_subquery()
+    db.execute(update(RefreshTokens).where(RefreshTokens.family == family).values(revoked=True))
+    db.commit()
+
+
+async def issue_tokens(db, user_id: int, username: str, role: str, family: str = None,
+                       refresh_token: str = None):
+    # login starts a new family, a refresh passes the token it already stored in the old one
+    if refresh_token is None:
+        refresh_token = secrets.token_urlsafe(32)
+        await run(db, store_refresh_token, user_id, family or secrets.token_hex(16),
+                  token_digest(refresh_token))
+    access_token = create_access_token(username, user_id, role,
+                                       timedelta(minutes=ACCESS_TOKEN_MINUTES))
+    return {'access_token': access_token, 'token_type': 'bearer', 'refresh_token': refresh_token,
+            'expires_in': ACCESS_TOKEN_MINUTES * 60}
+
+
+@router.post("/", status_code=status.HTTP_201_CREATED,
+             dependencies=[Depends(RateLimit('signup', per_ip=SIGNUP_RATE_LIMIT_PER_IP))])
 async def create_user(db: db_dependency,
                       create_user_request: CreateUserRequest):
     create_user_model = Users(
@@ -104,13 +161,12 @@ async def create_user(db: db_dependency,
         first_name = create_user_request.first_name,
         last_name = create_user_request.last_name,
         role = create_user_request.role,
-        hashed_password = bcrypt_context.hash(create_user_request.password),
+        hashed_password = await password_hasher.hash(create_user_request.password),
         is_active = True,
         phone_number = create_user_request.phone_number
     )
 
-    db.add(create_user_model)
-    db.commit()
+    await run(db, add_user, create_user_model)
 
 
 # created a new API request, type : 'POST', API name : 'token', for user verification
@@ -119,17 +175,44 @@ async def create_user(db: db_dependency,
 # This 'token' is simply a JWT (JSON Web Token),
 
 # first, receiving the information that user have submitted
-@router.post("/token", response_model=Token)
+@router.post("/token", response_model=Token,
+             dependencies=[Depends(RateLimit('login', per_ip=LOGIN_RATE_LIMIT_PER_IP,
+                                             per_username=LOGIN_RATE_LIMIT_PER_USERNAME))])
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
                                  db: db_dependency):
     # here we have passed them to verify in our database
-    user = authenticate_user(form_data.username, form_data.password, db)
+    user = await authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail='Could Not Validate User')
-    token = create_access_token(user.username, user.id, user.role, timedelta(minutes=20))
-    
-    return {'access_token': token, 'token_type': 'bearer'} #'Authentication is Successful'
+
+    return await issue_tokens(db, user.id, user.username, user.role) #'Authentication is Successful'
+
+
+# a new access token (and a new refresh token, the old one is used up) without the password
+@router.post("/refresh", response_model=Token,
+             dependencies=[Depends(RateLimit('refresh', per_ip=REFRESH_RATE_LIMIT_PER_IP))])
+async def refresh_access_token(db: db_dependency, refresh_request: RefreshRequest):
+    refresh_token = secrets.token_urlsafe(32)
+    user_id = await run(db, rotate_refresh_token, token_digest(refresh_request.refresh_token),
+                        token_digest(refresh_token))
+    user = await get_user_row(db, user_id) if user_id is not None else None
+    if user is None or not user['is_active']:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail='Could Not Validate User')
+    return await issue_tokens(db, user['id'], user['username'], user['role'],
+                              refresh_token=refresh_token)
+
+
+# the access token stops working right away (token_cache keeps it as revoked until it would
+# have expired) and the refresh token, if sent, is revoked with its whole family
+@router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
+async def logout(user: user_dependency, token: Annotated[str, Depends(oauth2_bearer)],
+                 db: db_dependency, refresh_request: Optional[RefreshRequest] = None):
+    await token_cache.revoke(token, jwt.get_unverified_claims(token).get('exp'))
+    if refresh_request is not None:
+        await run(db, revoke_refresh_family, token_digest(refresh_request.refresh_token),
+                  user.get('id'))
 
 # to submit forms to our application, we have to (pip) install python-multipart name package
 # here we use 'OAuth2PasswordRequestForm' form,
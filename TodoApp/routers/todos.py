@@ -1,13 +1,26 @@
-from fastapi import APIRouter, Depends, HTTPException, Path
-from pydantic import BaseModel, Field
+import base64
+import json
+from datetime import datetime
+from fastapi import APIRouter, Body, Depends, Header, HTTPException, Path, Query, Response
+from fastapi.responses import StreamingResponse
+from jose import jwt
+from pydantic import BaseModel, ConfigDict, Field
+from sqlalchemy import and_, bindparam, delete, or_, select, tuple_, update
 from sqlalchemy.orm import Session
-from typing import Annotated
+from typing import Annotated, Dict, List, Literal, Optional
 from starlette import status
 import models
 from models import Todos
-from database import SessionLocal
-from routers import auth
-from .auth import get_current_user
+from change_feed import change_feed, event_stream
+from database import execute_insert_returning, execute_write, recent_writes, run
+from dependencies import oauth2_bearer, todos_db_dependency, todos_read_db_dependency, \
+    user_dependency
+from read_cache import CachedResponse, etag_matches, make_etag, read_cache
+from responses import dumps
+from search import search_terms, search_todos
+from sharding import todo_ids
+from todo_stats import query_stats
+from todo_sync import query_changes, sync_maintained
 
 router = APIRouter()
 
@@ -17,24 +30,7 @@ router = APIRouter()
 
 # Now, todos.db has been created, so we have to install sqlite on our system
 
-router.include_router(auth.router)
-
-
-def get_db():
-    # create db dependency
-    # before each request, we now need to fetch this db session local and be able to open up the
-    # connection and close the connection on every request send to this fast api application
-    db = SessionLocal()
-    try:
-        # only the code prior to and including yield statement is executed before sending a response
-        # the code following the yield statement, is executed after the response has been delivered.
-        yield db
-    finally:
-        db.close()
-
-
-db_dependency = Annotated[Session, Depends(get_db)]
-user_dependency = Annotated[dict, Depends(get_current_user)]
+if_none_match_header = Annotated[Optional[str], Header()]
 
 
 
@@ -45,35 +41,455 @@ class TodoRequest(BaseModel):
     complete: bool
 
 
-@router.get("/", status_code=status.HTTP_200_OK)
-async def read_all(user: user_dependency, db: db_dependency):
+# how many todos one bulk request may carry, so one request cannot hold a transaction forever
+BULK_MAX_ITEMS = 500
+
+
+# What we send back for a todo. Reads select only these columns (not whole ORM objects, so no
+# identity map / instance state per row), and from_attributes lets the model read those rows.
+class TodoResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    title: Optional[str]
+    description: Optional[str]
+    priority: Optional[int]
+    complete: Optional[bool]
+    owner_id: Optional[int]
+
+
+TODO_COLUMNS = (Todos.id, Todos.title, Todos.description, Todos.priority, Todos.complete,
+                Todos.owner_id)
+
+
+class PriorityCounts(BaseModel):
+    complete: int
+    incomplete: int
+
+
+class TodoStatsResponse(BaseModel):
+    total: int
+    complete: int
+    incomplete: int
+    by_priority: Dict[str, PriorityCounts]
+
+
+# GET /todo/changes: the todos changed after `since` (with the version of their last change)
+# and the ids deleted after it. `version` is what the client sends as `since` next time.
+class TodoChange(TodoResponse):
+    version: int
+    updated_at: Optional[datetime]
+
+
+class TodoTombstone(BaseModel):
+    id: int
+    version: int
+
+
+class TodoChangesResponse(BaseModel):
+    changes: List[TodoChange]
+    deleted: List[TodoTombstone]
+    version: int
+    has_more: bool
+
+
+class TodoBulkUpdateRequest(TodoRequest):
+    id: int = Field(gt=0)
+
+
+class TodoBulkDeleteRequest(BaseModel):
+    ids: List[int] = Field(min_length=1, max_length=BULK_MAX_ITEMS)
+
+
+# GET / is paginated with a keyset cursor: instead of OFFSET (which still reads every skipped
+# row) the cursor remembers the sort key of the last row we sent, and the next page starts
+# with "WHERE (priority, id) > (last priority, last id)" which the owner_id indexes can seek to.
+# The cursor is opaque for the client, it just sends back whatever X-Next-Cursor it got.
+#
+# priority is nullable (old rows), and NULL never compares as > or < anything. Those rows sort
+# where the database puts NULLs by itself (before the numbers on SQLite / MySQL, after them on
+# PostgreSQL / Oracle), so the ORDER BY still walks the index, and the cursor keeps "p": null.
+NULLS_LAST_DIALECTS = ('postgresql', 'oracle')
+def encode_cursor(data: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(cursor: str, sort: str, order: str) -> dict:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if data['s'] != sort or data['o'] != order or not isinstance(data['id'], int):
+            raise ValueError()
+        if sort == 'priority' and data['p'] is not None and not isinstance(data['p'], int):
+            raise ValueError()
+        return data
+    except (ValueError, KeyError, TypeError):
+        # also covers a cursor from a different sort/order, it would skip or repeat rows
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+def query_todos(db: Session, owner_id: int, limit: int, last: Optional[dict],
+                complete: Optional[bool], priority: Optional[int], sort: str, order: str):
+    query = db.query(*TODO_COLUMNS).filter(Todos.owner_id == owner_id)
+    if complete is not None:
+        query = query.filter(Todos.complete == complete)
+    if priority is not None:
+        query = query.filter(Todos.priority == priority)
+
+    sort_columns = (Todos.priority, Todos.id) if sort == 'priority' else (Todos.id,)
+    if last is not None:
+        def after(key, last_value):
+            return key > last_value if order == 'asc' else key < last_value
+
+        if sort != 'priority':
+            query = query.filter(after(Todos.id, last['id']))
+        else:
+            # does this page walk the NULL priorities before the numbers?
+            nulls_first = ((order == 'asc')
+                           != (db.get_bind().dialect.name in NULLS_LAST_DIALECTS))
+            if last['p'] is None:
+                rest = and_(Todos.priority.is_(None), after(Todos.id, last['id']))
+                query = query.filter(or_(rest, Todos.priority.isnot(None)) if nulls_first
+                                     else rest)
+            else:
+                rest = after(tuple_(Todos.priority, Todos.id), tuple_(last['p'], last['id']))
+                query = query.filter(rest if nulls_first
+                                     else or_(rest, Todos.priority.is_(None)))
+    query = query.order_by(*(column.asc() if order == 'asc' else column.desc()
+                             for column in sort_columns))
+    return query.limit(limit).all()
+
+
+def serialize_todos(rows) -> str:
+    # rows from TODO_COLUMNS already have exactly the TodoResponse fields, so they go straight
+    # to orjson as dicts, without the generic jsonable_encoder walk over every attribute
+    return dumps([row._asdict() for row in rows]).decode()
+
+
+# Both reads answer from the read cache when they can. The ETag is a hash of the JSON body, so
+# a client sending it back in If-None-Match gets an empty 304 if nothing changed since then,
+# and on a cache hit we do not even run the query or serialize the todos again.
+def cached_json_response(cached: CachedResponse, if_none_match: Optional[str]) -> Response:
+    headers = dict(cached.headers, ETag=cached.etag)
+    if etag_matches(if_none_match, cached.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=cached.body, media_type='application/json', headers=headers)
+
+
+@router.get("/", status_code=status.HTTP_200_OK, response_model=List[TodoResponse])
+async def read_all(user: user_dependency, db: todos_read_db_dependency,
+                   if_none_match: if_none_match_header = None,
+                   limit: int = Query(default=100, gt=0, le=1000),
+                   cursor: Optional[str] = None,
+                   complete: Optional[bool] = None,
+                   priority: Optional[int] = Query(default=None, gt=0, lt=6),
+                   sort: Literal['id', 'priority'] = 'id',
+                   order: Literal['asc', 'desc'] = 'asc'):
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
     # depends -- dependency injection
     # we have to do something before executing whatever we are trying to execute
-    return db.query(Todos).filter(Todos.owner_id == user.get('id')).all()
+    last = decode_cursor(cursor, sort, order) if cursor is not None else None
+
+    owner_id = user.get('id')
+    generation = await read_cache.generation(owner_id)
+    cache_key = read_cache.key(owner_id, generation, 'list', limit, cursor, complete,
+                               priority, sort, order)
+    cached = await read_cache.get(cache_key)
+    if cached is None:
+        # one extra row tells us if there is a next page, without a separate COUNT query
+        todos = await run(db, query_todos, owner_id, limit + 1, last,
+                          complete, priority, sort, order)
+        headers = {}
+        if len(todos) > limit:
+            todos = todos[:limit]
+            last_todo = todos[-1]
+            next_cursor = {'s': sort, 'o': order, 'id': last_todo.id}
+            if sort == 'priority':
+                next_cursor['p'] = last_todo.priority
+            headers['X-Next-Cursor'] = encode_cursor(next_cursor)
+        body = serialize_todos(todos)
+        cached = CachedResponse(body, make_etag(body), headers)
+        await read_cache.set(cache_key, cached)
+    return cached_json_response(cached, if_none_match)
     # here we call, our db, then here we write a query (which is a script to our database)
-    # where we have pass our model(TODOS) and in return we want all our data so we have
-    # used .all() method.
+    # where we have pass our model(TODOS) and in return we want only one page of our data,
+    # so we have used .limit() instead of the .all() on the whole table.
+
+
+def decode_search_cursor(cursor: str) -> dict:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if data['s'] != 'search' or not isinstance(data['id'], int) \
+                or not isinstance(data['r'], (int, float)):
+            raise ValueError()
+        return data
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+# GET /todo/search?q=... -- the owner's todos matching every word of q, best match first
+# (see search.py for how each database does it), with the same X-Next-Cursor paging as GET /.
+# Declared before /todo/{todo_id}, otherwise 'search' would be taken for a todo id.
+@router.get("/todo/search", status_code=status.HTTP_200_OK, response_model=List[TodoResponse])
+async def search(user: user_dependency, db: todos_read_db_dependency,
+                 q: str = Query(min_length=1, max_length=200),
+                 if_none_match: if_none_match_header = None,
+                 limit: int = Query(default=20, gt=0, le=100),
+                 cursor: Optional[str] = None,
+                 complete: Optional[bool] = None):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+    last = decode_search_cursor(cursor) if cursor is not None else None
+    terms = search_terms(q)
+
+    owner_id = user.get('id')
+    generation = await read_cache.generation(owner_id)
+    cache_key = read_cache.key(owner_id, generation, 'search', ' '.join(terms), limit, cursor,
+                               complete)
+    cached = await read_cache.get(cache_key)
+    if cached is None:
+        todos = []
+        if terms:
+            todos = await run(db, search_todos, TODO_COLUMNS, owner_id, terms, limit + 1, last,
+                              complete)
+        headers = {}
+        if len(todos) > limit:
+            todos = todos[:limit]
+            headers['X-Next-Cursor'] = encode_cursor({'s': 'search', 'r': todos[-1].score,
+                                                      'id': todos[-1].id})
+        body = dumps([{column.key: getattr(row, column.key) for column in TODO_COLUMNS}
+                      for row in todos]).decode()
+        cached = CachedResponse(body, make_etag(body), headers)
+        await read_cache.set(cache_key, cached)
+    return cached_json_response(cached, if_none_match)
+
+
+# GET /todo/stats -- complete / incomplete counts and the priority histogram for the dashboard,
+# read from the todo_stats summary table (see todo_stats.py) instead of the whole todo list
+@router.get("/todo/stats", status_code=status.HTTP_200_OK, response_model=TodoStatsResponse)
+async def read_stats(user: user_dependency, db: todos_read_db_dependency,
+                     if_none_match: if_none_match_header = None):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+    owner_id = user.get('id')
+    generation = await read_cache.generation(owner_id)
+    cache_key = read_cache.key(owner_id, generation, 'stats')
+    cached = await read_cache.get(cache_key)
+    if cached is None:
+        body = dumps(await run(db, query_stats, owner_id)).decode()
+        cached = CachedResponse(body, make_etag(body))
+        await read_cache.set(cache_key, cached)
+    return cached_json_response(cached, if_none_match)
+
+
+# GET /todo/changes?since=<version> -- delta sync for the clients which keep a local copy:
+# only the todos created / updated after `since` and the ids deleted after it, instead of the
+# whole list on every poll (see todo_sync.py). Start with since=0, then send back `version`
+# of the last answer; with has_more, ask again right away. 410 means the tombstones the client
+# needs are pruned already (or `since` is from another database): fetch everything again.
+@router.get("/todo/changes", status_code=status.HTTP_200_OK, response_model=TodoChangesResponse)
+async def read_changes(user: user_dependency, db: todos_read_db_dependency,
+                       since: int = Query(default=0, ge=0),
+                       if_none_match: if_none_match_header = None,
+                       limit: int = Query(default=500, gt=0, le=1000)):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+    owner_id = user.get('id')
+    generation = await read_cache.generation(owner_id)
+    cache_key = read_cache.key(owner_id, generation, 'changes', since, limit)
+    cached = await read_cache.get(cache_key)
+    if cached is None:
+        if not await run(db, sync_maintained):
+            raise HTTPException(status_code=501, detail='Sync is not available on this database')
+        changes = await run(db, query_changes, TODO_COLUMNS, owner_id, since, limit)
+        if changes is None:
+            raise HTTPException(status_code=410, detail='Full resync required')
+        body = dumps(changes).decode()
+        cached = CachedResponse(body, make_etag(body))
+        await read_cache.set(cache_key, cached)
+    return cached_json_response(cached, if_none_match)
+
+
+# GET /todo/events -- a server-sent events stream of the user's todo changes, instead of
+# polling GET / (see change_feed.py). Every write below publishes after its commit:
+#   event: created / updated   data: {"todos": [<the todos as in GET />]}
+#   event: deleted             data: {"ids": [...]}
+# On (re)connect the client first catches up with GET /todo/changes, then follows the stream.
+@router.get("/todo/events", status_code=status.HTTP_200_OK, response_class=StreamingResponse)
+async def stream_events(user: user_dependency, token: Annotated[str, Depends(oauth2_bearer)]):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+    # the token is verified already, the stream just ends when it expires
+    expires_at = jwt.get_unverified_claims(token).get('exp')
+    subscription = change_feed.subscribe(user.get('id'))
+    return StreamingResponse(event_stream(subscription, expires_at),
+                             media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def todo_event(todo_id: int, owner_id: int, todo_request: TodoRequest) -> dict:
+    # the same fields as TodoResponse
+    return dict(id=todo_id, **todo_request.model_dump(exclude={'id'}), owner_id=owner_id)
+
+
+async def todos_changed(owner_id: int, event: str, data: dict):
+    # after every committed write of an owner's todos: their next reads stay on the primary for
+    # a moment (database.py), their cached reads are dropped and their open streams told
+    await recent_writes.mark(owner_id)
+    await read_cache.invalidate_owner(owner_id)
+    await change_feed.publish(owner_id, event, data)
+
+
+# Bulk endpoints -- our sync clients push hundreds of changes at once, and doing them one by
+# one costs a round trip and a commit (fsync) per todo. These take a list, apply everything in
+# a single transaction and answer with one result per item, in the same order as the request.
+def bulk_create_todos(db: Session, owner_id: int, todo_requests: List[TodoRequest],
+                      ids: Optional[List[int]] = None):
+    # ids: given with shards (sharding.todo_ids), otherwise the database numbers them
+    rows = [dict(todo_request.model_dump(), owner_id=owner_id) for todo_request in todo_requests]
+    if ids is not None:
+        for row, todo_id in zip(rows, ids):
+            row['id'] = todo_id
+    # ids come back in the same order as the rows
+    ids = execute_insert_returning(db, Todos, rows, Todos.id)
+    db.commit()
+    return ids
+
+
+def owned_todo_ids(db: Session, owner_id: int, todo_ids) -> set:
+    return set(db.scalars(select(Todos.id).where(Todos.id.in_(set(todo_ids)))
+                          .where(Todos.owner_id == owner_id)))
+
+
+def bulk_update_todos(db: Session, owner_id: int, todo_requests: List[TodoBulkUpdateRequest]):
+    found = owned_todo_ids(db, owner_id, (todo_request.id for todo_request in todo_requests))
+    rows = [{'todo_id': todo_request.id, 'title': todo_request.title,
+             'description': todo_request.description, 'priority': todo_request.priority,
+             'complete': todo_request.complete}
+            for todo_request in todo_requests if todo_request.id in found]
+    if rows:
+        # a single executemany of "UPDATE todos SET ... WHERE id = ? AND owner_id = ?"
+        db.connection().execute(update(Todos)
+                                .where(Todos.id == bindparam('todo_id'))
+                                .where(Todos.owner_id == owner_id), rows)
+    db.commit()
+    return found
+
+
+def bulk_delete_todos(db: Session, owner_id: int, todo_ids: List[int]):
+    found = owned_todo_ids(db, owner_id, todo_ids)
+    if found:
+        db.execute(delete(Todos).where(Todos.id.in_(found)).where(Todos.owner_id == owner_id))
+    db.commit()
+    return found
+
+
+@router.post("/todo/bulk", status_code=status.HTTP_200_OK)
+async def create_todos(user: user_dependency, db: todos_db_dependency,
+                       todo_requests: Annotated[List[TodoRequest],
+                                                Body(min_length=1, max_length=BULK_MAX_ITEMS)]):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+    ids = await run(db, bulk_create_todos, user.get('id'), todo_requests,
+                    await todo_ids.allocate(len(todo_requests)))
+    await todos_changed(user.get('id'), 'created', {'todos': [
+        todo_event(todo_id, user.get('id'), todo_request)
+        for todo_id, todo_request in zip(ids, todo_requests)]})
+    return [{'index': index, 'id': todo_id, 'status': status.HTTP_201_CREATED}
+            for index, todo_id in enumerate(ids)]
+
+
+@router.put("/todo/bulk", status_code=status.HTTP_200_OK)
+async def update_todos(user: user_dependency, db: todos_db_dependency,
+                       todo_requests: Annotated[List[TodoBulkUpdateRequest],
+                                                Body(min_length=1, max_length=BULK_MAX_ITEMS)]):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+    found = await run(db, bulk_update_todos, user.get('id'), todo_requests)
+    if found:
+        await todos_changed(user.get('id'), 'updated', {'todos': [
+            todo_event(todo_request.id, user.get('id'), todo_request)
+            for todo_request in todo_requests if todo_request.id in found]})
+    return [{'index': index, 'id': todo_request.id,
+             'status': status.HTTP_204_NO_CONTENT if todo_request.id in found
+             else status.HTTP_404_NOT_FOUND}
+            for index, todo_request in enumerate(todo_requests)]
+
+
+@router.delete("/todo/bulk", status_code=status.HTTP_200_OK)
+async def delete_todos(user: user_dependency, db: todos_db_dependency,
+                       delete_request: TodoBulkDeleteRequest):
+    if user is None:
+        raise HTTPException(status_code=401, detail='Authentication Failed')
+    found = await run(db, bulk_delete_todos, user.get('id'), delete_request.ids)
+    if found:
+        await todos_changed(user.get('id'), 'deleted', {'ids': sorted(found)})
+    return [{'index': index, 'id': todo_id,
+             'status': status.HTTP_204_NO_CONTENT if todo_id in found
+             else status.HTTP_404_NOT_FOUND}
+            for index, todo_id in enumerate(delete_request.ids)]
+
+
+def get_owned_todo(db: Session, todo_id: int, owner_id: int):
+    return db.query(*TODO_COLUMNS).filter(Todos.id == todo_id)\
+        .filter(Todos.owner_id == owner_id).first()
+
+
+def add_todo(db: Session, todo_model: Todos):
+    db.add(todo_model)
+    # adding means getting the db ready / we want to add this data into our db
+    db.flush()
+    # the INSERT is sent now, so we know the new id before commit() expires the object
+    todo_id = todo_model.id
+    db.commit()
+    # do a transaction into the database / helps us to store our data in db (reflecting)
+    # permanent store karne ke liye commit() use krna pdega
+    return todo_id
+
+
+# update and delete are one statement each, "UPDATE/DELETE ... WHERE id = ? AND owner_id = ?",
+# and the number of rows it hit tells us if the todo exists (for this user) -- no SELECT first
+def update_owned_todo(db: Session, todo_id: int, owner_id: int, todo_request: TodoRequest):
+    stmt = update(Todos).where(Todos.id == todo_id).where(Todos.owner_id == owner_id)\
+        .values(title=todo_request.title, description=todo_request.description,
+                priority=todo_request.priority, complete=todo_request.complete)
+    updated = execute_write(db, stmt, Todos.id)
+    db.commit()
+    return updated > 0
+
+
+def delete_owned_todo(db: Session, todo_id: int, owner_id: int):
+    stmt = delete(Todos).where(Todos.id == todo_id).where(Todos.owner_id == owner_id)
+    deleted = execute_write(db, stmt, Todos.id)
+    db.commit()
+    return deleted > 0
 
 
 # Fetch Single Todo based on the todo id
-@router.get("/todo/{todo_id}", status_code=status.HTTP_200_OK)
-async def read_todo(user: user_dependency, db: db_dependency, todo_id: int = Path(gt=0)):
+@router.get("/todo/{todo_id}", status_code=status.HTTP_200_OK, response_model=TodoResponse)
+async def read_todo(user: user_dependency, db: todos_read_db_dependency,
+                    if_none_match: if_none_match_header = None, todo_id: int = Path(gt=0)):
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
 
-    # Path(gt=0) -- validation at path, like id should be greater than 0
-    # if we give lesser value then this will throw an exception.
-    todo_model = db.query(Todos).filter(Todos.id == todo_id)\
-        .filter(Todos.owner_id == user.get('id')).first()
-    if todo_model is not None:
-        return todo_model
-    raise HTTPException(status_code=404, detail='Todo not found.')
+    owner_id = user.get('id')
+    generation = await read_cache.generation(owner_id)
+    cache_key = read_cache.key(owner_id, generation, 'todo', todo_id)
+    cached = await read_cache.get(cache_key)
+    if cached is None:
+        # Path(gt=0) -- validation at path, like id should be greater than 0
+        # if we give lesser value then this will throw an exception.
+        todo_model = await run(db, get_owned_todo, todo_id, owner_id)
+        if todo_model is None:
+            raise HTTPException(status_code=404, detail='Todo not found.')
+        body = dumps(todo_model._asdict()).decode()
+        cached = CachedResponse(body, make_etag(body))
+        await read_cache.set(cache_key, cached)
+    return cached_json_response(cached, if_none_match)
 
 
 @router.post("/todo", status_code=status.HTTP_201_CREATED)
-async def create_todo(user: user_dependency, db: db_dependency,
+async def create_todo(user: user_dependency, db: todos_db_dependency,
                       todo_request: TodoRequest):
 
     if user is None:
@@ -82,44 +498,31 @@ async def create_todo(user: user_dependency, db: db_dependency,
     # authorized himself, so us tag(todo, create todo) ke pass me ek lock wala icon hoga
     # jha usko pehle khudko authorize krna pdega then wo ab db me data add kr payega
     todo_model = Todos(**todo_request.dict(), owner_id=user.get('id'))
-
-    db.add(todo_model)
-    # adding means getting the db ready / we want to add this data into our db
-    db.commit()
-    # do a transaction into the database / helps us to store our data in db (reflecting)
-    # permanent store karne ke liye commit() use krna pdega
+    # with shards the id comes from the id blocks, so it is unique over all of them
+    new_ids = await todo_ids.allocate(1)
+    if new_ids is not None:
+        todo_model.id = new_ids[0]
+    todo_id = await run(db, add_todo, todo_model)
+    await todos_changed(user.get('id'), 'created',
+                        {'todos': [todo_event(todo_id, user.get('id'), todo_request)]})
 
 
 @router.put("/todo/{todo_id}", status_code= status.HTTP_204_NO_CONTENT)
-async def update_todo(user: user_dependency, db: db_dependency,
+async def update_todo(user: user_dependency, db: todos_db_dependency,
                       todo_request: TodoRequest,
                       todo_id: int = Path(gt=0)):
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
-    todo_model = db.query(Todos).filter(Todos.id == todo_id)\
-        .filter(Todos.owner_id == user.get('id')).first()
-    if todo_model is None:
+    if not await run(db, update_owned_todo, todo_id, user.get('id'), todo_request):
         raise HTTPException(status_code=404, detail='Todo not found')
-
-    todo_model.title = todo_request.title
-    todo_model.description = todo_request.description
-    todo_model.priority = todo_request.priority
-    todo_model.complete = todo_request.complete
-
-    db.add(todo_model)
-    db.commit()
+    await todos_changed(user.get('id'), 'updated',
+                        {'todos': [todo_event(todo_id, user.get('id'), todo_request)]})
 
 
 @router.delete("/todo/{todo_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_todo(user: user_dependency, db: db_dependency, todo_id: int = Path(gt=0)):
+async def delete_todo(user: user_dependency, db: todos_db_dependency, todo_id: int = Path(gt=0)):
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
-    todo_model = db.query(Todos).filter(Todos.id == todo_id)\
-        .filter(Todos.owner_id == user.get('id')).first()
-    if todo_model is None:
+    if not await run(db, delete_owned_todo, todo_id, user.get('id')):
         raise HTTPException(status_code=404, detail='Todo not found')
-    db.query(Todos).filter(Todos.id == todo_id).filter(Todos.owner_id == user.get('id'))    .delete()
-
-    db.commit()
-
-
+    await todos_changed(user.get('id'), 'deleted', {'ids': [todo_id]})
@@ -1,67 +1,93 @@
+import os
 from fastapi import APIRouter, Depends, HTTPException, Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
+from sqlalchemy import select, update
 from sqlalchemy.orm import Session
-from typing import Annotated
+from typing import Optional
 from starlette import status
 import models
-from models import Todos, Users
-from database import SessionLocal
-from routers import auth
-from .auth import get_current_user
-from passlib.context import CryptContext
-
-router = APIRouter()
-router.include_router(auth.router)
+from models import RefreshTokens, Todos, Users
+from database import execute_write, recent_writes, run
+from dependencies import db_dependency, read_db_dependency, user_dependency
+from hashing import password_hasher
+from rate_limit import UserRateLimit
+from user_cache import get_user_row, user_cache
 
 router = APIRouter(
     prefix='/user',  # dividing the operations according to their file
     tags=['user']
 )
 
-
-def get_db():
-    # create db dependency
-    # before each request, we now need to fetch this db session local and be able to open up the
-    # connection and close the connection on every request send to this fast api application
-    db = SessionLocal()
-    try:
-        # only the code prior to and including yield statement is executed before sending a response
-        # the code following the yield statement, is executed after the response has been delivered.
-        yield db
-    finally:
-        db.close()
+# a password change runs bcrypt twice (verify + hash), see rate_limit.py
+PASSWORD_CHANGE_RATE_LIMIT_PER_IP = os.getenv('PASSWORD_CHANGE_RATE_LIMIT_PER_IP', '20/minute')
+PASSWORD_CHANGE_RATE_LIMIT_PER_USER = os.getenv('PASSWORD_CHANGE_RATE_LIMIT_PER_USER', '5/minute')
 
 
-db_dependency = Annotated[Session, Depends(get_db)]
-user_dependency = Annotated[dict, Depends(get_current_user)]
-bcrypt_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
-
 class UserVerification(BaseModel):
     password: str
     new_password: str = Field(min_length= 6)
 
 
 
-@router.get("/", status_code=status.HTTP_200_OK)
-async def get_user(user:user_dependency, db: db_dependency):
+# hashed_password is never part of the response
+class UserResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    email: Optional[str]
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+    is_active: Optional[bool]
+    role: Optional[str]
+    phone_number: Optional[str]
+
+
+def get_password_hash(db: Session, user_id: int):
+    # always from the database, the cached user rows do not have it
+    return db.scalar(select(Users.hashed_password).where(Users.id == user_id))
+
+
+# the row itself comes from user_cache.get_user_row (cached per id), and the writes below are a
+# single UPDATE by id, no SELECT of the row first. Every one of them must invalidate the cache
+def update_user(db: Session, user_id: int, values: dict, revoke_refresh_tokens: bool = False):
+    updated = execute_write(db, update(Users).where(Users.id == user_id).values(**values), Users.id)
+    if revoke_refresh_tokens:
+        # new password: the refresh tokens handed out with the old one must not work anymore
+        db.execute(update(RefreshTokens).where(RefreshTokens.user_id == user_id)
+                   .values(revoked=True))
+    db.commit()
+    return updated > 0
+
+
+@router.get("/", status_code=status.HTTP_200_OK, response_model=UserResponse)
+async def get_user(user:user_dependency, db: read_db_dependency):
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
-    return db.query(Users).filter(Users.id == user.get('id')).first()
+    # response_model keeps only the UserResponse fields, the password hash is never sent
+    return await get_user_row(db, user.get('id'))
 
 
 # change the password with validation
-@router.put("/password", status_code=status.HTTP_204_NO_CONTENT)
+@router.put("/password", status_code=status.HTTP_204_NO_CONTENT,
+            dependencies=[Depends(UserRateLimit('password',
+                                                per_ip=PASSWORD_CHANGE_RATE_LIMIT_PER_IP,
+                                                per_username=PASSWORD_CHANGE_RATE_LIMIT_PER_USER))])
 async def change_password(user: user_dependency, db: db_dependency,
                           user_verification: UserVerification):
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
-    user_model = db.query(Users).filter(Users.id == user.get('id')).first()
+    hashed_password = await run(db, get_password_hash, user.get('id'))
+    if hashed_password is None:
+        raise HTTPException(status_code=401, detail='Authentication Failed')
 
-    if not bcrypt_context.verify(user_verification.password, user_model.hashed_password):
+    if not await password_hasher.verify(user_verification.password, hashed_password):
         raise HTTPException(status_code=401, detail='Error on Password Change')
-    user_model.hashed_password = bcrypt_context.hash(user_verification.new_password)
-    db.add(user_model)
-    db.commit()
+    hashed_password = await password_hasher.hash(user_verification.new_password)
+    await run(db, update_user, user.get('id'), {'hashed_password': hashed_password},
+              revoke_refresh_tokens=True)
+    await recent_writes.mark(user.get('id'))
+    await user_cache.invalidate(user.get('id'))
 
 
 @router.put("/phonenumber/{phone_number}", status_code=status.HTTP_204_NO_CONTENT)
@@ -69,9 +95,8 @@ async def change_phone_number(user: user_dependency, db: db_dependency,
                               phone_number: str):
     if user is None:
         raise HTTPException(status_code=401, detail='Authentication Failed')
-    user_model = db.query(Users).filter(Users.id == user.get('id')).first()
-
-    user_model.phone_number = phone_number
-    db.add(user_model)
-    db.commit()
+    await run(db, update_user, user.get('id'), {'phone_number': phone_number})
+    # GET /user reads from a replica, which may not have the new number yet
+    await recent_writes.mark(user.get('id'))
+    await user_cache.invalidate(user.get('id'))
 
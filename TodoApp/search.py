@@ -0,0 +1,133 @@
+import logging
+import re
+from sqlalchemy import and_, column, exc, func, inspect, literal, literal_column, or_, select, \
+    table, text, tuple_
+from database import PerDatabase
+from models import Todos
+
+# Full text search over the title and description of the todos (GET /todo/search).
+#
+#   SQLite     -- an FTS5 table 'todos_fts' which only holds the index (content='todos'), kept
+#                 in sync by triggers on todos. Triggers and not ORM events, because the bulk
+#                 endpoints and the single row UPDATE / DELETE statements never load ORM objects.
+#   PostgreSQL -- a generated tsvector column 'search_vector' on todos with a GIN index, the
+#                 database keeps it up to date by itself.
+#   anything else (or SQLite built without FTS5) -- LIKE on every word, not ranked.
+#
+# The alembic migration d4e7b2c9a615 creates the same objects; ensure_search_index() below is
+# for databases made by create_all.
+
+logger = logging.getLogger('todoapp.search')
+
+# a title match counts more than a description match
+TITLE_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+POSTGRES_TEXT_SEARCH_CONFIG = 'english'
+
+SQLITE_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS todos_fts USING fts5("
+    "title, description, content='todos', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS todos_fts_ai AFTER INSERT ON todos BEGIN "
+    "INSERT INTO todos_fts(rowid, title, description) "
+    "VALUES (new.id, new.title, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS todos_fts_ad AFTER DELETE ON todos BEGIN "
+    "INSERT INTO todos_fts(todos_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS todos_fts_au AFTER UPDATE OF title, description ON todos BEGIN "
+    "INSERT INTO todos_fts(todos_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); "
+    "INSERT INTO todos_fts(rowid, title, description) "
+    "VALUES (new.id, new.title, new.description); END",
+)
+# fills the index from the rows which were there before the table / triggers
+SQLITE_SEARCH_REBUILD = "INSERT INTO todos_fts(todos_fts) VALUES ('rebuild')"
+
+POSTGRES_SEARCH_DDL = (
+    "ALTER TABLE todos ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+    f"setweight(to_tsvector('{POSTGRES_TEXT_SEARCH_CONFIG}', coalesce(title, '')), 'A') || "
+    f"setweight(to_tsvector('{POSTGRES_TEXT_SEARCH_CONFIG}', coalesce(description, '')), 'B')"
+    ") STORED",
+    "CREATE INDEX IF NOT EXISTS ix_todos_search_vector ON todos USING GIN (search_vector)",
+)
+
+todos_fts = table('todos_fts', column('rowid'))
+
+
+def ensure_search_index(sync_engine):
+    dialect = sync_engine.dialect.name
+    try:
+        with sync_engine.begin() as connection:
+            if dialect == 'sqlite':
+                created = not inspect(connection).has_table('todos_fts')
+                for statement in SQLITE_SEARCH_DDL:
+                    connection.execute(text(statement))
+                if created:
+                    connection.execute(text(SQLITE_SEARCH_REBUILD))
+            elif dialect == 'postgresql':
+                for statement in POSTGRES_SEARCH_DDL:
+                    connection.execute(text(statement))
+    except exc.OperationalError as error:
+        # e.g. "no such module: fts5", search falls back to LIKE then
+        logger.warning('full text search index not available: %s', error)
+    _backends.forget(sync_engine)
+
+
+def find_search_backend(db) -> str:
+    dialect = db.get_bind().dialect.name
+    connection = db.connection()
+    if dialect == 'sqlite' and inspect(connection).has_table('todos_fts'):
+        return 'fts5'
+    if dialect == 'postgresql' and any(
+            col['name'] == 'search_vector' for col in inspect(connection).get_columns('todos')):
+        return 'tsvector'
+    return 'like'
+
+
+# 'fts5' / 'tsvector' / 'like', looked up once per database
+_backends = PerDatabase(find_search_backend)
+
+
+def search_backend(db) -> str:
+    return _backends.get(db)
+
+
+def search_terms(query: str) -> list:
+    # only words go to the database, so no user input can break the FTS5 / tsquery syntax
+    return re.findall(r'\w+', query.lower())
+
+
+def search_todos(db, columns, owner_id: int, terms: list, limit: int, last, complete):
+    # Rows come ordered by 'score' (lower is better) and then id, and the page after
+    # (last score, last id) is a keyset seek like GET /. A write between two pages can change
+    # the scores, the same as any ranked result which is paged.
+    backend = search_backend(db)
+    if backend == 'fts5':
+        # every word also as a prefix, so "milk" finds "milkshake" too (the exact word ranks higher)
+        match = ' AND '.join(f'("{term}" OR "{term}"*)' for term in terms)
+        score = func.bm25(literal_column('todos_fts'), TITLE_WEIGHT, DESCRIPTION_WEIGHT)
+        query = select(*columns, score.label('score'))\
+            .select_from(todos_fts.join(Todos, Todos.id == todos_fts.c.rowid))\
+            .where(literal_column('todos_fts').op('MATCH')(match))
+    elif backend == 'tsvector':
+        tsquery = func.websearch_to_tsquery(
+            literal_column(f"'{POSTGRES_TEXT_SEARCH_CONFIG}'::regconfig"), ' '.join(terms))
+        search_vector = literal_column('todos.search_vector')
+        # ts_rank_cd is higher for better matches, negated so that lower is better everywhere
+        query = select(*columns, (-func.ts_rank_cd(search_vector, tsquery)).label('score'))\
+            .where(search_vector.op('@@')(tsquery))
+    else:
+        query = select(*columns, literal(0.0).label('score')).where(and_(*(
+            or_(func.lower(Todos.title).contains(term, autoescape=True),
+                func.lower(Todos.description).contains(term, autoescape=True))
+            for term in terms)))
+    query = query.where(Todos.owner_id == owner_id)
+    if complete is not None:
+        query = query.where(Todos.complete == complete)
+
+    ranked = query.subquery()
+    page = select(*(ranked.c[col.key] for col in columns))
+    if last is not None:
+        page = page.where(tuple_(ranked.c.score, ranked.c.id) > tuple_(last['r'], last['id']))
+    page = page.add_columns(ranked.c.score).order_by(ranked.c.score, ranked.c.id).limit(limit)
+    return db.execute(page).all()
@@ -0,0 +1,108 @@
+# Runs the app with several uvicorn workers, and the in-memory stores (read cache, rate limit
+# buckets, revoked tokens, user rows) in one place all workers share. Run it from the TodoApp
+# folder:
+#
+#   python serve.py --workers 4 --state sqlite
+#   python serve.py --workers 4 --state redis --redis-url redis://localhost:6379
+#
+# --state memory keeps the old per process stores, that is only right with --workers 1.
+# The change feed (GET /todo/events, see change_feed.py) goes through redis pub/sub as soon as
+# there is more than one worker; without --redis-url a local stand-in is the broker.
+import argparse
+import logging
+import os
+import secrets
+import threading
+
+logger = logging.getLogger('todoapp.serve')
+
+STATES = ('memory', 'shared-memory', 'sqlite', 'redis')
+
+
+def start_redis_stand_in():
+    # a redis speaking server inside this process (fakeredis), for trying the 'redis' state
+    # on a machine without a redis server. Not for production, every command takes the GIL of
+    # the supervisor process
+    from fakeredis import TcpFakeServer
+
+    server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='redis-stand-in', daemon=True).start()
+    host, port = server.server_address
+    return server, f'redis://{host}:{port}'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int,
+                        default=int(os.getenv('WEB_CONCURRENCY', os.cpu_count() or 1)))
+    parser.add_argument('--state', choices=STATES, default=os.getenv('STATE_BACKEND', 'memory'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--redis-url', help='redis server for --state redis (default: start a '
+                                            'local stand-in), the stores use databases 0-2')
+    parser.add_argument('--feed', choices=('memory', 'redis'),
+                        help='change feed backend (default: redis with --state redis or more '
+                             'than one worker, else memory)')
+    # open event streams never end by themselves, uvicorn would wait for them forever when it
+    # shuts down; after this many seconds it closes them (the clients reconnect elsewhere)
+    parser.add_argument('--graceful-timeout', type=int, default=10)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # everything below goes to the workers through the environment, so it has to be set
+    # before the app modules are imported (they read their settings on import)
+    os.environ['STATE_BACKEND'] = args.state
+    if not os.getenv('SECRET_KEY'):
+        # a token signed by one worker has to verify on the others
+        logger.warning('SECRET_KEY is not set, using a random key until the server stops')
+        os.environ['SECRET_KEY'] = secrets.token_hex(32)
+    feed = args.feed or ('redis' if args.state == 'redis' or args.workers > 1 else 'memory')
+    os.environ['CHANGE_FEED_BACKEND'] = feed
+    stand_in = manager = None
+    if args.state == 'memory' and args.workers > 1:
+        logger.warning('--state memory with %d workers: every worker keeps its own cache, rate '
+                       'limits and revoked tokens', args.workers)
+    if args.state == 'shared-memory':
+        from shared_state import start_manager
+
+        manager, manager_env = start_manager()
+        os.environ.update(manager_env)
+    if args.state == 'redis' or feed == 'redis':
+        redis_url = args.redis_url
+        if redis_url is None:
+            stand_in, redis_url = start_redis_stand_in()
+            logger.info('started a local redis stand-in on %s', redis_url)
+        redis_url = redis_url.rstrip('/')
+        if args.state == 'redis':
+            os.environ.setdefault('READ_CACHE_URL', f'{redis_url}/0')
+            os.environ.setdefault('RATE_LIMIT_URL', f'{redis_url}/1')
+            os.environ.setdefault('STATE_REDIS_URL', f'{redis_url}/2')
+        os.environ.setdefault('CHANGE_FEED_URL', f'{redis_url}/2')
+    # bcrypt threads are per worker, together they should not be more than the cores we have
+    os.environ.setdefault('PASSWORD_HASH_WORKERS',
+                          str(max(1, (os.cpu_count() or 1) // max(1, args.workers))))
+
+    # the schema is made once, here, instead of by N workers racing each other at startup
+    import main as app_main
+    from database import engine
+
+    app_main.prepare_database()
+    engine.dispose()
+    os.environ['DB_CREATE_ALL'] = 'false'
+
+    import uvicorn
+
+    try:
+        uvicorn.run('main:app', host=args.host, port=args.port, workers=args.workers,
+                    timeout_graceful_shutdown=args.graceful_timeout,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
+    finally:
+        if stand_in is not None:
+            stand_in.shutdown()
+        if manager is not None:
+            manager.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,527 @@
+import argparse
+import asyncio
+import bisect
+import hashlib
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from sqlalchemy import delete, func, inspect, insert, select, text, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+from database import create_engines, db_session, dispose_engine_pair, engine, pool_status, run
+from models import TodoIdBlocks, TodoShardOwners, TodoSyncVersions, TodoTombstones, Todos
+from todo_sync import has_sync_triggers
+
+# Todos split over several databases by owner -- DATABASE_SHARD_URLS=a=sqlite:///./shard_a.db,...
+# One database takes all the writes, and every todos query of a user is for their own todos
+# only (owner_id), so an owner's todos can live in a database of their own. Users, tokens and
+# the rest stay in the main database (DATABASE_URL); every shard gets the todos tables with
+# their triggers (stats, sync, search), all per shard.
+#
+# Which shard an owner is on: a consistent hash ring, every shard is on it
+# DATABASE_SHARD_VNODES times, an owner goes to the next point after the hash of their id.
+# Adding a shard only takes owners away from its neighbours on the ring, instead of reshuffling
+# everybody like owner_id % N would. The shards are found by name, so name them (name=url);
+# without a name an entry is shard_<position> and the order of the list must not change.
+#
+# Owners which are not on their ring shard (being moved, or moved on purpose) are listed in
+# todo_shard_owners in the main database. Every worker keeps a copy of it and reads it again
+# every DATABASE_SHARD_MAP_REFRESH seconds.
+#
+# The todo ids come from todo_id_blocks in the main database, a block of TODO_ID_BLOCK_SIZE ids
+# at a time per worker, so an id is unique over all shards and stays the same when its owner
+# moves (GET /todo/{id}, the clients' local copies and the admin routes rely on it).
+#
+# The admin routes ask every shard at the same time and merge the answers in id order.
+#
+# Moving owners, with the app running (python sharding.py --help):
+#
+#   python sharding.py status
+#   python sharding.py move --owner-id 7 --to b      # pin owner 7 to shard b
+#   python sharding.py pin                           # after DATABASE_SHARD_URLS changed, below
+#   python sharding.py rebalance [--dry-run]         # every pinned owner to their ring shard
+#   python sharding.py purge --owner-id 7 --shard a  # leftovers of a move which stopped halfway
+#
+# A move marks the owner as moving (their writes get 503 for the moment, the reads go on),
+# waits until every worker has seen that, copies the rows and tombstones to the new shard,
+# switches the owner over, waits again and then deletes the old rows.
+#
+# Adding a shard: run `pin` with the new DATABASE_SHARD_URLS first -- every owner the new ring
+# would send elsewhere is pinned to where their todos are now. Then start the app with the new
+# list (so nobody's todos seem to vanish) and run `rebalance`. Starting to shard an existing
+# database is the same, with that database as one of the shards.
+#
+# For trying it locally any number of SQLite files works:
+#
+#   DATABASE_SHARD_URLS=a=sqlite:///./shard_a.db,b=sqlite:///./shard_b.db uvicorn main:app
+
+DATABASE_SHARD_URLS = os.getenv('DATABASE_SHARD_URLS', '')
+DATABASE_SHARD_VNODES = int(os.getenv('DATABASE_SHARD_VNODES', 128))
+DATABASE_SHARD_MAP_REFRESH = float(os.getenv('DATABASE_SHARD_MAP_REFRESH', 5))  # seconds
+TODO_ID_BLOCK_SIZE = int(os.getenv('TODO_ID_BLOCK_SIZE', 1000))
+
+# what a move copies, the triggers of the new shard fill in version / updated_at
+MOVE_COLUMNS = (Todos.id, Todos.title, Todos.description, Todos.priority, Todos.complete,
+                Todos.owner_id)
+MOVE_BATCH_SIZE = 1000
+
+logger = logging.getLogger('todoapp.sharding')
+
+
+def parse_shard_urls(value: str) -> dict:
+    # 'a=sqlite:///./a.db,b=postgresql://...' -> {'a': url, 'b': url}, unnamed ones by position
+    shards = {}
+    entries = [entry.strip() for entry in value.split(',') if entry.strip()]
+    for index, entry in enumerate(entries):
+        name, _, url = entry.partition('=')
+        # the '=' of a query string (?sslmode=require) is not a name
+        if not url or ':' in name or '/' in name:
+            name, url = f'shard_{index}', entry
+        shards[name.strip()] = url.strip()
+    return shards
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+
+    def __init__(self, names, vnodes: int = DATABASE_SHARD_VNODES):
+        points = sorted((ring_hash(f'{name}#{point}'), name)
+                        for name in names for point in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def lookup(self, owner_id: int) -> str:
+        index = bisect.bisect(self._hashes, ring_hash(str(owner_id))) % len(self._hashes)
+        return self._names[index]
+
+
+class Shard:
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = make_url(url).render_as_string(hide_password=True)
+        self.sync_engine, self.engine = create_engines(url)
+
+    def stats(self) -> dict:
+        request_engine = self.engine if self.engine is self.sync_engine \
+            else self.engine.sync_engine
+        return dict(pool_status(request_engine), url=self.url)
+
+
+class ShardMap:
+
+    def __init__(self, urls: dict):
+        self.shards = {name: Shard(name, url) for name, url in urls.items()}
+        self.ring = HashRing(self.shards) if self.shards else None
+        self.pinned = {}  # owner_id -> shard name, from todo_shard_owners
+        self.moving = set()
+        self.refreshed_at = None
+        self._refresher = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.shards)
+
+    def home(self, owner_id: int) -> str:
+        # the shard the ring gives the owner
+        return self.ring.lookup(owner_id)
+
+    def locate(self, owner_id: int) -> str:
+        return self.pinned.get(owner_id) or self.home(owner_id)
+
+    def shard_for(self, owner_id: int) -> Shard:
+        return self.shards[self.locate(owner_id)]
+
+    def is_moving(self, owner_id: int) -> bool:
+        return owner_id in self.moving
+
+    def load(self, connection):
+        pinned, moving = {}, set()
+        for owner_id, shard, is_moving in connection.execute(
+                select(TodoShardOwners.owner_id, TodoShardOwners.shard, TodoShardOwners.moving)):
+            if shard not in self.shards:
+                # better a 500 for this owner than reads and writes on the wrong database
+                logger.error('owner %s is pinned to shard %r, which is not in '
+                             'DATABASE_SHARD_URLS', owner_id, shard)
+            pinned[owner_id] = shard
+            if is_moving:
+                moving.add(owner_id)
+        self.pinned, self.moving = pinned, moving
+        self.refreshed_at = time.time()
+
+    def refresh(self):
+        with engine.connect() as connection:
+            self.load(connection)
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(DATABASE_SHARD_MAP_REFRESH)
+            try:
+                await run_in_threadpool(self.refresh)
+            except Exception:
+                # keep routing with the copy we have, the next refresh may work again
+                logger.warning('could not refresh the shard map', exc_info=True)
+
+    async def start(self):
+        if self.enabled and self._refresher is None:
+            await run_in_threadpool(self.refresh)
+            self._refresher = asyncio.create_task(self._refresh_forever())
+
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+        for shard in self.shards.values():
+            await dispose_engine_pair(shard.sync_engine, shard.engine)
+
+    def stats(self) -> dict:
+        return {
+            'shards': {name: shard.stats() for name, shard in self.shards.items()},
+            'pinned': len(self.pinned),
+            'moving': len(self.moving),
+            'refreshed_at': self.refreshed_at,
+        }
+
+
+shard_map = ShardMap(parse_shard_urls(DATABASE_SHARD_URLS))
+
+
+def todo_engines() -> list:
+    # (name, sync engine) of every database with todos in it, for the maintenance scripts
+    if not shard_map.enabled:
+        return [('main', engine)]
+    return [(name, shard.sync_engine) for name, shard in shard_map.shards.items()]
+
+
+async def on_every_shard(fn, *args):
+    # fn(db, *args) on every shard at the same time, the results in the order of the shards
+    async def on_shard(shard):
+        async with db_session(bind=shard.engine) as db:
+            return await run(db, fn, *args)
+
+    return await asyncio.gather(*(on_shard(shard) for shard in shard_map.shards.values()))
+
+
+def merge_by_id(parts, key=lambda row: row.id):
+    # the id ordered results of the shards as one id ordered stream
+    return heapq.merge(*parts, key=key)
+
+
+def drop_owner_foreign_key(sync_engine):
+    # todos.owner_id references users, which are in the main database and not in the shard
+    if sync_engine.dialect.name == 'postgresql':
+        with sync_engine.begin() as connection:
+            connection.execute(text('ALTER TABLE todos DROP CONSTRAINT IF EXISTS '
+                                    'todos_owner_id_fkey'))
+
+
+class TodoIds:
+    # Unique todo ids over all shards: a worker takes a whole block of ids from todo_id_blocks
+    # in one short transaction and hands them out from memory, so it is one write on the main
+    # database per TODO_ID_BLOCK_SIZE new todos, not one per todo. The ids of a block which a
+    # worker did not use before it stopped are skipped, gaps are fine.
+
+    def __init__(self, block_size: int = TODO_ID_BLOCK_SIZE):
+        self.block_size = block_size
+        self._next = self._end = 0
+        self._lock = threading.Lock()
+        self.blocks = 0
+
+    def reserve_block(self) -> int:
+        with engine.begin() as connection:
+            # the UPDATE locks the row until commit, so no two workers get the same block
+            connection.execute(update(TodoIdBlocks).where(TodoIdBlocks.id == 1)
+                               .values(next_block=TodoIdBlocks.next_block + 1))
+            block = connection.execute(select(TodoIdBlocks.next_block)
+                                       .where(TodoIdBlocks.id == 1)).scalar()
+        if block is None:
+            raise RuntimeError('todo_id_blocks is empty, run prepare_database() first')
+        self.blocks += 1
+        return block - 1
+
+    def take(self, count: int) -> list:
+        ids = []
+        with self._lock:
+            while len(ids) < count:
+                if self._next >= self._end:
+                    block = self.reserve_block()
+                    self._next, self._end = block * self.block_size, (block + 1) * self.block_size
+                taken = min(count - len(ids), self._end - self._next)
+                ids.extend(range(self._next, self._next + taken))
+                self._next += taken
+        return ids
+
+    async def allocate(self, count: int):
+        # None without shards: the database numbers the todos itself as before
+        if not shard_map.enabled:
+            return None
+        if self._end - self._next >= count:
+            # the common case, no thread hop for it
+            with self._lock:
+                if self._end - self._next >= count:
+                    ids = list(range(self._next, self._next + count))
+                    self._next += count
+                    return ids
+        return await run_in_threadpool(self.take, count)
+
+
+todo_ids = TodoIds()
+
+
+def ensure_id_blocks():
+    # the first block starts after every todo id there is already (in the main database and in
+    # the shards), tombstones included, so an old id never comes back
+    with engine.begin() as connection:
+        if connection.execute(select(TodoIdBlocks.next_block)
+                              .where(TodoIdBlocks.id == 1)).first() is not None:
+            return
+    highest = 0
+    for sync_engine in [engine] + [shard.sync_engine for shard in shard_map.shards.values()]:
+        with sync_engine.connect() as connection:
+            tables = inspect(connection).get_table_names()
+            for table, column in (('todos', Todos.id), ('todo_tombstones', TodoTombstones.id)):
+                if table in tables:
+                    highest = max(highest, connection.execute(select(func.max(column))).scalar()
+                                  or 0)
+    try:
+        with engine.begin() as connection:
+            connection.execute(insert(TodoIdBlocks).values(
+                id=1, next_block=highest // TODO_ID_BLOCK_SIZE + 1))
+    except IntegrityError:
+        pass  # another worker was first
+
+
+# Moving owners between shards. These run in the maintenance script, with their own view of
+# todo_shard_owners; the workers see the changes within DATABASE_SHARD_MAP_REFRESH seconds.
+
+def set_pins(pins: dict, moving: bool):
+    # owner_id -> shard name
+    if not pins:
+        return
+    with engine.begin() as connection:
+        connection.execute(delete(TodoShardOwners)
+                           .where(TodoShardOwners.owner_id.in_(list(pins))))
+        connection.execute(insert(TodoShardOwners), [
+            {'owner_id': owner_id, 'shard': shard, 'moving': moving}
+            for owner_id, shard in pins.items()])
+
+
+def drop_pins(owner_ids):
+    if not owner_ids:
+        return
+    with engine.begin() as connection:
+        connection.execute(delete(TodoShardOwners)
+                           .where(TodoShardOwners.owner_id.in_(list(owner_ids))))
+
+
+def owner_rows(sync_engine) -> dict:
+    # owner_id -> number of todos, of every owner with todos or tombstones in this database
+    with sync_engine.connect() as connection:
+        owners = dict(connection.execute(select(Todos.owner_id, func.count())
+                                         .group_by(Todos.owner_id)).all())
+        for (owner_id,) in connection.execute(select(TodoTombstones.owner_id).distinct()):
+            owners.setdefault(owner_id, 0)
+    owners.pop(None, None)
+    return owners
+
+
+def copy_owner(owner_id: int, source: Shard, target: Shard) -> int:
+    with source.sync_engine.connect() as connection:
+        rows = [dict(row._mapping) for row in connection.execute(
+            select(*MOVE_COLUMNS).where(Todos.owner_id == owner_id).order_by(Todos.id))]
+        tombstones = connection.execute(
+            select(TodoTombstones.id, TodoTombstones.deleted_at)
+            .where(TodoTombstones.owner_id == owner_id).order_by(TodoTombstones.version)).all()
+        source_version, source_pruned = connection.execute(
+            select(TodoSyncVersions.value, TodoSyncVersions.pruned)
+            .where(TodoSyncVersions.owner_id == owner_id)).first() or (0, 0)
+
+    with target.sync_engine.begin() as connection:
+        # whatever an earlier move which stopped halfway left here
+        connection.execute(delete(Todos).where(Todos.owner_id == owner_id))
+        connection.execute(delete(TodoTombstones).where(TodoTombstones.owner_id == owner_id))
+        if has_sync_triggers(connection):
+            # The owner's clients send versions of the source as `since`. The owner's counter
+            # on the target goes on after the higher of both, so every moved row and tombstone
+            # gets a version above anything they have seen: they get the todos again, and miss
+            # no delete. A client which synced before the pruned tombstones still gets 410.
+            version = max(connection.execute(
+                select(TodoSyncVersions.value)
+                .where(TodoSyncVersions.owner_id == owner_id)).scalar() or 0, source_version)
+            if tombstones:
+                connection.execute(insert(TodoTombstones), [
+                    {'id': todo_id, 'owner_id': owner_id, 'version': version + number,
+                     'deleted_at': deleted_at}
+                    for number, (todo_id, deleted_at) in enumerate(tombstones, start=1)])
+            connection.execute(delete(TodoSyncVersions)
+                               .where(TodoSyncVersions.owner_id == owner_id))
+            connection.execute(insert(TodoSyncVersions).values(
+                owner_id=owner_id, value=version + len(tombstones), pruned=source_pruned))
+        for start in range(0, len(rows), MOVE_BATCH_SIZE):
+            connection.execute(insert(Todos), rows[start:start + MOVE_BATCH_SIZE])
+    return len(rows)
+
+
+def delete_owner(owner_id: int, shard: Shard):
+    with shard.sync_engine.begin() as connection:
+        connection.execute(delete(Todos).where(Todos.owner_id == owner_id))
+        connection.execute(delete(TodoTombstones).where(TodoTombstones.owner_id == owner_id))
+        # after the todos, their delete trigger counts up the owner's counter once more
+        connection.execute(delete(TodoSyncVersions).where(TodoSyncVersions.owner_id == owner_id))
+
+
+def place_owners(owners: dict):
+    # owner_id -> shard name, as the place the workers route them to from now on
+    drop_pins([owner_id for owner_id, name in owners.items() if name == shard_map.home(owner_id)])
+    set_pins({owner_id: name for owner_id, name in owners.items()
+              if name != shard_map.home(owner_id)}, moving=False)
+
+
+def move_owners(moves: dict, wait: float = None, log=print) -> int:
+    # owner_id -> target shard name. Returns the number of todos moved.
+    wait = 2 * DATABASE_SHARD_MAP_REFRESH if wait is None else wait
+    shard_map.refresh()
+    sources = {owner_id: shard_map.shard_for(owner_id) for owner_id in moves}
+    # a move which stopped before the switch: the todos are still all on the source
+    place_owners({owner_id: target for owner_id, target in moves.items()
+                  if sources[owner_id].name == target and shard_map.is_moving(owner_id)})
+    moves = {owner_id: shard_map.shards[target] for owner_id, target in moves.items()
+             if sources[owner_id].name != target}
+    if not moves:
+        return 0
+
+    # 1. their writes stop (the reads still go to the source)
+    set_pins({owner_id: sources[owner_id].name for owner_id in moves}, moving=True)
+    log(f'{len(moves)} owners marked as moving, waiting {wait:.0f}s for the workers')
+    time.sleep(wait)
+
+    # 2. copy, 3. switch them over
+    moved = 0
+    for owner_id, target in moves.items():
+        count = copy_owner(owner_id, sources[owner_id], target)
+        moved += count
+        log(f'owner {owner_id}: {count} todos copied {sources[owner_id].name} -> {target.name}')
+    place_owners({owner_id: target.name for owner_id, target in moves.items()})
+    log(f'switched over, waiting {wait:.0f}s until no worker reads the old shards')
+    time.sleep(wait)
+
+    # 4. the old rows go
+    for owner_id in moves:
+        delete_owner(owner_id, sources[owner_id])
+    return moved
+
+
+def pin_owners(log=print) -> int:
+    # every owner with todos on another shard than the ring (and the pins) give them is pinned
+    # to where their todos are
+    shard_map.refresh()
+    found = {}
+    for name, shard in shard_map.shards.items():
+        for owner_id in owner_rows(shard.sync_engine):
+            found.setdefault(owner_id, []).append(name)
+    pins = {}
+    for owner_id, names in found.items():
+        if len(names) > 1:
+            log(f'owner {owner_id} has todos on {", ".join(names)}, not pinned (a move which '
+                f'stopped halfway? see `status` and `purge`)')
+        elif names[0] != shard_map.locate(owner_id):
+            pins[owner_id] = names[0]
+    set_pins(pins, moving=False)
+    return len(pins)
+
+
+def purge_owner(owner_id: int, name: str):
+    # the copy a move which stopped after the switch left behind
+    shard_map.refresh()
+    if shard_map.locate(owner_id) == name:
+        raise ValueError(f'owner {owner_id} is routed to {name}, those are the todos in use')
+    delete_owner(owner_id, shard_map.shards[name])
+
+
+def shard_status(log=print):
+    shard_map.refresh()
+    for name, shard in shard_map.shards.items():
+        owners = owner_rows(shard.sync_engine)
+        strays = [owner_id for owner_id in owners if shard_map.locate(owner_id) != name]
+        log(f'{name} ({shard.url}): {len(owners)} owners, {sum(owners.values())} todos'
+            + (f', todos of {len(strays)} owners routed elsewhere: {sorted(strays)[:20]}'
+               if strays else ''))
+    for owner_id, name in sorted(shard_map.pinned.items()):
+        log(f'owner {owner_id}: pinned to {name} (ring: {shard_map.home(owner_id)})'
+            + (', moving' if shard_map.is_moving(owner_id) else ''))
+
+
+def batches(items, size: int):
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Todo shards: where the owners are, moving them')
+    parser.add_argument('--wait', type=float, default=None,
+                        help='seconds to wait for the workers to see a change '
+                             '(default 2 x DATABASE_SHARD_MAP_REFRESH)')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    subcommands.add_parser('status', help='owners and todos per shard, the pinned owners')
+    move = subcommands.add_parser('move', help="move an owner's todos to another shard")
+    move.add_argument('--owner-id', type=int, required=True)
+    move.add_argument('--to', required=True)
+    purge = subcommands.add_parser('purge', help="delete an owner's todos from a shard they "
+                                                 "are not routed to")
+    purge.add_argument('--owner-id', type=int, required=True)
+    purge.add_argument('--shard', required=True)
+    subcommands.add_parser('pin', help='pin every owner to the shard their todos are on')
+    rebalance = subcommands.add_parser('rebalance',
+                                       help='move the pinned owners to their ring shard')
+    rebalance.add_argument('--batch', type=int, default=100, help='owners moved together')
+    rebalance.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if not shard_map.enabled:
+        parser.error('DATABASE_SHARD_URLS is not set')
+    if args.command == 'status':
+        shard_status()
+    elif args.command == 'move':
+        if args.to not in shard_map.shards:
+            parser.error(f'no shard {args.to!r}, there are: {", ".join(shard_map.shards)}')
+        moved = move_owners({args.owner_id: args.to}, args.wait)
+        print(f'{moved} todos moved')
+    elif args.command == 'purge':
+        if args.shard not in shard_map.shards:
+            parser.error(f'no shard {args.shard!r}, there are: {", ".join(shard_map.shards)}')
+        try:
+            purge_owner(args.owner_id, args.shard)
+        except ValueError as error:
+            parser.error(str(error))
+        print(f'todos of owner {args.owner_id} deleted from {args.shard}')
+    elif args.command == 'pin':
+        print(f'{pin_owners()} owners pinned')
+    elif args.command == 'rebalance':
+        shard_map.refresh()
+        moves = {owner_id: shard_map.home(owner_id) for owner_id, name in
+                 sorted(shard_map.pinned.items()) if name != shard_map.home(owner_id)
+                 or shard_map.is_moving(owner_id)}
+        if args.dry_run:
+            for owner_id, target in moves.items():
+                print(f'owner {owner_id}: {shard_map.locate(owner_id)} -> {target}')
+            return
+        moved = 0
+        for batch in batches(moves.items(), args.batch):
+            moved += move_owners(dict(batch), args.wait)
+        # pins which say the same as the ring
+        drop_pins([owner_id for owner_id, name in shard_map.pinned.items()
+                   if name == shard_map.home(owner_id) and not shard_map.is_moving(owner_id)])
+        print(f'{len(moves)} owners, {moved} todos moved')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+import json
+import math
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+from starlette.concurrency import run_in_threadpool
+
+# The read cache, the rate limit buckets, the revoked tokens and the user rows are kept in
+# memory by default, which is only right with a single worker: with `uvicorn --workers 4` every
+# worker has its own copy, so a token revoked on one worker still works on the other three, and
+# every worker hands out its own 5 logins per minute. Run several workers through serve.py and
+# pick one of these, every store then lives outside the workers:
+#
+# 'shared-memory' -- a manager process started by serve.py keeps it in its memory, the workers
+#                    talk to it over a local socket (multiprocessing.managers)
+# 'sqlite'        -- a small WAL mode SQLite file next to the app, no extra process at all
+# 'redis'         -- a redis server (or anything speaking its protocol), serve.py starts a
+#                    local stand-in when none is given
+#
+# Every store has the same async methods, the ones read_cache.py and rate_limit.py already
+# expect from their backends: get / set / delete / get_counter / incr / take / size.
+
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')  # 'memory', 'shared-memory', 'sqlite', 'redis'
+SHARED_BACKENDS = ('shared-memory', 'sqlite', 'redis')
+STATE_SQLITE_PATH = os.getenv('STATE_SQLITE_PATH', './todoapp_state.db')
+STATE_SQLITE_BUSY_TIMEOUT = float(os.getenv('STATE_SQLITE_BUSY_TIMEOUT', 5))  # seconds
+STATE_REDIS_URL = os.getenv('STATE_REDIS_URL', 'redis://localhost:6379/2')
+# expired keys are swept out every this many writes
+STATE_SWEEP_INTERVAL = 1000
+
+
+def refill(value, burst: int, per_second: float, now: float):
+    # one step of the token bucket of rate_limit.py, value is the stored (tokens, at) or None.
+    # Returns the new value and the seconds to wait (0 when a token was taken)
+    tokens, at = value if value is not None else (burst, now)
+    tokens = min(burst, tokens + max(0.0, now - at) * per_second)
+    if tokens >= 1:
+        return (tokens - 1, now), 0.0
+    return (tokens, now), (1 - tokens) / per_second
+
+
+def bucket_ttl(burst: int, per_second: float) -> int:
+    # after that long the bucket is full again, so it can just as well be forgotten
+    return math.ceil(burst / per_second) + 1
+
+
+# the bucket of refill() as one atomic script, on the server's clock, so all workers share the
+# buckets; keys expire once the bucket would be full again anyway
+TAKE_SCRIPT = """
+local burst = tonumber(ARGV[1])
+local per_second = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or burst
+local at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * per_second)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / per_second
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / per_second) + 1)
+return tostring(wait)
+"""
+
+
+class StateTable:
+    # lives in the manager process; the manager serves every worker connection on its own
+    # thread, so every method holds the lock
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}  # key -> (expires or None, value)
+        self._writes = 0
+
+    def _get(self, key: str, now: float):
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] <= now:
+            del self._values[key]
+            return None
+        return entry[1]
+
+    def _put(self, key: str, value, expires):
+        self._values[key] = (expires, value)
+        self._writes += 1
+        if self._writes % STATE_SWEEP_INTERVAL == 0:
+            now = time.time()
+            for stale in [key for key, (expires, _) in self._values.items()
+                          if expires is not None and expires <= now]:
+                del self._values[stale]
+
+    def get(self, key: str):
+        with self._lock:
+            return self._get(key, time.time())
+
+    def set(self, key: str, value, ttl: int):
+        with self._lock:
+            self._put(key, value, time.time() + ttl)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            value = (self._get(key, time.time()) or 0) + 1
+            self._put(key, value, None)
+            return value
+
+    def take(self, key: str, burst: int, per_second: float) -> float:
+        with self._lock:
+            now = time.time()
+            value, wait = refill(self._get(key, now), burst, per_second, now)
+            self._put(key, value, now + bucket_ttl(burst, per_second))
+            return wait
+
+    def size(self, prefix: str) -> int:
+        with self._lock:
+            return sum(1 for key in self._values if key.startswith(prefix))
+
+
+_table = StateTable()
+
+
+def get_table():
+    return _table
+
+
+class StateManager(BaseManager):
+    pass
+
+
+StateManager.register('state_table', callable=get_table)
+
+
+def start_manager():
+    # called once by serve.py, before the workers are started. Returns the manager (keep a
+    # reference, it shuts the process down when collected) and the env vars for the workers
+    authkey = secrets.token_bytes(16)
+    manager = StateManager(address=('127.0.0.1', 0), authkey=authkey)
+    manager.start()
+    host, port = manager.address
+    return manager, {'STATE_MANAGER_ADDRESS': f'{host}:{port}',
+                     'STATE_MANAGER_AUTHKEY': authkey.hex()}
+
+
+_manager = None
+
+
+def connect_manager():
+    global _manager
+    if _manager is None:
+        # set by serve.py for its workers: 'host:port' of the manager process and its key (hex)
+        address = os.getenv('STATE_MANAGER_ADDRESS')
+        if not address:
+            raise RuntimeError("the 'shared-memory' state backend needs the manager of serve.py, "
+                               "STATE_MANAGER_ADDRESS is not set")
+        host, port = address.rsplit(':', 1)
+        _manager = StateManager(address=(host, int(port)),
+                                authkey=bytes.fromhex(os.getenv('STATE_MANAGER_AUTHKEY', '')))
+        _manager.connect()
+    return _manager
+
+
+class SharedMemoryStore:
+    # every call is one round trip over a local socket to the manager, usually tens of
+    # microseconds, but it blocks until the manager answers (and the first one connects), so
+    # the calls run on the threadpool instead of the event loop. The proxy opens one
+    # connection per thread by itself
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._proxy = None
+
+    @property
+    def _table(self):
+        # connected on first use, importing the app does not need the manager yet
+        if self._proxy is None:
+            self._proxy = connect_manager().state_table()
+        return self._proxy
+
+    def _call(self, method: str, *args):
+        return getattr(self._table, method)(*args)
+
+    async def get(self, key: str):
+        return await run_in_threadpool(self._call, 'get', self.prefix + key)
+
+    async def set(self, key: str, value, ttl: int):
+        await run_in_threadpool(self._call, 'set', self.prefix + key, value, ttl)
+
+    async def delete(self, key: str):
+        await run_in_threadpool(self._call, 'delete', self.prefix + key)
+
+    async def get_counter(self, key: str) -> int:
+        return await self.get(key) or 0
+
+    async def incr(self, key: str) -> int:
+        return await run_in_threadpool(self._call, 'incr', self.prefix + key)
+
+    async def take(self, key: str, burst: int, per_second: float) -> float:
+        return await run_in_threadpool(self._call, 'take', self.prefix + key, burst, per_second)
+
+    def size(self) -> int:
+        return self._table.size(self.prefix)
+
+
+class SqliteStore:
+    # one local file shared by all workers. The statements touch a single row by primary key,
+    # but a write can wait up to STATE_SQLITE_BUSY_TIMEOUT for the lock of another worker (and
+    # every commit may hit the disk), so the calls run on the threadpool, never on the event loop
+
+    def __init__(self, prefix: str, path: str = STATE_SQLITE_PATH):
+        self.prefix = prefix
+        # autocommit, take() opens its own transaction
+        self._connection = sqlite3.connect(path, timeout=STATE_SQLITE_BUSY_TIMEOUT,
+                                           isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, '
+                                 'value TEXT, expires REAL) WITHOUT ROWID')
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _get(self, key: str, now: float):
+        row = self._connection.execute(
+            'SELECT value FROM state WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, now)).fetchone()
+        return row[0] if row is not None else None
+
+    def _put(self, key: str, value: str, expires):
+        self._connection.execute(
+            'INSERT INTO state (key, value, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires',
+            (key, value, expires))
+        self._writes += 1
+        if self._writes % STATE_SWEEP_INTERVAL == 0:
+            self._connection.execute('DELETE FROM state WHERE expires <= ?', (time.time(),))
+
+    def _read(self, key: str):
+        with self._lock:
+            return self._get(key, time.time())
+
+    def _write(self, key: str, value: str, ttl: int):
+        with self._lock:
+            self._put(key, value, time.time() + ttl)
+
+    def _remove(self, key: str):
+        with self._lock:
+            self._connection.execute('DELETE FROM state WHERE key = ?', (key,))
+
+    def _incr(self, key: str) -> int:
+        with self._lock:
+            row = self._connection.execute(
+                "INSERT INTO state (key, value, expires) VALUES (?, '1', NULL) "
+                'ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1 '
+                'RETURNING value', (key,)).fetchone()
+        return int(row[0])
+
+    def _take(self, key: str, burst: int, per_second: float) -> float:
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so two workers can not both read the
+            # same bucket and take the same token
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                value = self._get(key, now)
+                value, wait = refill(json.loads(value) if value is not None else None,
+                                     burst, per_second, now)
+                self._put(key, json.dumps(value), now + bucket_ttl(burst, per_second))
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+        return wait
+
+    async def get(self, key: str):
+        return await run_in_threadpool(self._read, self.prefix + key)
+
+    async def set(self, key: str, value: str, ttl: int):
+        await run_in_threadpool(self._write, self.prefix + key, value, ttl)
+
+    async def delete(self, key: str):
+        await run_in_threadpool(self._remove, self.prefix + key)
+
+    async def get_counter(self, key: str) -> int:
+        value = await self.get(key)
+        return int(value) if value is not None else 0
+
+    async def incr(self, key: str) -> int:
+        return await run_in_threadpool(self._incr, self.prefix + key)
+
+    async def take(self, key: str, burst: int, per_second: float) -> float:
+        return await run_in_threadpool(self._take, self.prefix + key, burst, per_second)
+
+    def size(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                'SELECT count(*) FROM state WHERE substr(key, 1, ?) = ?',
+                (len(self.prefix), self.prefix)).fetchone()[0]
+
+
+class RedisStore:
+    # works with anything speaking the redis protocol (redis, valkey, keydb, dragonfly, ...)
+    # the 'redis' package is only needed when this backend is chosen
+
+    def __init__(self, prefix: str, url: str = STATE_REDIS_URL):
+        import redis.asyncio
+
+        self.prefix = prefix
+        self._redis = redis.asyncio.from_url(url)
+        self._take = self._redis.register_script(TAKE_SCRIPT)
+        self._script_loaded = False
+
+    async def get(self, key: str):
+        value = await self._redis.get(self.prefix + key)
+        return value.decode() if value is not None else None
+
+    async def set(self, key: str, value: str, ttl: int):
+        await self._redis.set(self.prefix + key, value, ex=ttl)
+
+    async def delete(self, key: str):
+        await self._redis.delete(self.prefix + key)
+
+    async def get_counter(self, key: str) -> int:
+        value = await self._redis.get(self.prefix + key)
+        return int(value) if value is not None else 0
+
+    async def incr(self, key: str) -> int:
+        return await self._redis.incr(self.prefix + key)
+
+    async def take(self, key: str, burst: int, per_second: float) -> float:
+        if not self._script_loaded:
+            # load it up front instead of letting the first EVALSHA fail with NOSCRIPT, the
+            # fakeredis stand-in of serve.py drops the connection after any error reply
+            await self._redis.script_load(TAKE_SCRIPT)
+            self._script_loaded = True
+        return float(await self._take(keys=[self.prefix + key], args=[burst, per_second]))
+
+    def size(self) -> int:
+        return -1  # unknown, the server keeps its own numbers
+
+
+def create_store(name: str, prefix: str, redis_url: str = STATE_REDIS_URL):
+    # prefix keeps the stores apart when they share one table / manager / redis database
+    if name == 'shared-memory':
+        return SharedMemoryStore(prefix)
+    if name == 'sqlite':
+        return SqliteStore(prefix)
+    if name == 'redis':
+        return RedisStore(prefix, redis_url)
+    raise ValueError(f'Unknown state backend: {name}')
@@ -0,0 +1,47 @@
+import argparse
+import sqlite3
+import time
+
+# Stand-in read replicas for trying DATABASE_REPLICA_URLS (database.py) without a PostgreSQL
+# cluster: copies the SQLite database into the replica files every --interval seconds, so they
+# are behind the primary by up to that long, like real replicas. Run it from the TodoApp
+# folder next to the app:
+#
+#   python sqlite_replicas.py ./todosapp.db ./replica1.db ./replica2.db --interval 1
+#   DATABASE_REPLICA_URLS=sqlite:///./replica1.db,sqlite:///./replica2.db uvicorn main:app
+#
+# Stop it and the replicas fall behind; a replica URL pointing into a missing folder shows
+# the failover (the reads go to the other replicas, or to the primary).
+
+
+def copy_database(source_path: str, target_path: str):
+    # the online backup API: a consistent snapshot even while the app writes to the source,
+    # and readers of the target wait (busy timeout) instead of seeing a half copied file
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path, timeout=30)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep SQLite copies of the database as replicas')
+    parser.add_argument('source')
+    parser.add_argument('replicas', nargs='+')
+    parser.add_argument('--interval', type=float, default=1, help='seconds between copies')
+    parser.add_argument('--once', action='store_true', help='copy once and exit')
+    args = parser.parse_args()
+
+    while True:
+        started = time.perf_counter()
+        for replica in args.replicas:
+            copy_database(args.source, replica)
+        if args.once:
+            break
+        time.sleep(max(0.0, args.interval - (time.perf_counter() - started)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import tempfile
+
+# the settings are read from the environment on import, so they are set before the app is
+# imported: a throw away SQLite database and the in process state of one worker
+_tmp = tempfile.mkdtemp(prefix='todoapp-tests-')
+os.environ['DATABASE_URL'] = f'sqlite:///{_tmp}/todosapp.db'
+os.environ['STATE_BACKEND'] = 'memory'
+os.environ['STATE_SQLITE_PATH'] = f'{_tmp}/todoapp_state.db'
+# the app uses flat imports (from database import ...), like uvicorn main:app run in TodoApp
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+import models
+import rate_limit
+import read_cache
+from database import engine
+from main import app
+from tests.helpers import bearer, login, signup
+from token_cache import token_cache
+from user_cache import user_cache
+
+
+@pytest.fixture
+def anyio_backend():
+    # async tests (pytest.mark.anyio) run on asyncio, like uvicorn
+    return 'asyncio'
+
+
+@pytest.fixture(scope='session')
+def client():
+    # with the lifespan, so the tables and the search / stats / sync triggers are created
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(autouse=True)
+def clean_state(client):
+    # every test starts with empty tables, rate limit buckets and caches
+    with engine.begin() as connection:
+        for table in reversed(models.Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+    rate_limit.rate_limiter.backend = rate_limit.MemoryBackend()
+    read_cache.read_cache.backend = read_cache.MemoryBackend()
+    token_cache._entries.clear()
+    token_cache._revoked.clear()
+    token_cache._revoked_expiry.clear()
+    user_cache._entries.clear()
+    yield
+
+
+@pytest.fixture
+def new_user(client):
+    # new_user() signs up one more user and gives the headers of its bearer token
+    return lambda: bearer(login(client, signup(client)))
+
+
+@pytest.fixture
+def auth_headers(new_user):
+    return new_user()
@@ -0,0 +1,26 @@
+import itertools
+
+# signing up and logging in through the API, for the tests and the fixtures of conftest.py
+
+_users = itertools.count(1)
+
+
+def signup(client, password: str = 'secret-password', role: str = 'user') -> dict:
+    number = next(_users)
+    user = {'username': f'user{number}', 'email': f'user{number}@example.com',
+            'first_name': 'Test', 'last_name': 'User', 'password': password, 'role': role,
+            'phone_number': '1234567890'}
+    response = client.post('/auth/', json=user)
+    assert response.status_code == 201, response.text
+    return user
+
+
+def login(client, user: dict) -> dict:
+    response = client.post('/auth/token', data={'username': user['username'],
+                                                'password': user['password']})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def bearer(tokens: dict) -> dict:
+    return {'Authorization': f"Bearer {tokens['access_token']}"}
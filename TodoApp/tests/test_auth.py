@@ -0,0 +1,60 @@
+from tests.helpers import bearer, login, signup
+from user_cache import user_cache
+
+
+def test_refresh_rotates_the_refresh_token(client):
+    tokens = login(client, signup(client))
+    response = client.post('/auth/refresh', json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == 200
+    refreshed = response.json()
+    assert client.get('/user/', headers=bearer(refreshed)).status_code == 200
+    # the old refresh token is used up
+    assert client.post('/auth/refresh', json={
+        'refresh_token': tokens['refresh_token']}).status_code == 401
+
+
+def test_reused_refresh_token_revokes_its_family(client):
+    tokens = login(client, signup(client))
+    refreshed = client.post('/auth/refresh', json={
+        'refresh_token': tokens['refresh_token']}).json()
+    # someone replays the old one: the new one stops working too
+    assert client.post('/auth/refresh', json={
+        'refresh_token': tokens['refresh_token']}).status_code == 401
+    assert client.post('/auth/refresh', json={
+        'refresh_token': refreshed['refresh_token']}).status_code == 401
+
+
+def test_logout_revokes_both_tokens(client):
+    tokens = login(client, signup(client))
+    headers = bearer(tokens)
+    assert client.get('/user/', headers=headers).status_code == 200
+    response = client.post('/auth/logout', json={'refresh_token': tokens['refresh_token']},
+                           headers=headers)
+    assert response.status_code == 204
+    assert client.get('/user/', headers=headers).status_code == 401
+    assert client.post('/auth/refresh', json={
+        'refresh_token': tokens['refresh_token']}).status_code == 401
+
+
+def test_cached_user_row_has_no_password_hash(client):
+    user = signup(client)
+    tokens = login(client, user)
+    row = client.get('/user/', headers=bearer(tokens)).json()
+    assert 'hashed_password' not in row
+    assert all('hashed_password' not in cached for _, cached in user_cache._entries.values())
+
+    # the password change reads the hash from the database
+    response = client.put('/user/password', json={'password': 'wrong-password',
+                                                  'new_password': 'new-password'},
+                          headers=bearer(tokens))
+    assert response.status_code == 401
+    response = client.put('/user/password', json={'password': user['password'],
+                                                  'new_password': 'new-password'},
+                          headers=bearer(tokens))
+    assert response.status_code == 204
+    assert client.post('/auth/token', data={'username': user['username'],
+                                            'password': user['password']}).status_code == 401
+    login(client, dict(user, password='new-password'))
+    # and the refresh tokens of the old password are revoked
+    assert client.post('/auth/refresh', json={
+        'refresh_token': tokens['refresh_token']}).status_code == 401
@@ -0,0 +1,40 @@
+import pytest
+from sqlalchemy import exc, text
+import metrics
+from database import engine
+
+
+def test_failed_statement_leaves_no_start_time_behind():
+    with engine.connect() as connection:
+        with pytest.raises(exc.OperationalError):
+            connection.execute(text('SELECT * FROM no_such_table'))
+        assert connection.info.get('query_start') == []
+        # the next statement times itself, not the failed one
+        connection.execute(text('SELECT 1'))
+        assert connection.info['query_start'] == []
+
+
+def test_metrics_need_the_token(client, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', 'scrape-token')
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    response = client.get('/metrics', headers={'Authorization': 'Bearer scrape-token'})
+    assert response.status_code == 200
+    assert 'http_request_duration_seconds' in response.text
+
+
+def test_metrics_without_a_token_only_for_this_machine(client, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', None)
+    # the test client is not a loopback address
+    assert client.get('/metrics').status_code == 403
+
+    class Request:
+        def __init__(self, host, headers=None):
+            self.client = type('Client', (), {'host': host})
+            self.headers = headers or {}
+
+    assert metrics.metrics_allowed(Request('127.0.0.1'))
+    assert metrics.metrics_allowed(Request('::1'))
+    assert not metrics.metrics_allowed(Request('203.0.113.9'))
+    # a proxy on this machine forwarding a request from outside
+    assert not metrics.metrics_allowed(Request('127.0.0.1', {'x-forwarded-for': '203.0.113.9'}))
@@ -0,0 +1,149 @@
+import pytest
+import sqlalchemy as sa
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+import migration_helpers
+import models
+from main import prepare_todo_tables
+from migration_helpers import alter_table, backfill, backfill_progress, table_triggers
+
+TODOS = 2000
+
+
+@pytest.fixture
+def seeded(tmp_path):
+    # a database of its own, like the one a migration runs on: every table, the FTS, stats and
+    # sync triggers on todos, and some todos written through them
+    engine = sa.create_engine(f'sqlite:///{tmp_path}/migrate.db')
+    models.Base.metadata.create_all(engine)
+    prepare_todo_tables(engine)
+    with engine.begin() as connection:
+        connection.execute(sa.insert(models.Users), [
+            {'id': 1, 'username': 'one', 'email': 'one@example.com', 'is_active': True},
+            {'id': 2, 'username': 'two', 'email': 'two@example.com', 'is_active': True}])
+        connection.execute(sa.insert(models.Todos), [
+            {'title': f'todo {number}', 'description': 'write the migration' if number % 2
+             else 'review it', 'priority': number % 5 + 1, 'complete': False,
+             'owner_id': number % 2 + 1} for number in range(TODOS)])
+    yield engine
+    engine.dispose()
+
+
+def migrate(engine, upgrade, dry_run: bool = False):
+    # what alembic does around one revision with env.py's transaction_per_migration: op.* works
+    # on this connection, in the revision's own transaction (which autocommit_block commits)
+    with engine.connect() as connection:
+        context = MigrationContext.configure(connection, opts={
+            'dry_run': dry_run, 'transaction_per_migration': True})
+        with Operations.context(context), context.begin_transaction(_per_migration=True):
+            upgrade()
+
+
+def trigger_names(engine) -> set:
+    with engine.connect() as connection:
+        return set(table_triggers(connection, 'todos'))
+
+
+def check_triggers_work(engine):
+    with engine.begin() as connection:
+        version = connection.execute(sa.text(
+            'SELECT value FROM todo_sync_versions WHERE owner_id = 1')).scalar()
+        connection.execute(sa.text(
+            "INSERT INTO todos (title, description, priority, complete, owner_id) "
+            "VALUES ('zebra crossing', 'after the copy', 5, 0, 1)"))
+        # search: the FTS trigger indexed the new row
+        assert connection.execute(sa.text(
+            "SELECT count(*) FROM todos_fts WHERE todos_fts MATCH 'zebra'")).scalar() == 1
+        # stats: the count trigger counted it
+        assert connection.execute(sa.text(
+            'SELECT sum(count) FROM todo_stats WHERE owner_id = 1')).scalar() == TODOS // 2 + 1
+        # sync: the version trigger gave it the next version of its owner
+        assert connection.execute(sa.text(
+            'SELECT value FROM todo_sync_versions WHERE owner_id = 1')).scalar() == version + 1
+
+
+def test_alter_table_in_place_keeps_the_triggers(seeded):
+    before = trigger_names(seeded)
+    assert {'todos_fts_ai', 'todo_stats_ai', 'todo_sync_ai'} <= before
+
+    def upgrade():
+        # SQLite can add a column with ALTER TABLE, so the table (and its triggers) stay
+        with alter_table('todos') as batch:
+            batch.add_column(sa.Column('title_lower', sa.String(), nullable=True))
+
+    migrate(seeded, upgrade)
+
+    assert trigger_names(seeded) == before
+    check_triggers_work(seeded)
+
+
+def test_alter_table_copy_recreates_the_triggers(seeded):
+    before = trigger_names(seeded)
+
+    def upgrade():
+        # a changed column type needs the copy, which drops the triggers with the old table
+        with alter_table('todos') as batch:
+            batch.alter_column('description', type_=sa.Text(), existing_type=sa.String())
+
+    migrate(seeded, upgrade)
+
+    assert trigger_names(seeded) == before
+    with seeded.connect() as connection:
+        assert connection.execute(sa.text('SELECT count(*) FROM todos')).scalar() == TODOS
+    check_triggers_work(seeded)
+
+
+def test_backfill_in_batches(seeded, monkeypatch):
+    monkeypatch.setattr(migration_helpers, 'BACKFILL_LOG_INTERVAL', 0)
+
+    def upgrade():
+        with alter_table('todos') as batch:
+            batch.add_column(sa.Column('title_lower', sa.String(), nullable=True))
+        backfill('todos', {'title_lower': 'upper(title)'}, where='title_lower IS NULL',
+                 batch_size=300)
+
+    migrate(seeded, upgrade)
+
+    with seeded.connect() as connection:
+        assert connection.execute(sa.text(
+            'SELECT count(*) FROM todos WHERE title_lower = upper(title)')).scalar() == TODOS
+        # a finished backfill leaves no progress behind
+        assert connection.execute(sa.select(sa.func.count()).select_from(
+            backfill_progress)).scalar() == 0
+    check_triggers_work(seeded)
+
+
+def test_backfill_resumes_after_the_last_batch(seeded):
+    with seeded.begin() as connection:
+        connection.execute(sa.text('ALTER TABLE todos ADD COLUMN title_lower VARCHAR'))
+        middle = connection.execute(sa.text('SELECT min(id) + 999 FROM todos')).scalar()
+        # a run which stopped after the first 1000 rows
+        backfill_progress.create(connection)
+        connection.execute(backfill_progress.insert().values(
+            name='todos:title_lower', last_key=middle, rows_done=1000))
+
+    def upgrade():
+        backfill('todos', {'title_lower': 'lower(title)'}, batch_size=250)
+
+    migrate(seeded, upgrade)
+
+    with seeded.connect() as connection:
+        assert connection.execute(sa.text(
+            'SELECT count(*) FROM todos WHERE title_lower IS NOT NULL')).scalar() == TODOS - 1000
+        assert connection.execute(sa.text(
+            'SELECT max(id) FROM todos WHERE title_lower IS NULL')).scalar() == middle
+
+
+def test_dry_run_changes_nothing(seeded):
+    with seeded.begin() as connection:
+        connection.execute(sa.text('ALTER TABLE todos ADD COLUMN title_lower VARCHAR'))
+
+    def upgrade():
+        backfill('todos', {'title_lower': 'lower(title)'}, batch_size=100)
+
+    migrate(seeded, upgrade, dry_run=True)
+
+    with seeded.connect() as connection:
+        assert connection.execute(sa.text(
+            'SELECT count(*) FROM todos WHERE title_lower IS NOT NULL')).scalar() == 0
+        assert not sa.inspect(connection).has_table('alembic_backfill_progress')
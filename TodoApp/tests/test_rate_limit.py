@@ -0,0 +1,62 @@
+import pytest
+import rate_limit
+from tests.helpers import bearer, login, signup
+
+
+@pytest.fixture
+def from_ip(monkeypatch):
+    # behind a trusted proxy the client IP is the one of X-Forwarded-For
+    monkeypatch.setattr(rate_limit, 'RATE_LIMIT_TRUST_FORWARDED', True)
+    return lambda ip: {'X-Forwarded-For': ip}
+
+
+def wrong_login(client, user: dict, headers: dict = None):
+    return client.post('/auth/token', data={'username': user['username'],
+                                            'password': 'wrong-password'}, headers=headers)
+
+
+def test_login_over_the_ip_limit_gets_429(client, from_ip):
+    users = [signup(client) for _ in range(5)]
+    # 20/minute for the IP, spread over accounts so the per username limit is not hit first
+    statuses = [wrong_login(client, users[attempt % 5], from_ip('10.0.0.1')).status_code
+                for attempt in range(21)]
+    assert statuses[:20] == [401] * 20
+    response = wrong_login(client, users[0], from_ip('10.0.0.1'))
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    # another IP has its own bucket
+    assert wrong_login(client, users[0], from_ip('10.0.0.2')).status_code == 401
+
+
+def test_wrong_passwords_do_not_lock_out_the_owner(client, from_ip):
+    victim = signup(client)
+    # 5/minute for one username from one IP
+    statuses = [wrong_login(client, victim, from_ip('10.0.0.66')).status_code
+                for _ in range(6)]
+    assert statuses == [401] * 5 + [429]
+    # the owner, from their own IP, still logs in
+    response = client.post('/auth/token', data={'username': victim['username'],
+                                                'password': victim['password']},
+                           headers=from_ip('10.0.0.7'))
+    assert response.status_code == 200
+
+
+def test_signup_over_the_limit_gets_429(client):
+    # 10/minute per IP
+    for _ in range(10):
+        signup(client)
+    response = client.post('/auth/', json={
+        'username': 'one-too-many', 'email': 'many@example.com', 'first_name': 'Test',
+        'last_name': 'User', 'password': 'secret-password', 'role': 'user',
+        'phone_number': '1234567890'})
+    assert response.status_code == 429
+
+
+def test_password_change_over_the_user_limit_gets_429(client, from_ip):
+    headers = bearer(login(client, signup(client)))
+    # 5/minute for the logged in user, whatever IP it comes from
+    statuses = [client.put('/user/password', json={'password': 'wrong-password',
+                                                   'new_password': 'new-password'},
+                           headers=dict(headers, **from_ip(f'10.0.1.{attempt}'))).status_code
+                for attempt in range(6)]
+    assert statuses == [401] * 5 + [429]
@@ -0,0 +1,121 @@
+import asyncio
+import multiprocessing
+
+import pytest
+import shared_state
+from rate_limit import RateLimiter, RateLimitExceeded
+from shared_state import SharedMemoryStore, SqliteStore, start_manager
+from token_cache import TokenCache
+
+pytestmark = pytest.mark.anyio
+
+
+def take_all(path: str, attempts: int) -> int:
+    # one worker process: how many of its attempts the shared bucket let through
+    async def attempt():
+        limiter = RateLimiter(SqliteStore('ratelimit:', path))
+        allowed = 0
+        for _ in range(attempts):
+            try:
+                await limiter.check('login:ip:10.0.0.1', '10/minute')
+                allowed += 1
+            except RateLimitExceeded:
+                pass
+        return allowed
+    return asyncio.run(attempt())
+
+
+def test_sqlite_bucket_is_shared_by_worker_processes(tmp_path):
+    path = str(tmp_path / 'state.db')
+    SqliteStore('ratelimit:', path)
+    with multiprocessing.get_context('spawn').Pool(3) as workers:
+        allowed = workers.starmap(take_all, [(path, 10)] * 3)
+    # 10 per minute for the IP, not 10 per worker
+    assert sum(allowed) == 10
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    # like serve.py: the manager process, then its address for the workers
+    manager, manager_env = start_manager()
+    for name, value in manager_env.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(shared_state, '_manager', None)
+    yield manager
+    manager.shutdown()
+
+
+@pytest.fixture(params=['sqlite', 'shared-memory'])
+def stores(request, tmp_path):
+    # new_store() is the store of one more worker
+    if request.param == 'sqlite':
+        return lambda prefix: SqliteStore(prefix, str(tmp_path / 'state.db'))
+    request.getfixturevalue('manager')
+    return SharedMemoryStore
+
+
+async def test_revoked_token_is_revoked_on_every_worker(stores):
+    first = TokenCache(store=stores('revoked:'))
+    second = TokenCache(store=stores('revoked:'), sync_interval=0)
+    token, expires = 'header.payload.signature', 4102444800
+    second.put(token, {'sub': 'user1'}, expires)
+    assert await second.get(token) == {'sub': 'user1'}
+    await first.revoke(token, expires)
+    assert await second.is_revoked(token)
+    assert await second.get(token) is None
+
+
+class CountingStore:
+    # counts the round trips of a worker to the shared store
+
+    def __init__(self, store):
+        self.store = store
+        self.calls = 0
+
+    def __getattr__(self, method):
+        async def call(*args):
+            self.calls += 1
+            return await getattr(self.store, method)(*args)
+        return call
+
+
+async def test_cached_token_does_not_ask_the_store_every_time(stores, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('token_cache.time.monotonic', lambda: now[0])
+    first = TokenCache(store=stores('revoked:'))
+    second_store = CountingStore(stores('revoked:'))
+    second = TokenCache(store=second_store, sync_interval=1)
+    tokens = [f'header.payload.signature{number}' for number in range(3)]
+    expires = 4102444800
+    for token in tokens:
+        second.put(token, {'sub': token}, expires)
+
+    for _ in range(20):
+        for token in tokens:
+            assert await second.get(token) == {'sub': token}
+    # one read of the revocation counter for all of them
+    assert second_store.calls == 1
+
+    await first.revoke(tokens[0], expires)
+    # still cached until the next sync, at most sync_interval later
+    assert await second.get(tokens[0]) is not None
+    now[0] += 1
+    assert await second.get(tokens[0]) is None
+    assert await second.get(tokens[1]) == {'sub': tokens[1]}
+    calls = second_store.calls
+    # checked again once after the counter moved, then cached as before
+    assert await second.get(tokens[1]) == {'sub': tokens[1]}
+    assert second_store.calls == calls
+
+
+async def test_rate_limit_is_shared_by_workers(stores):
+    workers = [RateLimiter(stores('ratelimit:')) for _ in range(3)]
+    allowed = 0
+    for _ in range(4):
+        for limiter in workers:
+            try:
+                await limiter.check('login:ip:10.0.0.2', '5/minute')
+                allowed += 1
+            except RateLimitExceeded:
+                pass
+    assert allowed == 5
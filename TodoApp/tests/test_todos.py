@@ -0,0 +1,141 @@
+import pytest
+from sqlalchemy import insert, select
+from database import SessionLocal, engine
+from models import Todos
+from routers.todos import TodoRequest, bulk_create_todos
+from search import search_backend
+from todo_stats import stats_maintained
+
+
+def todo(number: int, priority: int = 3, complete: bool = False) -> dict:
+    return {'title': f'todo {number}', 'description': f'description {number}',
+            'priority': priority, 'complete': complete}
+
+
+def test_bulk_create_answers_in_request_order(client, auth_headers):
+    todos = [todo(number, priority=number % 5 + 1) for number in range(20)]
+    response = client.post('/todo/bulk', json=todos, headers=auth_headers)
+    assert response.status_code == 200
+    results = response.json()
+    assert [result['index'] for result in results] == list(range(20))
+    assert all(result['status'] == 201 for result in results)
+    for result, sent in zip(results, todos):
+        stored = client.get(f"/todo/{result['id']}", headers=auth_headers).json()
+        assert stored['title'] == sent['title']
+        assert stored['priority'] == sent['priority']
+
+
+def test_bulk_create_without_insert_returning(client, auth_headers, monkeypatch):
+    # MySQL and SQLite before 3.35 have no INSERT ... RETURNING: one INSERT per row instead
+    monkeypatch.setattr(engine.dialect, 'insert_returning', False)
+    owner_id = client.get('/user/', headers=auth_headers).json()['id']
+    requests = [TodoRequest(**todo(number)) for number in range(5)]
+    with SessionLocal() as db:
+        ids = bulk_create_todos(db, owner_id, requests)
+        titles = dict(db.execute(select(Todos.id, Todos.title).where(Todos.id.in_(ids))).all())
+    assert len(set(ids)) == 5
+    assert [titles[todo_id] for todo_id in ids] == [request.title for request in requests]
+
+
+def test_bulk_update_and_delete(client, auth_headers, new_user):
+    ids = [result['id'] for result in
+           client.post('/todo/bulk', json=[todo(number) for number in range(3)],
+                       headers=auth_headers).json()]
+    # someone else's todo is not found, like one which does not exist
+    other_headers = new_user()
+    other_id = client.post('/todo/bulk', json=[todo(9)], headers=other_headers).json()[0]['id']
+
+    updates = [dict(todo(number, priority=5, complete=True), id=todo_id)
+               for number, todo_id in enumerate(ids)] + [dict(todo(7), id=other_id)]
+    response = client.put('/todo/bulk', json=updates, headers=auth_headers)
+    assert [result['status'] for result in response.json()] == [204, 204, 204, 404]
+    for todo_id in ids:
+        stored = client.get(f'/todo/{todo_id}', headers=auth_headers).json()
+        assert stored['priority'] == 5 and stored['complete'] is True
+    assert client.get(f'/todo/{other_id}', headers=other_headers).json()['title'] == 'todo 9'
+
+    response = client.request('DELETE', '/todo/bulk', json={'ids': [ids[0], other_id]},
+                              headers=auth_headers)
+    assert [result['status'] for result in response.json()] == [204, 404]
+    assert client.get(f'/todo/{ids[0]}', headers=auth_headers).status_code == 404
+    assert client.get(f'/todo/{ids[1]}', headers=auth_headers).status_code == 200
+
+
+def test_search_uses_the_full_text_index(client, auth_headers):
+    client.post('/todo/bulk', json=[
+        dict(todo(1), title='Buy milk'), dict(todo(2), title='Milkshake recipe'),
+        dict(todo(3), title='Call mom')], headers=auth_headers)
+    response = client.get('/todo/search', params={'q': 'milk'}, headers=auth_headers)
+    assert response.status_code == 200
+    # every word matches as a prefix, the whole word first
+    assert [found['title'] for found in response.json()] == ['Buy milk', 'Milkshake recipe']
+    with SessionLocal() as db:
+        assert search_backend(db) == 'fts5'
+
+
+def test_stats_follow_the_writes(client, auth_headers):
+    ids = [result['id'] for result in client.post('/todo/bulk', json=[
+        todo(1, priority=1), todo(2, priority=1), todo(3, priority=4, complete=True)],
+        headers=auth_headers).json()]
+    client.put('/todo/bulk', json=[dict(todo(2, priority=4, complete=True), id=ids[1])],
+               headers=auth_headers)
+    client.request('DELETE', '/todo/bulk', json={'ids': [ids[0]]}, headers=auth_headers)
+    stats = client.get('/todo/stats', headers=auth_headers).json()
+    assert stats == {'total': 2, 'complete': 2, 'incomplete': 0,
+                     'by_priority': {'4': {'complete': 2, 'incomplete': 0}}}
+    # read from todo_stats, which the triggers keep up to date
+    with SessionLocal() as db:
+        assert stats_maintained(db)
+
+
+def test_changes_since_a_version(client, auth_headers, new_user):
+    ids = [result['id'] for result in client.post('/todo/bulk', json=[
+        todo(number) for number in range(3)], headers=auth_headers).json()]
+    first = client.get('/todo/changes', params={'since': 0}, headers=auth_headers).json()
+    assert sorted(change['id'] for change in first['changes']) == sorted(ids)
+    assert first['deleted'] == []
+
+    # another owner's writes do not move this owner's versions
+    client.post('/todo/bulk', json=[todo(9)], headers=new_user())
+    assert client.get('/todo/changes', params={'since': first['version']},
+                      headers=auth_headers).json()['changes'] == []
+
+    client.put('/todo/bulk', json=[dict(todo(7), id=ids[1])], headers=auth_headers)
+    client.request('DELETE', '/todo/bulk', json={'ids': [ids[2]]}, headers=auth_headers)
+    second = client.get('/todo/changes', params={'since': first['version']},
+                        headers=auth_headers).json()
+    assert [(change['id'], change['title']) for change in second['changes']] == [(ids[1], 'todo 7')]
+    assert [deleted['id'] for deleted in second['deleted']] == [ids[2]]
+    assert second['version'] == first['version'] + 2
+
+
+def all_pages(client, headers, limit: int, **params) -> list:
+    ids, cursor = [], None
+    while True:
+        response = client.get('/', params=dict(params, limit=limit, **(
+            {'cursor': cursor} if cursor else {})), headers=headers)
+        assert response.status_code == 200, response.text
+        ids += [found['id'] for found in response.json()]
+        cursor = response.headers.get('x-next-cursor')
+        if cursor is None:
+            return ids
+
+
+@pytest.mark.parametrize('order', ['asc', 'desc'])
+def test_paging_by_priority_with_null_priorities(client, auth_headers, order):
+    owner_id = client.get('/user/', headers=auth_headers).json()['id']
+    # old rows have no priority, the API does not let new ones be written without
+    with SessionLocal() as db:
+        db.execute(insert(Todos), [
+            {'title': f'todo {number}', 'description': 'paging', 'complete': number % 3 == 0,
+             'priority': None if number % 4 == 0 else number % 5 + 1, 'owner_id': owner_id}
+            for number in range(13)])
+        db.commit()
+    everything = all_pages(client, auth_headers, 1000, sort='priority', order=order)
+    assert len(everything) == 13
+    for limit in (1, 2, 3, 5):
+        assert all_pages(client, auth_headers, limit, sort='priority', order=order) == everything
+        assert all_pages(client, auth_headers, limit, sort='priority', order=order,
+                         complete=False) == all_pages(client, auth_headers, 1000,
+                                                      sort='priority', order=order,
+                                                      complete=False)
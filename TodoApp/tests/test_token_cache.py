@@ -0,0 +1,44 @@
+import pytest
+from token_cache import TokenCache, token_digest
+
+pytestmark = pytest.mark.anyio
+
+EXPIRES = 4102444800
+
+
+async def test_revocation_hooks():
+    cache = TokenCache()
+    disabled = set()
+
+    def disabled_user(claims):
+        return claims['id'] in disabled
+
+    cache.add_revocation_hook(disabled_user)
+    cache.put('token-one', {'id': 1}, EXPIRES)
+    cache.put('token-two', {'id': 2}, EXPIRES)
+    assert await cache.get('token-one') == {'id': 1}
+
+    disabled.add(1)
+    # cached and new tokens of the user alike
+    assert await cache.get('token-one') is None
+    assert await cache.is_revoked('token-three', {'id': 1})
+    assert await cache.get('token-two') == {'id': 2}
+    assert not await cache.is_revoked('token-four', {'id': 2})
+
+    cache.remove_revocation_hook(disabled_user)
+    assert not await cache.is_revoked('token-three', {'id': 1})
+
+
+async def test_revoked_tokens_are_swept_once_expired(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('token_cache.time.time', lambda: now[0])
+    cache = TokenCache()
+    await cache.revoke('short', 1010)
+    await cache.revoke('long', 2000)
+    assert await cache.is_revoked('short') and await cache.is_revoked('long')
+    now[0] = 1500
+    await cache.revoke('other', 3000)
+    # the next revoke dropped the one which expired
+    assert set(cache._revoked) == {token_digest('long'), token_digest('other')}
+    assert not await cache.is_revoked('short')
+    assert await cache.is_revoked('long')
@@ -0,0 +1,172 @@
+import argparse
+from sqlalchemy import func, inspect, select, text
+from database import PerDatabase
+from models import Todos, TodoStats
+
+# Counts of todos per owner, priority and complete, for GET /todo/stats and /admin/stats.
+#
+# The todo_stats table is maintained by triggers on todos, in the same transaction as the
+# write, so every way of writing a todo (single create / update / delete, the bulk endpoints,
+# the admin delete) moves the counts without extra code or round trips in the routes. Like the
+# search index (search.py) it is triggers and not ORM events, because most of those writes are
+# plain INSERT / UPDATE / DELETE statements which never see the old values of the row.
+#
+# SQLite and PostgreSQL get the triggers, on other databases the stats are counted from todos.
+# The alembic migration e8a3c5d1f047 creates the same objects, ensure_stats_triggers() below is
+# for databases made by create_all. To fill / repair the table:
+#
+#   python todo_stats.py rebuild [--owner-id 3]
+
+TRIGGER_DIALECTS = ('sqlite', 'postgresql')
+
+SQLITE_STATS_DDL = (
+    "CREATE TRIGGER IF NOT EXISTS todo_stats_ai AFTER INSERT ON todos BEGIN "
+    "INSERT INTO todo_stats (owner_id, priority, complete, count) "
+    "VALUES (coalesce(new.owner_id, 0), coalesce(new.priority, 0), coalesce(new.complete, 0), 1) "
+    "ON CONFLICT (owner_id, priority, complete) DO UPDATE SET count = count + 1; END",
+    "CREATE TRIGGER IF NOT EXISTS todo_stats_ad AFTER DELETE ON todos BEGIN "
+    "UPDATE todo_stats SET count = count - 1 WHERE owner_id = coalesce(old.owner_id, 0) "
+    "AND priority = coalesce(old.priority, 0) AND complete = coalesce(old.complete, 0); END",
+    "CREATE TRIGGER IF NOT EXISTS todo_stats_au AFTER UPDATE OF owner_id, priority, complete "
+    "ON todos WHEN old.owner_id IS NOT new.owner_id OR old.priority IS NOT new.priority "
+    "OR old.complete IS NOT new.complete BEGIN "
+    "UPDATE todo_stats SET count = count - 1 WHERE owner_id = coalesce(old.owner_id, 0) "
+    "AND priority = coalesce(old.priority, 0) AND complete = coalesce(old.complete, 0); "
+    "INSERT INTO todo_stats (owner_id, priority, complete, count) "
+    "VALUES (coalesce(new.owner_id, 0), coalesce(new.priority, 0), coalesce(new.complete, 0), 1) "
+    "ON CONFLICT (owner_id, priority, complete) DO UPDATE SET count = count + 1; END",
+)
+
+POSTGRES_STATS_DDL = (
+    "CREATE OR REPLACE FUNCTION todo_stats_apply() RETURNS trigger AS $$ BEGIN "
+    "IF TG_OP IN ('UPDATE', 'DELETE') THEN "
+    "UPDATE todo_stats SET count = count - 1 WHERE owner_id = coalesce(OLD.owner_id, 0) "
+    "AND priority = coalesce(OLD.priority, 0) AND complete = coalesce(OLD.complete, false); "
+    "END IF; "
+    "IF TG_OP IN ('INSERT', 'UPDATE') THEN "
+    "INSERT INTO todo_stats (owner_id, priority, complete, count) "
+    "VALUES (coalesce(NEW.owner_id, 0), coalesce(NEW.priority, 0), coalesce(NEW.complete, false), 1) "
+    "ON CONFLICT (owner_id, priority, complete) DO UPDATE SET count = todo_stats.count + 1; "
+    "END IF; "
+    "RETURN NULL; END $$ LANGUAGE plpgsql",
+    "DROP TRIGGER IF EXISTS todo_stats_trigger ON todos",
+    "CREATE TRIGGER todo_stats_trigger AFTER INSERT OR DELETE OR UPDATE OF owner_id, priority, "
+    "complete ON todos FOR EACH ROW EXECUTE FUNCTION todo_stats_apply()",
+)
+
+def has_stats_triggers(connection) -> bool:
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        return connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'todo_stats_ai'"
+        )).first() is not None
+    if dialect == 'postgresql':
+        return connection.execute(text(
+            "SELECT 1 FROM pg_trigger WHERE tgname = 'todo_stats_trigger'")).first() is not None
+    return False
+
+
+def ensure_stats_triggers(sync_engine):
+    dialect = sync_engine.dialect.name
+    if dialect not in TRIGGER_DIALECTS:
+        return
+    with sync_engine.begin() as connection:
+        if not inspect(connection).has_table('todo_stats') or has_stats_triggers(connection):
+            return
+        for statement in SQLITE_STATS_DDL if dialect == 'sqlite' else POSTGRES_STATS_DDL:
+            connection.execute(text(statement))
+        # the triggers only see writes from now on, count what is already there
+        rebuild_stats(connection)
+    _maintained.forget(sync_engine)
+
+
+def rebuild_stats(connection, owner_id: int = None) -> int:
+    # Recounts todo_stats from todos (all owners, or one), in the caller's transaction.
+    # On PostgreSQL writers are held off meanwhile, so no trigger update falls between the
+    # DELETE and the INSERT ... SELECT (SQLite only has one writer at a time anyway).
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('LOCK TABLE todos IN SHARE MODE'))
+    delete_stats = TodoStats.__table__.delete()
+    counts = select(func.coalesce(Todos.owner_id, 0), func.coalesce(Todos.priority, 0),
+                    func.coalesce(Todos.complete, False), func.count())
+    if owner_id is not None:
+        delete_stats = delete_stats.where(TodoStats.owner_id == owner_id)
+        counts = counts.where(func.coalesce(Todos.owner_id, 0) == owner_id)
+    counts = counts.group_by(func.coalesce(Todos.owner_id, 0), func.coalesce(Todos.priority, 0),
+                             func.coalesce(Todos.complete, False))
+    connection.execute(delete_stats)
+    result = connection.execute(TodoStats.__table__.insert().from_select(
+        ['owner_id', 'priority', 'complete', 'count'], counts))
+    return result.rowcount
+
+
+# are the triggers there, looked up once per database
+_maintained = PerDatabase(lambda db: has_stats_triggers(db.connection()))
+
+
+def stats_maintained(db) -> bool:
+    return _maintained.get(db)
+
+
+def count_rows(db, owner_id: int = None):
+    # (priority, complete, count) rows, from todo_stats where the triggers keep it up to date
+    if stats_maintained(db):
+        query = select(TodoStats.priority, TodoStats.complete, func.sum(TodoStats.count))\
+            .where(TodoStats.count > 0)
+        if owner_id is not None:
+            query = query.where(TodoStats.owner_id == owner_id)
+        query = query.group_by(TodoStats.priority, TodoStats.complete)
+    else:
+        query = select(func.coalesce(Todos.priority, 0), func.coalesce(Todos.complete, False),
+                       func.count())
+        if owner_id is not None:
+            query = query.where(Todos.owner_id == owner_id)
+        query = query.group_by(func.coalesce(Todos.priority, 0),
+                               func.coalesce(Todos.complete, False))
+    return db.execute(query).all()
+
+
+def query_stats(db, owner_id: int = None) -> dict:
+    stats = {'total': 0, 'complete': 0, 'incomplete': 0, 'by_priority': {}}
+    for priority, complete, count in count_rows(db, owner_id):
+        count = int(count)
+        key = 'complete' if complete else 'incomplete'
+        bucket = stats['by_priority'].setdefault(str(priority), {'complete': 0, 'incomplete': 0})
+        bucket[key] += count
+        stats[key] += count
+        stats['total'] += count
+    stats['by_priority'] = dict(sorted(stats['by_priority'].items()))
+    return stats
+
+
+def merge_stats(parts) -> dict:
+    # query_stats() of several databases (the shards) added up
+    stats = {'total': 0, 'complete': 0, 'incomplete': 0, 'by_priority': {}}
+    for part in parts:
+        for key in ('total', 'complete', 'incomplete'):
+            stats[key] += part[key]
+        for priority, counts in part['by_priority'].items():
+            bucket = stats['by_priority'].setdefault(priority, {'complete': 0, 'incomplete': 0})
+            bucket['complete'] += counts['complete']
+            bucket['incomplete'] += counts['incomplete']
+    stats['by_priority'] = dict(sorted(stats['by_priority'].items()))
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance of the todo_stats table')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    rebuild = subcommands.add_parser('rebuild', help='recount todo_stats from todos')
+    rebuild.add_argument('--owner-id', type=int, default=None)
+    args = parser.parse_args()
+
+    # every shard with DATABASE_SHARD_URLS (sharding.py), else the one database
+    from sharding import todo_engines
+    for name, engine in todo_engines():
+        with engine.begin() as connection:
+            rows = rebuild_stats(connection, args.owner_id)
+        print(f'{name}: todo_stats rebuilt, {rows} rows')
+
+
+if __name__ == '__main__':
+    main()
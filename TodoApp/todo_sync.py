@@ -0,0 +1,262 @@
+import argparse
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, insert, inspect, literal, select, text, update
+from database import PerDatabase
+from models import Todos, TodoSyncVersions, TodoTombstones
+
+# Delta sync for the mobile clients (GET /todo/changes?since=<version>). Instead of downloading
+# the whole list every few seconds, a client keeps the `version` of its last sync and only gets
+# the todos inserted / updated after it, plus the ids of the ones deleted (tombstones).
+#
+# Every insert or update of a todo takes the next number of its owner's counter in
+# todo_sync_versions and stores it in todos.version (with updated_at), every delete leaves a
+# tombstone with such a number of the old owner. Like todo_stats.py that is done by triggers, in
+# the same transaction as the write, so all the ways of writing todos are covered. The owner's
+# counter row is locked until the writer commits, so the versions of an owner become visible
+# in order and a client can never skip a version which commits late; writes of different
+# owners do not wait for each other (on SQLite there is only one writer anyway). A client only
+# ever syncs the todos of its own user, so the versions only have to go up per owner.
+#
+# SQLite and PostgreSQL get the triggers, elsewhere GET /todo/changes answers 501. The alembic
+# migrations a7d2f9c4e813 and c5f1a8e2d94b create the same objects, ensure_sync_triggers() below
+# is for databases made by create_all. Tombstones are kept until pruned:
+#
+#   python todo_sync.py prune [--days 30]
+#
+# a client which last synced before the pruned tombstones gets 410 and has to fetch everything.
+
+TRIGGER_DIALECTS = ('sqlite', 'postgresql')
+TOMBSTONE_RETENTION_DAYS = 30
+
+SQLITE_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+SQLITE_NEXT_VERSION = (
+    "INSERT INTO todo_sync_versions (owner_id, value, pruned) "
+    "VALUES (coalesce(new.owner_id, 0), 1, 0) "
+    "ON CONFLICT (owner_id) DO UPDATE SET value = value + 1; "
+    "UPDATE todos SET version = (SELECT value FROM todo_sync_versions "
+    "WHERE owner_id = coalesce(new.owner_id, 0)), "
+    f"updated_at = {SQLITE_NOW} WHERE id = new.id; "
+)
+# the SELECT needs its WHERE, without one SQLite reads ON CONFLICT as part of a join
+SQLITE_TOMBSTONE = (
+    "INSERT INTO todo_sync_versions (owner_id, value, pruned) "
+    "SELECT coalesce(old.owner_id, 0), 1, 0 WHERE {condition} "
+    "ON CONFLICT (owner_id) DO UPDATE SET value = value + 1; "
+    "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+    f"SELECT old.id, old.owner_id, value, {SQLITE_NOW} FROM todo_sync_versions "
+    "WHERE owner_id = coalesce(old.owner_id, 0) AND {condition} "
+    "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, "
+    "version = excluded.version, deleted_at = excluded.deleted_at; "
+)
+SYNC_COLUMNS_CHANGED = (
+    "{old}.title IS {distinct} {new}.title OR {old}.description IS {distinct} {new}.description "
+    "OR {old}.priority IS {distinct} {new}.priority OR {old}.complete IS {distinct} {new}.complete "
+    "OR {old}.owner_id IS {distinct} {new}.owner_id"
+)
+
+SQLITE_SYNC_DDL = (
+    # the UPDATE of version / updated_at inside does not touch the columns the other todos
+    # triggers listen to, so it does not fire them (or this one) again
+    "DROP TRIGGER IF EXISTS todo_sync_ai",
+    "CREATE TRIGGER todo_sync_ai AFTER INSERT ON todos BEGIN "
+    + SQLITE_NEXT_VERSION +
+    # SQLite may hand out the id of a deleted todo again
+    "DELETE FROM todo_tombstones WHERE id = new.id; END",
+    "DROP TRIGGER IF EXISTS todo_sync_au",
+    "CREATE TRIGGER todo_sync_au AFTER UPDATE OF title, description, priority, "
+    "complete, owner_id ON todos WHEN "
+    + SYNC_COLUMNS_CHANGED.format(old='old', new='new', distinct='NOT') + " BEGIN "
+    + SQLITE_NEXT_VERSION
+    # moved to another owner: gone for the old one
+    + SQLITE_TOMBSTONE.format(condition='old.owner_id IS NOT new.owner_id') + "END",
+    "DROP TRIGGER IF EXISTS todo_sync_ad",
+    "CREATE TRIGGER todo_sync_ad AFTER DELETE ON todos BEGIN "
+    + SQLITE_TOMBSTONE.format(condition='1') + "END",
+)
+
+POSTGRES_SYNC_DDL = (
+    "CREATE OR REPLACE FUNCTION todo_sync_stamp() RETURNS trigger AS $$ "
+    "DECLARE old_version integer; BEGIN "
+    "INSERT INTO todo_sync_versions AS counter (owner_id, value, pruned) "
+    "VALUES (coalesce(NEW.owner_id, 0), 1, 0) "
+    "ON CONFLICT (owner_id) DO UPDATE SET value = counter.value + 1 "
+    "RETURNING value INTO NEW.version; "
+    "NEW.updated_at := now() AT TIME ZONE 'utc'; "
+    "IF TG_OP = 'INSERT' THEN "
+    "DELETE FROM todo_tombstones WHERE id = NEW.id; "
+    "ELSIF OLD.owner_id IS DISTINCT FROM NEW.owner_id THEN "
+    "INSERT INTO todo_sync_versions AS counter (owner_id, value, pruned) "
+    "VALUES (coalesce(OLD.owner_id, 0), 1, 0) "
+    "ON CONFLICT (owner_id) DO UPDATE SET value = counter.value + 1 "
+    "RETURNING value INTO old_version; "
+    "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+    "VALUES (OLD.id, OLD.owner_id, old_version, NEW.updated_at) "
+    "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, version = excluded.version, "
+    "deleted_at = excluded.deleted_at; "
+    "END IF; "
+    "RETURN NEW; END $$ LANGUAGE plpgsql",
+    "CREATE OR REPLACE FUNCTION todo_sync_tombstone() RETURNS trigger AS $$ "
+    "DECLARE next_version integer; BEGIN "
+    "INSERT INTO todo_sync_versions AS counter (owner_id, value, pruned) "
+    "VALUES (coalesce(OLD.owner_id, 0), 1, 0) "
+    "ON CONFLICT (owner_id) DO UPDATE SET value = counter.value + 1 "
+    "RETURNING value INTO next_version; "
+    "INSERT INTO todo_tombstones (id, owner_id, version, deleted_at) "
+    "VALUES (OLD.id, OLD.owner_id, next_version, now() AT TIME ZONE 'utc') "
+    "ON CONFLICT (id) DO UPDATE SET owner_id = excluded.owner_id, version = excluded.version, "
+    "deleted_at = excluded.deleted_at; "
+    "RETURN NULL; END $$ LANGUAGE plpgsql",
+    "DROP TRIGGER IF EXISTS todo_sync_insert ON todos",
+    "CREATE TRIGGER todo_sync_insert BEFORE INSERT ON todos "
+    "FOR EACH ROW EXECUTE FUNCTION todo_sync_stamp()",
+    "DROP TRIGGER IF EXISTS todo_sync_update ON todos",
+    "CREATE TRIGGER todo_sync_update BEFORE UPDATE OF title, description, priority, complete, "
+    "owner_id ON todos FOR EACH ROW WHEN ("
+    + SYNC_COLUMNS_CHANGED.format(old='OLD', new='NEW', distinct='DISTINCT FROM') + ") "
+    "EXECUTE FUNCTION todo_sync_stamp()",
+    "DROP TRIGGER IF EXISTS todo_sync_delete ON todos",
+    "CREATE TRIGGER todo_sync_delete AFTER DELETE ON todos "
+    "FOR EACH ROW EXECUTE FUNCTION todo_sync_tombstone()",
+)
+
+def has_sync_triggers(connection) -> bool:
+    # the triggers of before bumped the single row counter of todo_sync_version, those do not
+    # count
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        return connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'todo_sync_ai' "
+            "AND sql LIKE '%todo_sync_versions%'")).first() is not None
+    if dialect == 'postgresql':
+        return connection.execute(text(
+            "SELECT 1 FROM pg_trigger, pg_proc WHERE tgname = 'todo_sync_insert' "
+            "AND proname = 'todo_sync_stamp' AND prosrc LIKE '%todo_sync_versions%'"
+        )).first() is not None
+    return False
+
+
+def start_versions(connection):
+    # Rows from before the triggers get their id as version. The clients may hold any version
+    # handed out so far (by the single counter of todo_sync_version, when the database had
+    # it), so every owner's counter starts after the highest one there is.
+    connection.execute(update(Todos).where(Todos.version.is_(None))
+                       .values(version=Todos.id, updated_at=datetime.utcnow()))
+    start = max(connection.execute(select(func.max(Todos.version))).scalar() or 0,
+                connection.execute(select(func.max(TodoTombstones.version))).scalar() or 0)
+    pruned = 0
+    if inspect(connection).has_table('todo_sync_version'):
+        value, pruned = connection.execute(text(
+            'SELECT value, pruned FROM todo_sync_version WHERE id = 1')).first() or (0, 0)
+        start = max(start, value)
+    owners = select(func.coalesce(Todos.owner_id, 0).label('owner_id')).union(
+        select(func.coalesce(TodoTombstones.owner_id, 0))).subquery()
+    connection.execute(insert(TodoSyncVersions).from_select(
+        ['owner_id', 'value', 'pruned'],
+        select(owners.c.owner_id, literal(start), literal(pruned))
+        .where(owners.c.owner_id.not_in(select(TodoSyncVersions.owner_id)))))
+
+
+def ensure_sync_triggers(sync_engine):
+    dialect = sync_engine.dialect.name
+    if dialect not in TRIGGER_DIALECTS:
+        return
+    with sync_engine.begin() as connection:
+        inspector = inspect(connection)
+        if not inspector.has_table('todo_sync_versions') or has_sync_triggers(connection):
+            return
+        # create_all does not add columns to a todos table which was already there
+        columns = {column['name'] for column in inspector.get_columns('todos')}
+        for column in (Todos.version, Todos.updated_at):
+            if column.key not in columns:
+                connection.execute(text(f'ALTER TABLE todos ADD COLUMN {column.key} '
+                                        f'{column.type.compile(dialect=connection.dialect)}'))
+        connection.execute(text('CREATE INDEX IF NOT EXISTS ix_todos_owner_id_version '
+                                'ON todos (owner_id, version)'))
+        start_versions(connection)
+        for statement in SQLITE_SYNC_DDL if dialect == 'sqlite' else POSTGRES_SYNC_DDL:
+            connection.execute(text(statement))
+        # the single counter of before, nothing uses it any more
+        connection.execute(text('DROP TABLE IF EXISTS todo_sync_version'))
+    _maintained.forget(sync_engine)
+
+
+# are the triggers there, looked up once per database
+_maintained = PerDatabase(lambda db: has_sync_triggers(db.connection()))
+
+
+def sync_maintained(db) -> bool:
+    return _maintained.get(db)
+
+
+def query_changes(db, columns, owner_id: int, since: int, limit: int):
+    # Returns None when `since` can not be answered (older than the pruned tombstones, or newer
+    # than anything we handed out), otherwise the changed rows and the deleted ids after it,
+    # in version order, at most `limit` of them together.
+    #
+    # The owner's counter is read first, and only versions up to it are returned: on PostgreSQL
+    # every statement sees its own snapshot, a write committing between the statements gets a
+    # higher version than the one we tell the client to continue from, so it comes with the
+    # next sync.
+    current, pruned = db.execute(select(TodoSyncVersions.value, TodoSyncVersions.pruned)
+                                 .where(TodoSyncVersions.owner_id == owner_id)).first() or (0, 0)
+    if since < pruned or since > current:
+        return None
+    rows = db.execute(select(*columns, Todos.version, Todos.updated_at)
+                      .where(Todos.owner_id == owner_id, Todos.version > since,
+                             Todos.version <= current)
+                      .order_by(Todos.version).limit(limit + 1)).all()
+    tombstones = db.execute(select(TodoTombstones.id, TodoTombstones.version)
+                            .where(TodoTombstones.owner_id == owner_id,
+                                   TodoTombstones.version > since,
+                                   TodoTombstones.version <= current)
+                            .order_by(TodoTombstones.version).limit(limit + 1)).all()
+    changes = sorted([(row.version, 'changes', row._asdict()) for row in rows]
+                     + [(row.version, 'deleted', row._asdict()) for row in tombstones],
+                     key=lambda change: change[0])
+    result = {'changes': [], 'deleted': [], 'version': current, 'has_more': len(changes) > limit}
+    if result['has_more']:
+        changes = changes[:limit]
+        # the next page starts after the last change we send
+        result['version'] = changes[-1][0]
+    for _, kind, change in changes:
+        result[kind].append(change)
+    return result
+
+
+def prune_tombstones(connection, days: int = TOMBSTONE_RETENTION_DAYS) -> int:
+    # Drops the tombstones older than `days`. Clients of an owner which synced before the
+    # newest of that owner's would miss those deletes, so from now on they get 410 and fetch
+    # everything again.
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    owner = func.coalesce(TodoTombstones.owner_id, 0)
+    newest = connection.execute(select(owner, func.max(TodoTombstones.version))
+                                .where(TodoTombstones.deleted_at < cutoff)
+                                .group_by(owner)).all()
+    rows = 0
+    for owner_id, version in newest:
+        rows += connection.execute(delete(TodoTombstones).where(
+            owner == owner_id, TodoTombstones.version <= version)).rowcount
+        connection.execute(update(TodoSyncVersions)
+                           .where(TodoSyncVersions.owner_id == owner_id,
+                                  TodoSyncVersions.pruned < version)
+                           .values(pruned=version))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance of the todo sync tombstones')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    prune = subcommands.add_parser('prune', help='drop old tombstones')
+    prune.add_argument('--days', type=int, default=TOMBSTONE_RETENTION_DAYS)
+    args = parser.parse_args()
+
+    # every shard with DATABASE_SHARD_URLS (sharding.py), else the one database
+    from sharding import todo_engines
+    for name, engine in todo_engines():
+        with engine.begin() as connection:
+            rows = prune_tombstones(connection, args.days)
+        print(f'{name}: {rows} tombstones pruned')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import hashlib
+import heapq
+import math
+import os
+import time
+from collections import OrderedDict
+from shared_state import SHARED_BACKENDS, STATE_BACKEND, create_store
+
+# Clients send the same bearer token again and again during its 20 minutes of life, and
+# jwt.decode (with the signature check) was running on every single request. So once a token
+# is verified we keep its claims here, keyed by a digest of the token (we never keep the raw
+# token in memory), until the token's own 'exp' time.
+
+TOKEN_CACHE_ENABLED = os.getenv('TOKEN_CACHE_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+TOKEN_CACHE_MAX_SIZE = int(os.getenv('TOKEN_CACHE_MAX_SIZE', 10000))
+# the verified claims are fine per worker, but a revoke (logout) has to reach every worker, so
+# with several workers the revoked digests go to one of the shared stores of shared_state.py
+TOKEN_REVOCATION_BACKEND = os.getenv('TOKEN_REVOCATION_BACKEND', STATE_BACKEND)
+# a cache hit does not ask the shared store about its token every time: every revoke bumps a
+# counter there, a worker reads it at most this often (seconds) and only when it moved checks
+# its cached tokens again. So a logout on one worker reaches the others within this long
+TOKEN_REVOCATION_SYNC_INTERVAL = float(os.getenv('TOKEN_REVOCATION_SYNC_INTERVAL', 1))
+
+
+def token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class TokenCache:
+
+    def __init__(self, max_size: int = TOKEN_CACHE_MAX_SIZE, enabled: bool = TOKEN_CACHE_ENABLED,
+                 store=None, sync_interval: float = TOKEN_REVOCATION_SYNC_INTERVAL):
+        self.max_size = max(1, max_size)
+        self.enabled = enabled
+        # shared revocations (None: only the _revoked dict of this process)
+        self.store = store
+        self.sync_interval = sync_interval
+        # the revocation counter of the shared store as we last read it, and when
+        self._generation = 0
+        self._synced_at = None
+        # digest -> (exp timestamp, claims, generation it was checked at), oldest used entry
+        # first (LRU order)
+        self._entries = OrderedDict()
+        # digest -> exp timestamp of tokens which were revoked before they expired
+        self._revoked = {}
+        # (exp timestamp, digest) of _revoked, soonest first: every revoke sweeps out the ones
+        # which expired by now, so _revoked only holds revoked tokens which are still alive
+        self._revoked_expiry = []
+        # callables taking the cached user dict ({'username', 'id', 'user_role'}) and returning
+        # True when the token must not be used anymore, e.g. every token of a disabled user
+        self._revocation_hooks = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    async def get(self, token: str):
+        if not self.enabled:
+            return None
+        digest = token_digest(token)
+        entry = self._entries.get(digest)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, claims, generation = entry
+        if expires <= time.time():
+            # expired token, let jwt.decode raise the proper error for it
+            del self._entries[digest]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        if any(hook(claims) for hook in self._revocation_hooks) \
+                or (self.store is not None and await self.revoked_elsewhere(digest, generation)):
+            del self._entries[digest]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        return claims
+
+    def put(self, token: str, claims: dict, expires: float):
+        if not self.enabled or expires is None or expires <= time.time():
+            return
+        digest = token_digest(token)
+        self._entries[digest] = (expires, claims, self._generation)
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def revoked_elsewhere(self, digest: str, generation: int) -> bool:
+        # a cached token: only asked again when some worker revoked a token since we checked it
+        now = time.monotonic()
+        if self._synced_at is None or now - self._synced_at >= self.sync_interval:
+            self._generation = await self.store.get_counter('generation')
+            self._synced_at = now
+        if generation == self._generation:
+            return False
+        if await self.store.get(digest) is not None:
+            return True
+        self._entries[digest] = self._entries[digest][:2] + (self._generation,)
+        return False
+
+    async def is_revoked(self, token: str, claims: dict = None) -> bool:
+        # a token which is not cached yet, the shared store is always asked
+        digest = token_digest(token)
+        if self._revoked:
+            expires = self._revoked.get(digest)
+            if expires is not None:
+                if expires > time.time():
+                    return True
+                del self._revoked[digest]
+        if self.store is not None and await self.store.get(digest) is not None:
+            return True
+        if claims is not None:
+            return any(hook(claims) for hook in self._revocation_hooks)
+        return False
+
+    async def revoke(self, token: str, expires: float):
+        # we only need to remember a revoked token until it would have expired anyway
+        digest = token_digest(token)
+        self._entries.pop(digest, None)
+        now = time.time()
+        while self._revoked_expiry and self._revoked_expiry[0][0] <= now:
+            self._revoked.pop(heapq.heappop(self._revoked_expiry)[1], None)
+        if expires is not None and expires > now:
+            if digest not in self._revoked:
+                heapq.heappush(self._revoked_expiry, (expires, digest))
+            self._revoked[digest] = expires
+            if self.store is not None:
+                await self.store.set(digest, '1', math.ceil(expires - time.time()))
+                # the other workers check their cached tokens again on their next sync
+                await self.store.incr('generation')
+
+    def add_revocation_hook(self, hook):
+        self._revocation_hooks.append(hook)
+
+    def remove_revocation_hook(self, hook):
+        self._revocation_hooks.remove(hook)
+
+    def invalidate(self, token: str):
+        self._entries.pop(token_digest(token), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'revocation_backend': type(self.store).__name__ if self.store is not None else 'memory',
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'revoked': len(self._revoked),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+token_cache = TokenCache(store=create_store(TOKEN_REVOCATION_BACKEND, 'revoked:')
+                         if TOKEN_REVOCATION_BACKEND in SHARED_BACKENDS else None)
@@ -0,0 +1,131 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from database import run
+from models import Users
+from shared_state import SHARED_BACKENDS, STATE_BACKEND, create_store
+
+# GET /user, the password / phone number changes and every token refresh need the same Users
+# row, and it was queried by id every single time although it almost never changes. So we keep
+# the row (as a plain dict, not an ORM object, those belong to one session) per user id for a
+# while. Every write of a user row must call user_cache.invalidate(user_id).
+#
+# The memory backend is per process, so with several workers another worker can serve a row
+# up to USER_CACHE_TTL seconds old. With a shared backend (see shared_state.py) the rows are
+# kept there instead, under a per user generation number like the read cache uses.
+#
+# The password hash is not part of the row: a shared store is a redis server or a file next to
+# the app, no place for it. The login and the password change read it from the database.
+
+USER_CACHE_ENABLED = os.getenv('USER_CACHE_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60))  # seconds
+USER_CACHE_MAX_SIZE = int(os.getenv('USER_CACHE_MAX_SIZE', 10000))
+USER_CACHE_BACKEND = os.getenv('USER_CACHE_BACKEND', STATE_BACKEND)
+
+USER_COLUMNS = ('id', 'email', 'username', 'first_name', 'last_name', 'is_active', 'role',
+                'phone_number')
+
+
+class UserCache:
+
+    def __init__(self, max_size: int = USER_CACHE_MAX_SIZE, ttl: int = USER_CACHE_TTL,
+                 enabled: bool = USER_CACHE_ENABLED, store=None):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.enabled = enabled
+        # one of the shared stores, None keeps the rows in _entries of this process
+        self.store = store
+        # user id -> (expires, row dict), oldest used entry first (LRU order)
+        self._entries = OrderedDict()
+        # bumped by every invalidate, a reader which started before it must not store its row
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def generation(self, user_id: int) -> int:
+        # taken before the row is queried, see put()
+        if self.store is not None:
+            return await self.store.get_counter(f'gen:{user_id}')
+        return self._generation
+
+    async def get(self, user_id: int, generation: int):
+        if not self.enabled:
+            return None
+        if self.store is not None:
+            value = await self.store.get(f'{user_id}:{generation}')
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(value)
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] <= time.monotonic():
+            self._entries.pop(user_id, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    async def put(self, user_id: int, row: dict, generation: int):
+        if not self.enabled:
+            return
+        if self.store is not None:
+            # under the generation taken before the query, a write in between already moved on
+            await self.store.set(f'{user_id}:{generation}', json.dumps(row), self.ttl)
+            return
+        # row was read while a write of some user landed, it may be the old one
+        if generation != self._generation:
+            return
+        self._entries[user_id] = (time.monotonic() + self.ttl, row)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def invalidate(self, user_id: int):
+        self.invalidations += 1
+        if self.store is not None:
+            await self.store.incr(f'gen:{user_id}')
+            return
+        self._generation += 1
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'backend': type(self.store).__name__ if self.store is not None else 'memory',
+            'ttl': self.ttl,
+            'size': self.store.size() if self.store is not None else len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
+
+
+user_cache = UserCache(store=create_store(USER_CACHE_BACKEND, 'users:')
+                       if USER_CACHE_BACKEND in SHARED_BACKENDS else None)
+
+
+def query_user_row(db, user_id: int):
+    row = db.query(*(getattr(Users, column) for column in USER_COLUMNS))\
+        .filter(Users.id == user_id).first()
+    return dict(zip(USER_COLUMNS, row)) if row is not None else None
+
+
+async def get_user_row(db, user_id: int):
+    # the cached row is shared, callers must not change it
+    generation = await user_cache.generation(user_id)
+    row = await user_cache.get(user_id, generation)
+    if row is not None:
+        return row
+    row = await run(db, query_user_row, user_id)
+    if row is not None:
+        await user_cache.put(user_id, row, generation)
+    return row
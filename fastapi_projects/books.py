@@ -1,21 +1,108 @@
+from collections import defaultdict
+from itertools import count
+
 from fastapi import FastAPI
 from fastapi import Body
 
+from shared_books import shared
+
 app = FastAPI()
 
-BOOKS = [
+
+# Every endpoint used to walk the whole BOOKS list and casefold() every title/author/category
+# on every request. The store below casefolds each book once, when it is added, and keeps hash
+# indexes by title, author, category and (author, category), so a lookup only costs as much
+# as the number of books it returns. Books are still the same plain dicts as before.
+class BookStore:
+
+    INDEXES = ('title', 'author', 'category', 'author_category')
+
+    def __init__(self, books=()):
+        self._ids = count()
+        # internal id -> book, in insertion order, that is the order read_all_books returns
+        self._books = {}
+        # internal id -> the casefolded keys the book was indexed under
+        self._keys = {}
+        # index name -> casefolded key -> {internal id: book}
+        self._indexes = {name: defaultdict(dict) for name in self.INDEXES}
+        for book in books:
+            self.add(book)
+
+    def __iter__(self):
+        return iter(self._books.values())
+
+    def __len__(self):
+        return len(self._books)
+
+    @staticmethod
+    def _book_keys(book: dict) -> dict:
+        author = book.get('author', '').casefold()
+        category = book.get('category', '').casefold()
+        return {'title': book.get('title', '').casefold(), 'author': author,
+                'category': category, 'author_category': (author, category)}
+
+    def _index(self, book_id: int, book: dict):
+        keys = self._book_keys(book)
+        self._keys[book_id] = keys
+        for name, key in keys.items():
+            self._indexes[name][key][book_id] = book
+
+    def _unindex(self, book_id: int):
+        for name, key in self._keys.pop(book_id).items():
+            bucket = self._indexes[name][key]
+            del bucket[book_id]
+            if not bucket:
+                del self._indexes[name][key]
+
+    def _find(self, name: str, key) -> dict:
+        return self._indexes[name].get(key, {})
+
+    def add(self, book: dict):
+        book_id = next(self._ids)
+        self._books[book_id] = book
+        self._index(book_id, book)
+
+    def by_title(self, title: str) -> list:
+        return list(self._find('title', title.casefold()).values())
+
+    def by_author(self, author: str) -> list:
+        return list(self._find('author', author.casefold()).values())
+
+    def by_category(self, category: str) -> list:
+        return list(self._find('category', category.casefold()).values())
+
+    def by_author_category(self, author: str, category: str) -> list:
+        return list(self._find('author_category', (author.casefold(), category.casefold())).values())
+
+    def replace_by_title(self, book: dict):
+        # like before, every book with the same title is replaced
+        for book_id in list(self._find('title', book.get('title').casefold())):
+            self._unindex(book_id)
+            self._books[book_id] = book
+            self._index(book_id, book)
+
+    def delete_by_title(self, title: str):
+        # like before, only the first book with this title is removed
+        for book_id in self._find('title', title.casefold()):
+            self._unindex(book_id)
+            del self._books[book_id]
+            break
+
+
+# one BookStore per worker, or with serve_books.py a proxy to the one all workers share
+BOOKS = shared(__name__, BookStore([
     {'title': 'Title One', 'author': 'Author One', 'category': 'science'},
     {'title': 'Title Two', 'author': 'Author Two', 'category': 'science'},
     {'title': 'Title Three', 'author': 'Author Three', 'category': 'history'},
     {'title': 'Title Four', 'author': 'Author Four', 'category': 'math'},
     {'title': 'Title Five', 'author': 'Author Five', 'category': 'math'},
     {'title': 'Title Six', 'author': 'Author Two', 'category': 'math'}
-]
+]))
 
 
 @app.get("/books")
 async def read_all_books():
-    return BOOKS
+    return list(BOOKS)
 
 
 @app.get("/books/{dynamic_param}")
@@ -26,60 +113,41 @@ async def read_all_books(dynamic_param):
 # Pass book title as a dynamic parameter
 @app.get("/book/{book_title}")
 async def read_book(book_title: str):
-    for book in BOOKS:
-        if book.get('title').casefold() == book_title.casefold():
-            return book
+    for book in BOOKS.by_title(book_title):
+        return book
 
 
 # Use Query Parameter
 @app.get("/books/")
 async def read_category_by_book(category:str):
-    books_to_return = []
-    for book in BOOKS:
-        if book.get('category').casefold() == category.casefold():
-            books_to_return.append(book)
-    return books_to_return
+    return BOOKS.by_category(category)
 
 
 # Use Query with Dynamic Path Parameter
 @app.get("/books/{book_author}/")
 async def read_author_category_by_book(book_author:str, category:str):
-    books_to_return = []
-    for book in BOOKS:
-        if book.get('author').casefold() == book_author.casefold() and \
-                book.get('category').casefold() == category.casefold():
-            books_to_return.append(book)
-    return books_to_return
+    return BOOKS.by_author_category(book_author, category)
 
 
 # POST method request
 @app.post("/books/create_book")
 async def create_book(new_book=Body()):
-    BOOKS.append(new_book)
+    BOOKS.add(new_book)
 
 
 # PUT method request
 @app.put("/books/update_book")
 async def update_book(updated_book = Body()):
-    for i in range(len(BOOKS)):
-        if BOOKS[i].get('title').casefold() == updated_book.get('title').casefold():
-            BOOKS[i] = updated_book
+    BOOKS.replace_by_title(updated_book)
 
 
 # DELETE method request
 @app.delete("/books/delete_book/{book_title}")
 async def delete_book(book_title:str):
-    for i in range(len(BOOKS)):
-        if BOOKS[i].get('title').casefold() == book_title.casefold():
-            BOOKS.pop(i)
-            break
+    BOOKS.delete_by_title(book_title)
 
 
 # FastAPI Assignment
 @app.get("/books/by_author/{author}")
 async def read_books_by_author_path(author:str):
-    author_books = []
-    for book in BOOKS:
-        if book.get('author').casefold() == author.casefold():
-            author_books.append(book)
-    return author_books
\ No newline at end of file
+    return BOOKS.by_author(author)
\ No newline at end of file
@@ -1,9 +1,13 @@
+from collections import defaultdict
+from dataclasses import dataclass
 from typing import Optional
 
 from fastapi import FastAPI, Path, Query, HTTPException
 from pydantic import BaseModel, Field
 from starlette import status
 
+from shared_books import shared
+
 # So Pydantic is the framework that allows us to perform validation on data and
 # Base model is used to validate those data variables
 
@@ -11,6 +15,8 @@ app = FastAPI()
 
 
 # Created a Book Object
+# slots=True -- no per object __dict__, which matters once we keep a million of them in memory
+@dataclass(slots=True)
 class Book:
     id: int
     title: str
@@ -19,13 +25,73 @@ class Book:
     rating: int
     published_date: int
 
-    def __init__(self, id, title, author, description, rating, published_date):
-        self.id = id
-        self.title = title
-        self.author = author
-        self.description = description
-        self.rating = rating
-        self.published_date = published_date
+
+# Our in-memory "database" of books. Instead of one list which every endpoint had to walk
+# (and list.pop(i) which shifts everything after i), we keep a dict by id plus secondary
+# indexes by rating and by published date. The index buckets are dicts too (id -> Book), so
+# removing a book from them is O(1) and they still keep the books in insertion order.
+class BookStore:
+
+    def __init__(self, books=()):
+        self._books = {}
+        self._by_rating = defaultdict(dict)
+        self._by_published_date = defaultdict(dict)
+        # ids are never reused, even after the newest book is deleted
+        self._next_id = 1
+        for book in books:
+            self.add(book)
+
+    def __len__(self):
+        return len(self._books)
+
+    def __iter__(self):
+        return iter(self._books.values())
+
+    def _index(self, book: Book):
+        self._by_rating[book.rating][book.id] = book
+        self._by_published_date[book.published_date][book.id] = book
+
+    def _unindex(self, book: Book):
+        for index, key in ((self._by_rating, book.rating),
+                           (self._by_published_date, book.published_date)):
+            bucket = index[key]
+            del bucket[book.id]
+            if not bucket:
+                del index[key]
+
+    def add(self, book: Book) -> Book:
+        # books which already have an id (our seed data) keep it, new ones get the next id
+        if book.id is None or book.id in self._books:
+            book.id = self._next_id
+        self._next_id = max(self._next_id, book.id + 1)
+        self._books[book.id] = book
+        self._index(book)
+        return book
+
+    def get(self, book_id: int) -> Optional[Book]:
+        return self._books.get(book_id)
+
+    def by_rating(self, rating: int) -> list:
+        return list(self._by_rating.get(rating, {}).values())
+
+    def by_published_date(self, published_date: int) -> list:
+        return list(self._by_published_date.get(published_date, {}).values())
+
+    def replace(self, book: Book) -> bool:
+        old_book = self._books.get(book.id)
+        if old_book is None:
+            return False
+        self._unindex(old_book)
+        self._books[book.id] = book
+        self._index(book)
+        return True
+
+    def delete(self, book_id: int) -> bool:
+        book = self._books.pop(book_id, None)
+        if book is None:
+            return False
+        self._unindex(book)
+        return True
 
 
 class BookRequest(BaseModel):
@@ -48,47 +114,40 @@ class BookRequest(BaseModel):
         }
 
 
-BOOKS = [
+# one BookStore per worker, or with serve_books.py a proxy to the one all workers share
+BOOKS = shared(__name__, BookStore([
     Book(1, 'Computer Science', 'coding with Aditya', 'A very nice book', 5, 2012),
     Book(2, "Be fast with FastAPI", "coding with Aditya", "A great book", 5, 2013),
     Book(3, "Master Endpoints", "coding with Aditya", "An awesome book!", 5, 2014),
     Book(4, "HP1", "Author 1", "Book Description", 2, 2016),
     Book(5, "HP2", "Author 2", "Book Description", 3, 2016),
     Book(6, "HP3", "Author 3", "Book Description", 1, 2014)
-]
+]))
 
 
 @app.get("/books", status_code=status.HTTP_200_OK)
 async def read_all_books():
-    return BOOKS
+    return list(BOOKS)
 
 
 # Getting a Single Book
 @app.get("/books/{book_id}", status_code=status.HTTP_200_OK)
 async def read_book(book_id: int = Path(gt=0)):
-    for book in BOOKS:
-        if book.id == book_id:
-            return book
+    book = BOOKS.get(book_id)
+    if book is not None:
+        return book
 
     # if book id never matches
     raise HTTPException(status_code=404, detail='Item Not Found')
 
 @app.get("/books/", status_code=status.HTTP_200_OK)
 async def read_book_by_rating(book_rating: int = Query(gt=0, lt=6)):
-    books_to_return = []
-    for book in BOOKS:
-        if book.rating == book_rating:
-            books_to_return.append(book)
-    return books_to_return
+    return BOOKS.by_rating(book_rating)
 
 
 @app.get("/books/publish/", status_code=status.HTTP_200_OK)
 async def book_by_published_date(publish_date: int = Query(gt=1950, lt=2024)):
-    books_to_return = []
-    for book in BOOKS:
-        if book.published_date == publish_date:
-            books_to_return.append(book)
-    return books_to_return
+    return BOOKS.by_published_date(publish_date)
 
 
 # Here we are creating an object(book) so we have given 201 status.
@@ -96,25 +155,15 @@ async def book_by_published_date(publish_date: int = Query(gt=1950, lt=2024)):
 async def create_book(book_request: BookRequest):
     # It returns all the variables in dictionary form
     new_book = Book(**book_request.model_dump()) # instead of model_dump, use dict()
-    BOOKS.append(find_book_id(new_book))
-
-
-def find_book_id(book : Book):
-    if len(BOOKS) > 0:
-        book.id = BOOKS[-1].id + 1
-    else:
-        book.id = 1
-    return book
+    # the store gives the book its id (the old find_book_id did last id + 1 on the list)
+    new_book.id = None
+    BOOKS.add(new_book)
 
 
 # Here we are not creating anything, so we have given 204 status.
 @app.put("/books/update_book", status_code=status.HTTP_204_NO_CONTENT)
 async def update_book(book: BookRequest):
-    book_changed = False
-    for i in range(len(BOOKS)):
-        if BOOKS[i].id == book.id:
-            BOOKS[i] = book
-            book_changed = True
+    book_changed = BOOKS.replace(Book(**book.model_dump()))
 
     # If No Book has changed, then raise exception
     if not book_changed:
@@ -124,13 +173,8 @@ async def update_book(book: BookRequest):
 # Here we are not returning, we are just enhancing something so 204 is given.
 @app.delete("/books/{book_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_book(book_id:int):
-    book_changed = False
-    for i in range(len(BOOKS)):
-        if BOOKS[i].id == book_id:
-            BOOKS.pop(i)
-            book_changed = True
-            break
+    book_changed = BOOKS.delete(book_id)
 
     # If No Book has deleted, then raise exception
     if not book_changed:
-        raise HTTPException(status_code=404, detail='Book Not Found')
+        raise HTTPException(status_code=404, detail='Book Not Found')
\ No newline at end of file
@@ -0,0 +1,77 @@
+# Benchmark for the BookStore in books2.py against the old list + linear scan approach.
+# Run it from the fastapi_projects folder:
+#
+#   python books2_benchmark.py --books 1000000
+import argparse
+import random
+import time
+import tracemalloc
+
+from books2 import Book, BookStore
+
+
+def make_books(count):
+    return [Book(i, f'Title {i}', f'Author {i % 1000}', 'Book Description',
+                 i % 5 + 1, 1951 + i % 72) for i in range(1, count + 1)]
+
+
+def timed(name, fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f'{name:<34} {elapsed * 1e6:12.1f}us per call')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=1_000_000)
+    parser.add_argument('--lookups', type=int, default=10_000)
+    parser.add_argument('--list-lookups', type=int, default=20,
+                        help='the old linear scans are slow, so we only run a few of them')
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    store = BookStore(make_books(args.books))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'built store with {len(store)} books in {time.perf_counter() - start:.2f}s, '
+          f'peak memory {peak / 1024 / 1024:.0f} MiB')
+
+    old_books = make_books(args.books)
+    ids = [random.randint(1, args.books) for _ in range(args.lookups)]
+    id_iter = iter(ids * 2)
+
+    print('-- by id')
+    timed('store.get', lambda: store.get(next(id_iter)), args.lookups)
+    timed('list scan (old read_book)',
+          lambda: next(book for book in old_books if book.id == ids[0]), args.list_lookups)
+
+    print('-- by rating / published date (all matches)')
+    timed('store.by_rating', lambda: store.by_rating(3), args.list_lookups)
+    timed('list scan (old by rating)',
+          lambda: [book for book in old_books if book.rating == 3], args.list_lookups)
+    timed('store.by_published_date', lambda: store.by_published_date(2000), args.list_lookups)
+    timed('list scan (old by published date)',
+          lambda: [book for book in old_books if book.published_date == 2000], args.list_lookups)
+
+    print('-- delete')
+    delete_ids = iter(random.sample(range(1, args.books + 1), args.lookups))
+    timed('store.delete', lambda: store.delete(next(delete_ids)), args.lookups)
+
+    def old_delete():
+        book_id = random.randint(1, len(old_books))
+        for i in range(len(old_books)):
+            if old_books[i].id == book_id:
+                old_books.pop(i)
+                break
+    timed('list scan + pop (old delete)', old_delete, args.list_lookups)
+
+    print('-- create')
+    timed('store.add', lambda: store.add(Book(None, 'New', 'Author', 'Description', 3, 2000)),
+          args.lookups)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+# Runs books.py or books2.py with several uvicorn workers which all see the same books.
+# Run it from the fastapi_projects folder:
+#
+#   python serve_books.py books2 --workers 4
+#
+# --state memory keeps a BOOKS per worker (the old behaviour, only right with --workers 1).
+import argparse
+import os
+
+import uvicorn
+
+from shared_books import start_manager
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('app', choices=('books', 'books2'))
+    parser.add_argument('--workers', type=int,
+                        default=int(os.getenv('WEB_CONCURRENCY', os.cpu_count() or 1)))
+    parser.add_argument('--state', choices=('memory', 'shared-memory'), default='shared-memory')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    manager = None
+    if args.state == 'shared-memory':
+        manager, manager_env = start_manager()
+        os.environ.update(manager_env)
+    try:
+        uvicorn.run(f'{args.app}:app', host=args.host, port=args.port, workers=args.workers,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
+    finally:
+        if manager is not None:
+            manager.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import functools
+import importlib
+import os
+import secrets
+import threading
+from multiprocessing.managers import BaseManager
+
+# books.py and books2.py keep BOOKS in a module global, so with `uvicorn --workers 4` every
+# worker has its own books: a book created on one worker is missing on the other three. Started
+# through serve_books.py, the BookStore lives in one manager process instead, and BOOKS of every
+# worker is a proxy which sends each method call there (one round trip over a local socket).
+# Without BOOKS_MANAGER_ADDRESS (uvicorn books2:app, one worker) BOOKS stays the plain BookStore.
+#
+# The endpoints stay async defs: the manager does one call at a time anyway (LockedStore), so
+# running them on a threadpool would only give more threads waiting for the same lock, and with
+# the plain BookStore the event loop is what keeps two requests from changing it at once.
+
+
+class LockedStore:
+    # the manager serves every worker connection on its own thread, so one call at a time
+
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.Lock()
+
+    def call(self, method: str, *args):
+        with self._lock:
+            result = getattr(self._store, method)(*args)
+            # an iterator can not be sent back to the worker, the list of books can
+            return list(result) if method == '__iter__' else result
+
+
+_stores = {}
+
+
+def get_store(module: str):
+    # runs in the manager process, which imports books.py / books2.py without
+    # BOOKS_MANAGER_ADDRESS, so their BOOKS is the plain BookStore with the seed books
+    if module not in _stores:
+        _stores[module] = LockedStore(importlib.import_module(module).BOOKS)
+    return _stores[module]
+
+
+class BooksManager(BaseManager):
+    pass
+
+
+BooksManager.register('store', callable=get_store)
+
+
+class SharedStore:
+    # looks like a BookStore to the endpoints: BOOKS.by_rating(5), list(BOOKS), len(BOOKS)
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+
+    def __getattr__(self, method: str):
+        return functools.partial(self._proxy.call, method)
+
+    def __iter__(self):
+        return iter(self._proxy.call('__iter__'))
+
+    def __len__(self):
+        return self._proxy.call('__len__')
+
+
+def shared(module: str, store):
+    # BOOKS of a worker: the store itself, or a proxy to the one in the manager of serve_books.py
+    address = os.getenv('BOOKS_MANAGER_ADDRESS')
+    if not address:
+        return store
+    host, port = address.rsplit(':', 1)
+    manager = BooksManager(address=(host, int(port)),
+                           authkey=bytes.fromhex(os.getenv('BOOKS_MANAGER_AUTHKEY', '')))
+    manager.connect()
+    return SharedStore(manager.store(module))
+
+
+def start_manager():
+    # returns the manager (keep a reference, it shuts the process down when collected) and the
+    # env vars which make the workers use it
+    authkey = secrets.token_bytes(16)
+    manager = BooksManager(address=('127.0.0.1', 0), authkey=authkey)
+    manager.start()
+    host, port = manager.address
+    return manager, {'BOOKS_MANAGER_ADDRESS': f'{host}:{port}',
+                     'BOOKS_MANAGER_AUTHKEY': authkey.hex()}
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# books.py / books2.py import shared_books flat, like uvicorn books2:app run in this folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,60 @@
+import importlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+import books2
+from books2 import Book, BookStore
+from shared_books import SharedStore, shared, start_manager
+
+
+def test_one_worker_keeps_the_plain_store(monkeypatch):
+    monkeypatch.delenv('BOOKS_MANAGER_ADDRESS', raising=False)
+    store = BookStore()
+    assert shared('books2', store) is store
+    assert isinstance(books2.BOOKS, BookStore)
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    # what serve_books.py does: the manager first (it imports books2 without the address), then
+    # the address for the workers
+    manager, manager_env = start_manager()
+    for name, value in manager_env.items():
+        monkeypatch.setenv(name, value)
+    yield manager
+    manager.shutdown()
+
+
+def test_workers_share_the_books(manager):
+    # two workers, each with its own connection to the manager
+    first, second = shared('books2', None), shared('books2', None)
+    assert isinstance(first, SharedStore)
+    assert len(first) == len(second) == 6
+
+    book = first.add(Book(None, 'Shared Book', 'Author', 'seen by every worker', 4, 2020))
+    assert second.get(book.id) == book
+    assert book in second.by_rating(4)
+    assert second.replace(Book(book.id, 'Shared Book', 'Author', 'changed', 1, 2020))
+    assert first.get(book.id).rating == 1
+    assert book.id not in {each.id for each in first.by_rating(4)}
+    assert second.delete(book.id)
+    assert first.get(book.id) is None
+    assert len(first) == 6
+
+
+def test_endpoints_through_the_manager(manager, monkeypatch):
+    module = importlib.reload(books2)
+    try:
+        client = TestClient(module.app)
+        response = client.post('/create_book', json={
+            'id': None, 'title': 'Through HTTP', 'author': 'Author', 'description': 'a book',
+            'rating': 5, 'published_date': 2021})
+        assert response.status_code == 201
+        # another worker, e.g. the one the next request lands on
+        other = shared('books2', None)
+        assert 'Through HTTP' in {book.title for book in other.by_rating(5)}
+        assert len(client.get('/books').json()) == len(other) == 7
+    finally:
+        monkeypatch.delenv('BOOKS_MANAGER_ADDRESS')
+        importlib.reload(books2)